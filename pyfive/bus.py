@@ -3,8 +3,9 @@ from pyfive import plic
 from pyfive import dram
 from pyfive import uart
 from pyfive import virtio
+from pyfive import virtio_console
 from pyfive import trap
-import numpy as np
+from pyfive import util
 
 DRAM_BASE=0x8000_0000
 DRAM_SIZE=16*1024*1024
@@ -21,63 +22,129 @@ UART_SIZE=0x100
 VIRTIO_BASE=0x1000_1000
 VIRTIO_SIZE=0x1000
 
+# the next virtio-mmio slot
+VIRTIO_CONSOLE_BASE=0x1000_2000
+
 class Bus():
-    def __init__(self, size=DRAM_SIZE, dram_bin=None, disk_bin=None):
+    def __init__(self, size=DRAM_SIZE, dram_bin=None, disk_bin=None, queue_size=virtio.QUEUE_SIZE,
+                 io_workers=0, console=None, timer=clint.TIMER_MODES[0], frequency=clint.FREQUENCY,
+                 ips=clint.IPS, vconsole=None):
         self.ram = dram.Memory(size, dram_bin)
-        self.clint = clint.Clint(CLINT_SIZE)
+        self.dram_base = DRAM_BASE
+        # typed dram accessors by access size
+        self.read_int = {1: self.ram.read_i8, 2: self.ram.read_i16,
+                         4: self.ram.read_i32, 8: self.ram.read_i64}
+        self.read_uint = {1: self.ram.read_u8, 2: self.ram.read_u16,
+                          4: self.ram.read_u32, 8: self.ram.read_u64}
+        self.write_uint = {1: self.ram.write_u8, 2: self.ram.write_u16,
+                           4: self.ram.write_u32, 8: self.ram.write_u64}
+        # page number -> (base, end, device) of the mmio region covering it
+        self.pages = {}
+        self.regions = []
+        # loads that went to a device, for the jit to tell a spinning block
+        # from one polling a device
+        self.mmio_loads = 0
+        self.clint = clint.Clint(CLINT_SIZE, timer, frequency, ips)
         self.plic = plic.Plic(PLIC_SIZE)
-        self.uart = uart.Uart(UART_SIZE)
-        self.virtio = virtio.Virtio(VIRTIO_SIZE, self, disk_bin)
+        self.uart = uart.Uart(UART_SIZE, self.plic, console)
+        self.virtio = virtio.Virtio(VIRTIO_SIZE, self, disk_bin, queue_size, io_workers)
+        self.register(CLINT_BASE, CLINT_SIZE, self.clint)
+        self.register(PLIC_BASE, PLIC_SIZE, self.plic)
+        self.register(UART_BASE, UART_SIZE, self.uart)
+        self.register(VIRTIO_BASE, VIRTIO_SIZE, self.virtio)
+        # the virtio console is there only when given a backend
+        self.vconsole = None
+        if vconsole is not None:
+            self.vconsole = virtio_console.VirtioConsole(VIRTIO_SIZE, self, vconsole, queue_size)
+            self.register(VIRTIO_CONSOLE_BASE, VIRTIO_SIZE, self.vconsole)
+
+    # Flush console output and let go of host resources: disk, i/o threads,
+    # the console and the plic's selector.
+    def close(self):
+        self.uart.close()
+        if self.vconsole is not None:
+            self.vconsole.close()
+        self.virtio.close()
+        self.plic.close()
+
+    # Map a device at [base, base + size). The device gets load(offset, size)
+    # and store(offset, size, data) calls with offsets relative to base. A
+    # page holds at most one region.
+    def register(self, base, size, device):
+        first = base >> dram.PAGE_SHIFT
+        last = (base + size - 1) >> dram.PAGE_SHIFT
+        dram_first = self.dram_base >> dram.PAGE_SHIFT
+        dram_last = (self.dram_base + self.ram.size - 1) >> dram.PAGE_SHIFT
+        for page in range(first, last + 1):
+            if page in self.pages or dram_first <= page <= dram_last:
+                raise ValueError(f"region at {hex(base)} overlaps another one")
+        region = (base, base + size, device)
+        for page in range(first, last + 1):
+            self.pages[page] = region
+        self.regions.append(region)
+
+    def in_dram(self, addr, size):
+        return 0 <= addr - self.dram_base <= self.ram.size - size
+
+    # the region an access of size bytes at addr falls in completely, if any
+    def find(self, addr, size):
+        region = self.pages.get(addr >> dram.PAGE_SHIFT)
+        if region is not None and region[0] <= addr and addr + size <= region[1]:
+            return region
+        return None
+
+    # Device dma, restricted to dram: dma_read returns a zero-copy view of
+    # size bytes at addr and dma_write copies a buffer to addr in one go.
+    def dma_read(self, addr, size):
+        if not self.in_dram(addr, size):
+            return trap.EXCEPTION.LoadAccessFault
+        return self.ram.view(addr - self.dram_base, size)
+
+    def dma_write(self, addr, data):
+        if not self.in_dram(addr, len(data)):
+            return trap.EXCEPTION.StoreAMOAccessFault
+        return self.ram.store(addr - self.dram_base, len(data), data)
 
     def loadint(self, addr, size):
-        arr = self.load(int(addr), size)
-        if isinstance(arr, trap.EXCEPTION):
-            return arr
-        # print("loadint", hex(addr) ,size, len(arr), arr)
-        val = arr
-        if isinstance(arr, bytes) or isinstance(arr, bytearray):
-            if len(arr) < size:
-                return trap.EXCEPTION.LoadAccessFault
-            val = int.from_bytes(arr, byteorder='little', signed=True)
-        return np.uint64(val)
+        offset = addr - self.dram_base
+        if 0 <= offset <= self.ram.size - size:
+            return self.read_int[size](offset) & util.MASK64
+        return self.load_mmio(addr, size, True)
 
     def loaduint(self, addr, size):
-        arr = self.load(int(addr), size)
+        offset = addr - self.dram_base
+        if 0 <= offset <= self.ram.size - size:
+            return self.read_uint[size](offset)
+        return self.load_mmio(addr, size, False)
+
+    def load_mmio(self, addr, size, signed):
+        self.mmio_loads += 1
+        arr = self.load(addr, size)
         if isinstance(arr, trap.EXCEPTION):
             return arr
         val = arr
         if isinstance(arr, bytes) or isinstance(arr, bytearray):
             if len(arr) < size:
                 return trap.EXCEPTION.LoadAccessFault
-            val = int.from_bytes(arr, byteorder='little', signed=False)
-        return np.uint64(val)
+            val = int.from_bytes(arr, byteorder='little', signed=signed)
+        return val & util.MASK64
 
     def load(self, addr, size):
-        if isinstance(addr, trap.EXCEPTION):
-            return addr
-        if addr >= DRAM_BASE and addr < DRAM_BASE + DRAM_SIZE:
-            return self.ram.load(addr-DRAM_BASE, size)
-        elif addr >= CLINT_BASE and addr < CLINT_BASE + CLINT_SIZE:
-            return self.clint.load(addr-CLINT_BASE, size)
-        elif addr >= PLIC_BASE and addr < PLIC_BASE + PLIC_SIZE:
-            return self.plic.load(addr-PLIC_BASE, size)
-        elif addr >= UART_BASE and addr < UART_BASE + UART_SIZE:
-            return self.uart.load(addr-UART_BASE, size)
-        elif addr >= VIRTIO_BASE and addr < VIRTIO_BASE + VIRTIO_SIZE:
-            return self.virtio.load(addr-VIRTIO_BASE, size)
-        return trap.EXCEPTION.LoadAccessFault
+        offset = addr - self.dram_base
+        if 0 <= offset <= self.ram.size - size:
+            return self.ram.load(offset, size)
+        region = self.find(addr, size)
+        if region is None:
+            return trap.EXCEPTION.LoadAccessFault
+        return region[2].load(addr - region[0], size)
 
     def store(self, addr, size, data):
-        if isinstance(addr, trap.EXCEPTION):
-            return addr
-        if addr >= DRAM_BASE and addr + size < DRAM_BASE + DRAM_SIZE:
-            return self.ram.store(addr-DRAM_BASE, size, data)
-        elif addr >= CLINT_BASE and addr + size < CLINT_BASE + CLINT_SIZE:
-            return self.clint.store(addr-CLINT_BASE, size, data)
-        elif addr >= PLIC_BASE and addr + size < PLIC_BASE + PLIC_SIZE:
-            return self.plic.store(addr-PLIC_BASE, size, data)
-        elif addr >= UART_BASE and addr < UART_BASE + UART_SIZE:
-            return self.uart.store(addr-UART_BASE, size, data)
-        elif addr >= VIRTIO_BASE and addr < VIRTIO_BASE + VIRTIO_SIZE:
-            return self.virtio.store(addr-VIRTIO_BASE, size, data)
-        return trap.EXCEPTION.StoreAMOAccessFault
+        offset = addr - self.dram_base
+        if 0 <= offset <= self.ram.size - size:
+            if data.__class__ is int and size in self.write_uint:
+                return self.write_uint[size](offset, data)
+            return self.ram.store(offset, size, data)
+        region = self.find(addr, size)
+        if region is None:
+            return trap.EXCEPTION.StoreAMOAccessFault
+        return region[2].store(addr - region[0], size, data)
@@ -1,8 +1,18 @@
 import sys
+import argparse
+import atexit
 from typing import List
 from pyfive import cpu
 from pyfive import bus
+from pyfive import clint
+from pyfive import console
+from pyfive import disk
+from pyfive import snapshot
+from pyfive import tcache
+from pyfive import trace
+from pyfive import virtio
 import logging
+import os
 import signal
 
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(filename)s[%(lineno)d] - %(message)s"
@@ -17,16 +27,218 @@ def handler(*args):
     emu.dump_regs()
     sys.exit(0)
 
+# "256M", "2G", "65536" -> bytes
+def parse_size(text: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    scale = units.get(text[-1:].upper(), 1)
+    if scale != 1:
+        text = text[:-1]
+    try:
+        size = int(text, 0) * scale
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size {text!r}")
+    if size <= 0 or size % 4096:
+        raise argparse.ArgumentTypeError("size must be a positive multiple of 4K")
+    return size
+
+def parse_queue_size(text: str) -> int:
+    size = int(text, 0)
+    if size <= 0 or size > 32768 or size & (size - 1):
+        raise argparse.ArgumentTypeError("queue size must be a power of 2 up to 32768")
+    return size
+
+def parse_console(spec: str):
+    try:
+        return console.open_console(spec)
+    except (OSError, ValueError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def report_memory(ram):
+    resident = ram.resident()
+    configured = ram.size >> 20
+    if resident is None:
+        logging.info(f"dram: {configured} MiB configured")
+    else:
+        logging.info(f"dram: {resident >> 20} MiB resident of {configured} MiB configured")
+
+# Calls action once, when the console has printed pattern.
+def watch_output(uart, pattern, action):
+    pattern = pattern.encode()
+    tail = bytearray()
+    def hook(byte):
+        if not pattern:
+            return
+        tail.append(byte)
+        del tail[:-len(pattern)]
+        if tail == pattern:
+            tail.clear()
+            action()
+    uart.output_hooks.append(hook)
+
+# Run with a snapshot every checkpoint_every instructions, the first one
+# incremental on top of the restored snapshot if there is one, until stopped
+# or snapshot_after instructions have run.
+def run_checkpointed(emu, args):
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    parent = args.restore
+    remaining = args.snapshot_after
+    n = 0
+    while True:
+        budget = args.checkpoint_every if remaining is None else min(args.checkpoint_every, remaining)
+        done = emu.run(budget)
+        if remaining is not None:
+            remaining -= done
+        if not emu.running or (remaining is not None and remaining <= 0):
+            return
+        path = os.path.join(args.checkpoint_dir, f"checkpoint-{n:04d}.snap")
+        emu.save_snapshot(path, parent)
+        logging.info(f"checkpoint saved to {path}")
+        parent = path
+        n += 1
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="pyfive", description="RISC-V emulator")
+    parser.add_argument("dram_bin", nargs="?", help="kernel image loaded at the start of dram")
+    parser.add_argument("disk_bin", nargs="?", help="disk image for the virtio block device")
+    parser.add_argument("-m", "--memory", type=parse_size, default=bus.DRAM_SIZE,
+                        help="dram size, e.g. 128M or 2G (default 16M)")
+    parser.add_argument("--queue-size", type=parse_queue_size, default=virtio.QUEUE_SIZE,
+                        help="virtio block queue size offered to the guest")
+    parser.add_argument("--async-io", type=int, default=0, metavar="WORKERS",
+                        help="do disk i/o on a pool of WORKERS threads while the guest runs "
+                             "(default 0: synchronous, deterministic)")
+    parser.add_argument("--overlay", nargs="?", const="", default=None, metavar="DELTA",
+                        help="leave disk_bin untouched and send guest writes to a copy-on-write "
+                             "delta, in memory or in the sparse file DELTA")
+    parser.add_argument("--overlay-mode", choices=disk.OVERLAY_MODES, default="discard",
+                        help="what happens to the overlay at exit: discard it, keep it for "
+                             "the next run (needs DELTA) or commit it into disk_bin")
+    parser.add_argument("--console", type=parse_console, default="stdio", metavar="SPEC",
+                        help="console backend: stdio (default), memory (headless), file:OUT "
+                             "or pipe:IN,OUT (named pipes)")
+    parser.add_argument("--virtio-console", type=parse_console, metavar="SPEC",
+                        help="add a virtio console at 0x10002000 on a backend named as for --console")
+    parser.add_argument("--timer", choices=clint.TIMER_MODES, default=clint.TIMER_MODES[0],
+                        help="derive mtime from instructions run (virtual, deterministic) "
+                             "or from the host clock (realtime)")
+    parser.add_argument("--timer-frequency", type=int, default=clint.FREQUENCY, metavar="HZ",
+                        help=f"mtime ticks per second (default {clint.FREQUENCY})")
+    parser.add_argument("--ips", type=int, default=clint.IPS, metavar="N",
+                        help="guest instructions per second of virtual time (default: one per tick)")
+    parser.add_argument("--trace", type=int, metavar="N",
+                        help="keep the last N instructions and traps, printed with the registers "
+                             "on an unhandled exception or ^C (runs without the jit)")
+    parser.add_argument("--trace-file", metavar="PATH",
+                        help="write every instruction, memory access and trap to a binary trace "
+                             "(runs without the jit); python -m pyfive.trace converts it to a "
+                             "spike commit log")
+    parser.add_argument("--trace-zlib", action="store_true",
+                        help="compress the --trace-file trace")
+    parser.add_argument("--restore", metavar="SNAPSHOT",
+                        help="start from a snapshot instead of booting")
+    parser.add_argument("--snapshot", metavar="PATH",
+                        help="save a snapshot to PATH and exit, once --snapshot-on or "
+                             "--snapshot-after is reached")
+    parser.add_argument("--snapshot-on", metavar="TEXT",
+                        help="snapshot when the console prints TEXT, e.g. '$ '")
+    parser.add_argument("--snapshot-after", type=int, metavar="N",
+                        help="snapshot after N instructions")
+    parser.add_argument("--checkpoint-every", type=int, metavar="N",
+                        help="save an incremental snapshot every N instructions")
+    parser.add_argument("--checkpoint-dir", default="checkpoints",
+                        help="directory of the --checkpoint-every snapshots")
+    parser.add_argument("--dirty-granularity", type=parse_size, default=4096, metavar="SIZE",
+                        help="granule of dram dirty tracking for checkpoints (default 4K)")
+    parser.add_argument("--cache-dir", default=tcache.DEFAULT_DIR,
+                        help="directory of the persistent translation cache")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not load or save translated blocks")
+    args = parser.parse_args(argv[1:])
+    if args.snapshot and args.snapshot_on is None and args.snapshot_after is None:
+        parser.error("--snapshot needs --snapshot-on or --snapshot-after")
+    if not args.snapshot and (args.snapshot_on is not None or args.snapshot_after is not None):
+        parser.error("--snapshot-on and --snapshot-after need --snapshot")
+    if args.checkpoint_every is not None and args.checkpoint_every <= 0:
+        parser.error("--checkpoint-every must be positive")
+    if args.snapshot_after is not None and args.snapshot_after <= 0:
+        parser.error("--snapshot-after must be positive")
+    if args.timer_frequency <= 0 or args.ips <= 0:
+        parser.error("--timer-frequency and --ips must be positive")
+    if args.trace is not None and args.trace <= 0:
+        parser.error("--trace must be positive")
+    if args.trace is not None and args.trace_file:
+        parser.error("--trace and --trace-file are exclusive")
+    if args.trace_zlib and not args.trace_file:
+        parser.error("--trace-zlib needs --trace-file")
+    return args
+
 def main(argv: List[str] = None) -> int:
     global emu
+    args = parse_args(argv)
     signal.signal(signal.SIGINT, handler)
-    if len(argv) > 2:
-        mybus = bus.Bus(dram_bin=argv[1], disk_bin=argv[2])
-    elif len(argv) > 1:
-        mybus = bus.Bus(dram_bin=argv[1])
-    else:
+    if not args.dram_bin:
         logging.fatal("dram_bin must be specified!")
-    emu = cpu.Cpu(mybus)
-    emu.run()
+        return 1
+    disk_bin = args.disk_bin
+    if args.overlay is not None:
+        if not disk_bin:
+            logging.fatal("--overlay needs a disk_bin to lay over")
+            return 1
+        try:
+            disk_bin = disk.Overlay(disk_bin, args.overlay or None, args.overlay_mode)
+        except ValueError as e:
+            logging.fatal(e)
+            return 1
+    memory = args.memory
+    if args.restore:
+        try:
+            memory = snapshot.read_header(args.restore)["dram_size"]
+        except (OSError, ValueError) as e:
+            logging.fatal(e)
+            return 1
+    mybus = bus.Bus(size=memory, dram_bin=args.dram_bin, disk_bin=disk_bin,
+                    queue_size=args.queue_size, io_workers=args.async_io, console=args.console,
+                    timer=args.timer,
+                    frequency=args.timer_frequency, ips=args.ips, vconsole=args.virtio_console)
+    tracer = None
+    if args.trace:
+        tracer = trace.Ring(args.trace)
+    elif args.trace_file:
+        try:
+            tracer = trace.BinaryTrace(args.trace_file, args.trace_zlib)
+        except OSError as e:
+            logging.fatal(e)
+            return 1
+        atexit.register(tracer.close)
+    emu = cpu.Cpu(mybus, trace=tracer)
+    atexit.register(report_memory, mybus.ram)
+    atexit.register(mybus.close)
+    if not args.no_cache:
+        cache = tcache.TranslationCache.for_image(args.dram_bin, args.cache_dir)
+        emu.translator.cache = cache
+        atexit.register(cache.save)
+    if args.checkpoint_every:
+        try:
+            mybus.ram.track_dirty(args.dirty_granularity)
+        except ValueError as e:
+            logging.fatal(e)
+            return 1
+    if args.restore:
+        emu.load_snapshot(args.restore)
+    if args.snapshot_on is not None:
+        watch_output(mybus.uart, args.snapshot_on, emu.stop)
+    try:
+        if args.checkpoint_every:
+            run_checkpointed(emu, args)
+        else:
+            emu.run(args.snapshot_after)
+    except Exception:
+        if emu.trace is not None:
+            emu.trace.dump()
+        raise
+    if args.snapshot:
+        emu.save_snapshot(args.snapshot)
+        logging.info(f"snapshot saved to {args.snapshot}")
+    return 0
 if __name__ == "__main__":
     sys.exit(main(argv=sys.argv))
@@ -1,10 +1,23 @@
 # The clint module contains the core-local interruptor (CLINT). The CLINT
 # block holds memory-mapped control and status registers associated with
 # software and timer interrupts. It generates per-hart software interrupts and timer.
+#
+# mtime is not a register that counts by itself: it is worked out when read,
+# from the number of instructions the hart has run (virtual time, the
+# default, so a run is the same every time) or from the host's monotonic
+# clock (real time), at frequency ticks per second. Whenever mtime or
+# mtimecmp changes the clint works out the instruction count at which the
+# timer goes off, its deadline, which the cpu folds into cpu.next_event, so
+# the run loop only compares two integers per instruction. In real time that count is a
+# guess, reached every REALTIME_POLL instructions to look at the clock.
+# MTIP in mip follows mtime >= mtimecmp, as it does on hardware.
+#
+# While the hart is idle (wfi, or a loop the jit found spinning) virtual
+# time skips straight to the timer; real time sleeps until it. Either way
+# a device event ends the wait early.
 
-import numpy as np
 from enum import Enum
-import logging
+import time
 
 # The address of a mtimecmp register starts. A mtimecmp is a dram mapped machine mode timer
 # compare register, used to trigger an interrupt when mtimecmp is greater than or equal to mtime.
@@ -13,30 +26,131 @@ class CLINT(Enum):
     MTIMECMP = 0x4000
     MTIME = 0xbff8
 
+MASK64 = 0xffffffffffffffff
+TIMER_MODES = ("virtual", "realtime")
+# ticks per second, the timebase of qemu's virt machine
+FREQUENCY = 10_000_000
+# guest instructions per second of virtual time: one per tick
+IPS = FREQUENCY
+# instructions between clock reads in real time
+REALTIME_POLL = 10_000
+# longest sleep of an idle hart, in seconds, so the run loop keeps control
+IDLE_WAIT = 0.1
+# an instruction count the hart never reaches
+NEVER = 1 << 64
+# mip and its MTIP bit; cpu.py imports this module, so not from there
+MIP = 0x344
+MTIP = 1 << 7
+
 class Clint():
-    def __init__(self, size):
-        self.mtime = np.uint64(0)
-        self.mtimecmp = np.uint64(0)
+    def __init__(self, size, mode=TIMER_MODES[0], frequency=FREQUENCY, ips=IPS):
+        if mode not in TIMER_MODES:
+            raise ValueError(f"timer mode must be one of {', '.join(TIMER_MODES)}")
+        if frequency <= 0 or ips <= 0:
+            raise ValueError("timer frequency and instructions per second must be positive")
+        self.mode = mode
+        self.frequency = frequency
+        self.ips = ips
+        # no timer interrupt until the guest asks for one
+        self.mtimecmp = MASK64
+        self.cpu = None
+        # instruction count at which schedule() has to run again
+        self.deadline = NEVER
+        # mtime was base_mtime when the hart had run base_insts instructions,
+        # at host time base_time
+        self.base_mtime = 0
+        self.base_insts = 0
+        self.base_time = time.monotonic()
+
+    # Connect the hart whose instructions drive virtual time and whose mip
+    # holds MTIP.
+    def attach(self, cpu):
+        self.cpu = cpu
+        self.set_mtime(self.base_mtime)
+        self.schedule()
+
+    def insts(self):
+        return self.cpu.insts if self.cpu is not None else 0
+
+    def read_mtime(self):
+        match self.mode:
+            case "virtual":
+                ticks = (self.insts() - self.base_insts) * self.frequency // self.ips
+            case "realtime":
+                ticks = int((time.monotonic() - self.base_time) * self.frequency)
+        return (self.base_mtime + ticks) & MASK64
+
+    def set_mtime(self, value):
+        self.base_mtime = value & MASK64
+        self.base_insts = self.insts()
+        self.base_time = time.monotonic()
+
+    # Raise or lower MTIP for the current mtime and set the deadline to when
+    # that has to be done again.
+    def schedule(self):
+        cpu = self.cpu
+        if cpu is None:
+            return
+        expired = self.read_mtime() >= self.mtimecmp
+        if expired or self.mtimecmp == MASK64:
+            # all ones is how guests turn the timer off (xv6's timervec, sbi):
+            # an idle hart must not skip 2^64 ticks ahead to reach it
+            self.deadline = NEVER
+        elif self.mode == "virtual":
+            # the first count at which base_mtime + elapsed ticks >= mtimecmp
+            self.deadline = self.base_insts - (self.base_mtime - self.mtimecmp) * self.ips // self.frequency
+        else:
+            self.deadline = cpu.insts + REALTIME_POLL
+        cpu.reschedule()
+        csrs = cpu.csrs.csrs
+        mip = csrs[MIP] | MTIP if expired else csrs[MIP] & ~MTIP
+        if mip != csrs[MIP]:
+            csrs[MIP] = mip
+            cpu.update_interrupts()
+
+    # Let time pass while the hart has nothing to do, until the timer goes
+    # off or wait(timeout), the plic's, returns early for a device event.
+    def idle(self, wait):
+        cpu = self.cpu
+        if self.mode == "virtual":
+            if self.deadline != NEVER:
+                cpu.insts = max(cpu.insts, self.deadline)
+            else:
+                # no timer to skip to: time goes by as on the host
+                start = time.monotonic()
+                wait(IDLE_WAIT)
+                cpu.insts += int((time.monotonic() - start) * self.ips)
+        else:
+            left = (self.mtimecmp - self.read_mtime()) / self.frequency
+            wait(min(max(left, 0), IDLE_WAIT))
+        self.schedule()
+
+    def save_state(self):
+        return {"mtime": self.read_mtime(), "mtimecmp": self.mtimecmp}
+
+    def load_state(self, state):
+        self.set_mtime(state["mtime"])
+        self.mtimecmp = state["mtimecmp"]
+        self.schedule()
 
     def load64(self, addr):
-        logging.debug(f"load clint addr {hex(addr)}")
         addr = CLINT(addr)
         match addr:
             case CLINT.MTIMECMP:
                 return self.mtimecmp
             case CLINT.MTIME:
-                return self.mtime
+                return self.read_mtime()
             case other:
-                return np.uint64(0)
+                return 0
 
     def store64(self, addr, value):
-        logging.debug(f"store clint addr {hex(addr)}")
         addr = CLINT(addr)
         match addr:
             case CLINT.MTIMECMP:
-                self.mtimecmp = np.uint64(value)
+                self.mtimecmp = value & 0xffffffffffffffff
             case CLINT.MTIME:
-                self.mtime = np.uint64(value)
+                self.set_mtime(value)
+        self.schedule()
 
     def load(self, addr, size):
         if size != 8:
@@ -47,6 +161,6 @@ class Clint():
         if size != 8:
             raise("storing clint size is not 8")
         value = data
-        if isinstance(data, bytes):
-            val = int.from_bytes(data, byteorder='little', signed=False)
-        self.store64(addr, val)
+        if isinstance(data, bytes) or isinstance(data, bytearray):
+            value = int.from_bytes(data, byteorder='little', signed=False)
+        self.store64(addr, value)
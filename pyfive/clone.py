@@ -0,0 +1,111 @@
+# The clone module branches a running machine into independent copies with
+# os.fork, one per scenario. Guest memory is a private mapping, so children
+# share it with the parent copy-on-write and a scenario starts from a fork
+# instead of a boot. Each child gets a disk overlay of its own on top of the
+# parent's disk and a console of its own: input queued by the scenario,
+# output captured instead of printed. What the scenario returns comes back
+# to the parent through a pipe, together with the console output. Children
+# leave with os._exit, so the parent's exit handlers (overlay commit, cache
+# save) never run in them.
+
+import concurrent.futures
+import os
+import pickle
+import sys
+import traceback
+from pyfive import console
+from pyfive import disk
+
+
+class CloneResult():
+    def __init__(self, index, scenario):
+        self.index = index
+        self.scenario = scenario
+        # what run(cpu, scenario) returned
+        self.value = None
+        self.output = b""
+        # traceback of an exception in the child, or how it died
+        self.error = None
+
+
+# Detach a freshly forked machine from what it shares with its parent.
+def isolate(emu, output):
+    virtio = emu.bus.virtio
+    virtio.disk = disk.Overlay(virtio.disk)
+    if virtio.pool is not None:
+        # worker threads do not survive a fork
+        virtio.pool = concurrent.futures.ThreadPoolExecutor(virtio.io_workers, thread_name_prefix="virtio")
+    # a selector and wakeup pipe of its own, and no terminal
+    emu.bus.plic.open_wakeup()
+    uart = emu.bus.uart
+    uart.watched = None
+    uart.set_console(console.Console())
+    uart.output_hooks = [output.append]
+    uart.pending.clear()
+    vconsole = emu.bus.vconsole
+    if vconsole is not None:
+        vconsole.watched = None
+        vconsole.set_console(console.MemoryConsole(output))
+        vconsole.pending.clear()
+
+
+def child(emu, index, scenario, run, wfd):
+    result = CloneResult(index, scenario)
+    output = bytearray()
+    try:
+        isolate(emu, output)
+        result.value = run(emu, scenario)
+    except BaseException:
+        result.error = traceback.format_exc()
+    result.output = bytes(output)
+    try:
+        data = pickle.dumps(result)
+    except Exception as e:
+        result.value = None
+        result.error = f"result not picklable: {e}"
+        data = pickle.dumps(result)
+    with os.fdopen(wfd, "wb") as f:
+        f.write(data)
+
+
+def collect(pid, rfd, index, scenario):
+    with os.fdopen(rfd, "rb") as f:
+        data = f.read()
+    _pid, status = os.waitpid(pid, 0)
+    if data:
+        return pickle.loads(data)
+    result = CloneResult(index, scenario)
+    result.error = f"child exited with status {os.waitstatus_to_exitcode(status)}"
+    return result
+
+
+# Run run(cpu, scenario) for every scenario, each in a fork of emu, at most
+# jobs at a time (all at once by default). The parent machine is left as it
+# was. Returns the CloneResults in scenario order.
+def fork(emu, scenarios, run, jobs=None):
+    scenarios = list(scenarios)
+    jobs = jobs or len(scenarios)
+    virtio = emu.bus.virtio
+    virtio.signal(virtio.drain())
+    results = []
+    running = []
+    for index, scenario in enumerate(scenarios):
+        if len(running) == jobs:
+            results.append(collect(*running.pop(0)))
+        # buffered output would otherwise be written again by every child
+        emu.bus.uart.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            try:
+                child(emu, index, scenario, run, wfd)
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        running.append((pid, rfd, index, scenario))
+    for entry in running:
+        results.append(collect(*entry))
+    return results
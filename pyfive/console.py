@@ -0,0 +1,103 @@
+# The console module holds the backends the uart talks to. A console takes
+# the guest's output in chunks, already buffered by the uart, and may have an
+# input file the plic watches with a selector: the uart reads from it only
+# when it is ready, so no thread waits on stdin and headless runs never open
+# it. Consoles are named on the command line:
+#
+#   stdio            read stdin, write stdout (the terminal)
+#   file:OUT         append output to the file OUT, no input
+#   pipe:IN,OUT      read the named pipe IN, write the named pipe OUT
+#   memory           keep output in memory, input only from push_input
+
+import os
+import sys
+
+READ_SIZE = 4096
+
+
+# No input, output dropped.
+class Console():
+    # the file whose readiness means input, None for none
+    def input(self):
+        return None
+
+    # what input is there, without blocking; b"" at end of input as well
+    def read(self):
+        return b""
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryConsole(Console):
+    # output, a bytearray to append to, e.g. shared by several devices
+    def __init__(self, output=None):
+        self.output = output if output is not None else bytearray()
+
+    def write(self, data):
+        self.output += data
+
+
+# A console on binary streams, either of which may be None. Input is read
+# with os.read, below any buffering, so a read never waits for more than is
+# there.
+class StreamConsole(Console):
+    def __init__(self, infile=None, outfile=None, owned=False):
+        self.infile = infile
+        self.outfile = outfile
+        # close the streams with the console
+        self.owned = owned
+
+    def input(self):
+        return self.infile
+
+    def read(self):
+        if self.infile is None:
+            return b""
+        try:
+            data = os.read(self.infile.fileno(), READ_SIZE)
+        except BlockingIOError:
+            return b""
+        if not data:
+            # end of input: nothing more to watch
+            if self.owned:
+                self.infile.close()
+            self.infile = None
+        return data
+
+    def write(self, data):
+        if self.outfile is not None:
+            self.outfile.write(data)
+            self.outfile.flush()
+
+    def close(self):
+        if self.owned:
+            for f in (self.infile, self.outfile):
+                if f is not None:
+                    f.close()
+        self.infile = self.outfile = None
+
+
+# Open a named pipe without waiting for the other end: with O_RDWR the pipe
+# always has a writer, so reading it never sees an end of input.
+def open_pipe(path, mode):
+    fd = os.open(path, os.O_RDWR | (os.O_NONBLOCK if mode == "rb" else 0))
+    return os.fdopen(fd, mode, buffering=0)
+
+
+def open_console(spec):
+    kind, _, arg = spec.partition(":")
+    match kind:
+        case "stdio":
+            return StreamConsole(sys.stdin.buffer, sys.stdout.buffer)
+        case "memory":
+            return MemoryConsole()
+        case "file" if arg:
+            return StreamConsole(None, open(arg, "ab"), owned=True)
+        case "pipe" if arg.count(",") == 1:
+            infile, outfile = arg.split(",")
+            return StreamConsole(open_pipe(infile, "rb"), open_pipe(outfile, "wb"), owned=True)
+    raise ValueError(f"unknown console {spec!r}: use stdio, memory, file:OUT or pipe:IN,OUT")
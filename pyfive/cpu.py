@@ -1,15 +1,24 @@
 from pyfive import bus
+from pyfive import clone
 from pyfive import trap
+from pyfive import util
 import sys
-import numpy as np
 from enum import Enum
 import logging
 
 from pyfive import uart
 from pyfive import virtio
 from pyfive import plic
+from pyfive import icache
+from pyfive import jit
+from pyfive import predecode
+from pyfive import snapshot
+from pyfive import tlb
 
 
+MASK32 = util.MASK32
+MASK64 = util.MASK64
+
 class MODE(Enum):
     USER = 0b00
     SUPERVISOR = 0b01
@@ -20,6 +29,18 @@ class ACCESSTYPE(Enum):
     LOAD = 1
     STORE = 2
 
+# the fault and the pte permission bit of every kind of access
+PAGE_FAULT = {
+    ACCESSTYPE.INSTRUCTION: trap.EXCEPTION.InstructionPageFault,
+    ACCESSTYPE.LOAD: trap.EXCEPTION.LoadPageFault,
+    ACCESSTYPE.STORE: trap.EXCEPTION.StoreAMOPageFault,
+}
+PERMISSION = {
+    ACCESSTYPE.INSTRUCTION: tlb.PTE_X,
+    ACCESSTYPE.LOAD: tlb.PTE_R,
+    ACCESSTYPE.STORE: tlb.PTE_W,
+}
+
 class CSR(Enum):
     # Machine-level CSRs.
     # Hardware thread ID.
@@ -68,6 +89,13 @@ class CSR(Enum):
     SATP = 0x180
 
 
+# csrs whose writes can make an interrupt deliverable or stop it being so
+INTERRUPT_CSRS = frozenset(csr.value for csr in (CSR.MSTATUS, CSR.SSTATUS, CSR.MIE, CSR.MIP,
+                                                 CSR.SIE, CSR.SIP, CSR.MIDELEG))
+
+# instructions between polls of the devices' host files (console input)
+POLL_INSTS = 10_000
+
 class MIP(Enum):
     SSIP = 1 << 1
     MSIP = 1 << 3
@@ -76,9 +104,23 @@ class MIP(Enum):
     SEIP = 1 << 9
     MEIP = 1 << 11
 
+# machine level interrupts, never delegated to supervisor mode
+M_INTERRUPTS = MIP.MSIP.value | MIP.MTIP.value | MIP.MEIP.value
+# the bits of mip that sip can write, where delegated
+SIP_WRITABLE = MIP.SSIP.value
+# highest priority first
+INTERRUPT_ORDER = (
+    (MIP.MEIP.value, trap.INTERRUPT.MachineExternalInterrupt),
+    (MIP.MSIP.value, trap.INTERRUPT.MachineSoftwareInterrupt),
+    (MIP.MTIP.value, trap.INTERRUPT.MachineTimerInterrupt),
+    (MIP.SEIP.value, trap.INTERRUPT.SupervisorExternalInterrupt),
+    (MIP.SSIP.value, trap.INTERRUPT.SupervisorSoftwareInterrupt),
+    (MIP.STIP.value, trap.INTERRUPT.SupervisorTimerInterrupt),
+)
+
 class XRegisters():
-    def __init__(self):
-        self.xregs = [np.uint64(0)] * 32
+    def __init__(self, stack_top=bus.DRAM_BASE + bus.DRAM_SIZE):
+        self.xregs = [0] * 32
         self._xnames = [
             "zero", "ra", "sp", "gp", "tp", "t0", "t1", "t2",
             "s0", "s1", "a0", "a1", "a2", "a3", "a4", "a5",
@@ -86,7 +128,7 @@ class XRegisters():
             "s8", "s9", "s10", "s11", "t3", "t4", "t5", "t6"
         ]
         # sp
-        self.xregs[2] = np.uint64(bus.DRAM_BASE + bus.DRAM_SIZE)
+        self.xregs[2] = stack_top
 
         # save a0 and a1; arguments from previous boot loader stage
         # li x10, 0
@@ -95,18 +137,15 @@ class XRegisters():
         # self.xregs[10] = 0
         # self.xregs[11] = POINTER_TO_DTB
 
-    def read(self, index: int) -> np.uint64:
+    def read(self, index: int) -> int:
         if index >= 0 and index < 32:
             return self.xregs[index]
         else:
             return None
 
-    def write(self, index: int, value: np.uint64):
-        if not isinstance(value, np.uint64):
-            # print("register value type must be uint64")
-            value = np.uint64(value)
+    def write(self, index: int, value: int):
         if index > 0 and index < 32:
-            self.xregs[index] = value
+            self.xregs[index] = value & MASK64
 
     def dump(self):
         for i in range(len(self.xregs)):
@@ -114,29 +153,31 @@ class XRegisters():
 
 class CSRegisters():
     def __init__(self):
-        self.csrs = [np.uint64(0)] * 4096
+        self.csrs = [0] * 4096
 
-    def read(self, index: int) -> np.uint64:
+    def read(self, index: int) -> int:
         if isinstance(index, CSR):
-            index = int(index.value)
-        match index:
-            case CSR.SIE:
-                return self.csrs[CSR.MIE] & self.csrs[CSR.MIDELEG]
-            case other:
-                return self.csrs[index]
+            index = index.value
+        if index == CSR.SIE.value:
+            return self.csrs[CSR.MIE.value] & self.csrs[CSR.MIDELEG.value]
+        if index == CSR.SIP.value:
+            return self.csrs[CSR.MIP.value] & self.csrs[CSR.MIDELEG.value]
+        return self.csrs[index]
 
-    def write(self, index: int, value: np.uint64):
+    def write(self, index: int, value: int):
         if isinstance(index, CSR):
-            index = int(index.value)
-        if not isinstance(value, np.uint64):
-            # print("register value type must be uint64")
-            value = np.uint64(value)
-        match index:
-            case CSR.SIE.value:
-                self.csrs[CSR.MIE.value] = (self.csrs[CSR.MIE.value] & ~self.csrs[CSR.MIDELEG.value]) |\
-                                 (value & self.csrs[CSR.MIDELEG.value])
-            case other:
-                self.csrs[index] = value
+            index = index.value
+        value &= MASK64
+        if index == CSR.SIE.value:
+            self.csrs[CSR.MIE.value] = (self.csrs[CSR.MIE.value] & ~self.csrs[CSR.MIDELEG.value]) |\
+                                       (value & self.csrs[CSR.MIDELEG.value])
+        elif index == CSR.SIP.value:
+            # a view of mip: only the delegated software interrupt can be set
+            # or cleared through it
+            mask = self.csrs[CSR.MIDELEG.value] & SIP_WRITABLE
+            self.csrs[CSR.MIP.value] = (self.csrs[CSR.MIP.value] & ~mask) | (value & mask)
+        else:
+            self.csrs[index] = value
 
     def dump(self):
         mregs = "mstatus\t{}\t{}\nmtvec\t{}\t{}\nmepc\t{}\t{}\nmcause\t{}\t{}".format(
@@ -155,69 +196,174 @@ class CSRegisters():
 
 class Cpu():
 
-    def __init__(self, obus):
-        self.xreg = XRegisters()
-        self.pc = np.uint64(bus.DRAM_BASE)
+    # trace, a tracer such as trace.Ring, or None for none
+    def __init__(self, obus, jit_enabled=True, trace=None):
+        self.xreg = XRegisters(obus.dram_base + obus.ram.size)
+        self.pc = bus.DRAM_BASE
         self.bus = obus
         self.csrs = CSRegisters()
         self.mode = MODE.MACHINE
         self.enable_paging = False
         self.page_table = 0
+        self.icache = icache.ICache(obus.ram, bus.DRAM_BASE)
+        self.predecoder = predecode.Predecoder(obus.ram, bus.DRAM_BASE, obus.ram.image_size)
+        self.jit_enabled = jit_enabled
+        self.translator = jit.Translator(self, obus.ram, bus.DRAM_BASE)
+        self.tlb = tlb.TLB(obus.ram, bus.DRAM_BASE)
+        self.tlb.listeners.append(self.translator.flush_space)
+        self.plic = obus.plic
+        self.running = False
+        # instructions run so far, the clock of virtual time, and the count
+        # at which to next poll devices or look at the timer
+        self.insts = 0
+        self.poll_at = POLL_INSTS
+        self.next_event = POLL_INSTS
+        self.clint = obus.clint
+        self.clint.attach(self)
+        self.trace = trace
+        if trace is not None:
+            # every instruction on its own through the interpreter, so the
+            # plain step and the jit never look at tracing
+            self.jit_enabled = False
+            self.step = self.step_traced
+            self.handle_trap = self.handle_trap_traced
+            if trace.memory:
+                self.loadint = self.loadint_traced
+                self.loaduint = self.loaduint_traced
+                self.store = self.store_traced
+
+    # csrs are saved sparsely, most of the 4096 are never written
+    def save_state(self):
+        return {
+            "pc": self.pc,
+            "mode": self.mode.name,
+            "xregs": list(self.xreg.xregs),
+            "csrs": {i: v for i, v in enumerate(self.csrs.csrs) if v},
+            "enable_paging": self.enable_paging,
+            "page_table": self.page_table,
+        }
+
+    def load_state(self, state):
+        self.pc = state["pc"]
+        self.mode = MODE[state["mode"]]
+        self.xreg.xregs[:] = state["xregs"]
+        self.csrs.csrs = [0] * 4096
+        for i, v in state["csrs"].items():
+            self.csrs.csrs[int(i)] = v
+        self.update_paging(CSR.SATP.value)
+        self.enable_paging = state["enable_paging"]
+        self.page_table = state["page_table"]
+        self.update_interrupts()
+
+    # with parent, an incremental snapshot (see snapshot.py)
+    def save_snapshot(self, path, parent=None):
+        return snapshot.save(self, path, parent)
+
+    def load_snapshot(self, path):
+        snapshot.load(self, path)
+
+    # run(cpu, scenario) for each scenario in a fork of this machine, see
+    # clone.py
+    def fork(self, scenarios, run, jobs=None):
+        return clone.fork(self, scenarios, run, jobs)
+
+    def fetch_paddr(self, pc):
+        return self.translate(pc, ACCESSTYPE.INSTRUCTION)
 
     def fetch(self):
-        ppc = self.translate(self.pc, ACCESSTYPE.INSTRUCTION)
+        ppc = self.fetch_paddr(self.pc)
         if isinstance(ppc, trap.EXCEPTION):
             return ppc
-        addr = ppc
-        arr = self.bus.load(int(addr), 4)
-        if isinstance(arr, trap.EXCEPTION):
+        inst = self.bus.loaduint(ppc, 4)
+        if isinstance(inst, trap.EXCEPTION):
             return trap.EXCEPTION.InstructionAccessFault
-        return arr[0] | arr[1] << 8 | arr[2] << 16 | arr[3] << 24
+        return inst
 
+    # Like fetch, but returns the decoded form of the instruction, taken from
+    # the decode cache when this physical pc has been executed before.
+    def fetch_decoded(self):
+        ppc = self.fetch_paddr(self.pc)
+        if isinstance(ppc, trap.EXCEPTION):
+            return ppc
+        return self.decode_at(ppc)
 
+    def decode_at(self, ppc):
+        d = self.icache.lookup(ppc)
+        if d is not None:
+            return d
+        fields = self.predecoder.fields_at(ppc)
+        if fields is not None:
+            d = self.decode_fields(fields)
+        else:
+            inst = self.bus.loaduint(ppc, 4)
+            if isinstance(inst, trap.EXCEPTION):
+                return trap.EXCEPTION.InstructionAccessFault
+            d = self.decode(inst)
+        # only dram is watched for writes, so never cache mmio fetches
+        if self.bus.in_dram(ppc, 4):
+            self.icache.insert(ppc, d)
+        return d
 
     def load(self, addr, size):
         paddr = self.translate(addr, ACCESSTYPE.LOAD)
+        if paddr.__class__ is trap.EXCEPTION:
+            return paddr
         return self.bus.load(paddr, size)
 
     def store(self, addr, size, data):
         paddr = self.translate(addr, ACCESSTYPE.STORE)
+        if paddr.__class__ is trap.EXCEPTION:
+            return paddr
         return self.bus.store(paddr, size, data)
 
     def loadint(self, addr, size):
-        arr = self.load(int(addr), size)
-        if isinstance(arr, trap.EXCEPTION):
-            return arr
-        val = arr
-        if isinstance(arr, bytes) or isinstance(arr, bytearray):
-            if len(arr) < size:
-                return trap.EXCEPTION.LoadAccessFault
-            val = int.from_bytes(arr, byteorder='little', signed=True)
-        return np.uint64(val)
-
-    # def sext(self, val, size, bits):
-    #     getbinary = lambda x, n: format(x, 'b').zfill(n)
-    #     val_bit = getbinary(val, size)
-    #     val_bit = val_bit[0] * (bits - size) + val_bit
-    #     return int(val_bit)
+        paddr = self.translate(addr, ACCESSTYPE.LOAD)
+        if paddr.__class__ is trap.EXCEPTION:
+            return paddr
+        return self.bus.loadint(paddr, size)
 
     def loaduint(self, addr, size):
-        arr = self.load(int(addr), size)
-        if isinstance(arr, trap.EXCEPTION):
-            return arr
-        val = arr
-        logging.debug(f"val is {val}")
-        if isinstance(arr, bytes) or isinstance(arr, bytearray):
-            if len(arr) < size:
-                return trap.EXCEPTION.LoadAccessFault
-            val = int.from_bytes(arr, byteorder='little', signed=False)
-        return np.uint64(val)
+        paddr = self.translate(addr, ACCESSTYPE.LOAD)
+        if paddr.__class__ is trap.EXCEPTION:
+            return paddr
+        return self.bus.loaduint(paddr, size)
+
+    # the accessors of a cpu whose tracer records memory accesses, by
+    # virtual address as spike logs them
+    def loadint_traced(self, addr, size):
+        value = Cpu.loadint(self, addr, size)
+        if value.__class__ is not trap.EXCEPTION:
+            self.trace.load(addr, size)
+        return value
+
+    def loaduint_traced(self, addr, size):
+        value = Cpu.loaduint(self, addr, size)
+        if value.__class__ is not trap.EXCEPTION:
+            self.trace.load(addr, size)
+        return value
+
+    def store_traced(self, addr, size, data):
+        ret = Cpu.store(self, addr, size, data)
+        if ret.__class__ is not trap.EXCEPTION:
+            self.trace.store(addr, size, data)
+        return ret
+
+    # side effects of a csr instruction writing csr_addr
+    def csr_written(self, csr_addr):
+        if csr_addr == CSR.SATP.value:
+            self.update_paging(csr_addr)
+        elif csr_addr in INTERRUPT_CSRS:
+            self.update_interrupts()
 
     def update_paging(self, csr_addr):
         if csr_addr != CSR.SATP.value:
             return
-        self.page_table = (self.csrs.read(CSR.SATP) & np.uint64((1 << 44) - 1)) * 4096
-        mode = int(self.csrs.read(CSR.SATP)) >> 60
+        satp = self.csrs.read(CSR.SATP)
+        # tlb entries and translated blocks are kept per address space
+        self.tlb.switch(satp)
+        self.translator.switch(satp)
+        self.page_table = (satp & ((1 << 44) - 1)) * 4096
+        mode = satp >> 60
         if mode == 8:
             self.enable_paging = True
         else:
@@ -226,469 +372,621 @@ class Cpu():
     def translate(self, addr, access_type):
         if not self.enable_paging:
             return addr
-        addr = int(addr)
-        if addr == 0x800080c0:
-            logging.debug(f"translate va {hex(addr)}")
-        levels = 3
-        vpn = [(addr >> 12) & 0x1ff,
-               (addr >> 21) & 0x1ff,
-               (addr >> 30) & 0x1ff]
+        tlb = self.tlb
+        if access_type is ACCESSTYPE.INSTRUCTION:
+            table = tlb.itlb
+            entry = table.get(addr >> 12)
+            if entry is None:
+                tlb.imisses += 1
+            else:
+                tlb.ihits += 1
+        else:
+            table = tlb.dtlb
+            entry = table.get(addr >> 12)
+            if entry is None:
+                tlb.dmisses += 1
+            else:
+                tlb.dhits += 1
+        if entry is None:
+            entry = self.walk(addr, access_type)
+            if isinstance(entry, trap.EXCEPTION):
+                return entry
+            tlb.insert(table, addr >> 12, entry[:2], entry[2])
+        page, perms = entry[0], entry[1]
+        if not perms & PERMISSION[access_type]:
+            return PAGE_FAULT[access_type]
+        return page | (addr & 0xfff)
 
+    # Sv39 page walk. Returns (physical page address, pte permission bits,
+    # addresses of the ptes read) for the page of addr.
+    def walk(self, addr, access_type):
         a = self.page_table
-        # logging.debug(f"pagetable {hex(int(a))}")
-        i = levels - 1
+        ptes = []
+        level = 2
         while True:
-            pte = self.bus.loaduint(a+vpn[i]*8, 8)
-            if addr == 0x800080c0:
-                logging.debug(f"pte address  {hex(int(a+vpn[i]*8))}")
+            pte_addr = a + ((addr >> (12 + 9 * level)) & 0x1ff) * 8
+            pte = self.bus.loaduint(pte_addr, 8)
             if isinstance(pte, trap.EXCEPTION):
                 return pte
-            pte = int(pte)
-            # logging.debug(f"read pte is {hex(pte)}")
-            v = pte & 1
-            r = (pte >> 1) & 1
-            w = (pte >> 2) & 1
-            x = (pte >> 3) & 1
-            if i==0 and (v == 0 or (r == 0 and w == 0)):
-                match access_type:
-                    case ACCESSTYPE.INSTRUCTION:
-                        return trap.EXCEPTION.InstructionPageFault
-                    case ACCESSTPYE.LOAD:
-                        return trap.EXCEPTION.LoadPageFault
-                    case ACCESSTYPE.STORE:
-                        return trap.EXCEPTION.StoreAMOPAageFault
-            if r == 1 or x == 1:
+            ptes.append(pte_addr)
+            # not valid, or writable but not readable
+            if pte & 1 == 0 or pte & 0b110 == 0b100:
+                return PAGE_FAULT[access_type]
+            # a leaf once readable or executable
+            if pte & 0b1010:
                 break
-            i = i - 1
-            ppn = (pte >> 10) & 0x0fff_ffff_ffff
-            a = ppn << 12
-            if i < 0:
-                match access_type:
-                    case ACCESSTYPE.INSTRUCTION:
-                        return trap.EXCEPTION.InstructionPageFault
-                    case ACCESSTYPE.LOAD:
-                        return trap.EXCEPTION.LoadPageFault
-                    case ACCESSTYPE.STORE:
-                        return trap.EXCEPTION.StoreAMOPAageFault
-
-        ppn = [(pte >> 10) & 0x1ff,
-               (pte >> 19) & 0x1ff,
-               (pte >> 28) & 0x03ff_ffff]
-
-        offset = addr & 0xfff
-        logging.debug(f"ppn   i offset {hex(ppn[i])}  {i}  {offset}")
-        ret = 0
-        match i:
-            case 0:
-                ppn = (pte >> 10) & 0x0fff_ffff_ffff
-                ret = (ppn << 12) | offset
-            case 1:
-                ret = ppn[2] << 30 | ppn[1] << 21 | vpn[0] << 12 | offset
-            case 2:
-                ret = ppn[2] << 30 | vpn[1] << 21 | vpn[0] << 12 | offset
-        # logging.debug(f"pa is {hex(ret)}")
-        return ret
+            level -= 1
+            if level < 0:
+                return PAGE_FAULT[access_type]
+            a = ((pte >> 10) & 0x0fff_ffff_ffff) << 12
+        # a superpage passes the low vpn fields of addr straight through
+        mask = (1 << (12 + 9 * level)) - 1
+        ppn = ((pte >> 10) & 0x0fff_ffff_ffff) << 12
+        page = ((ppn & ~mask) | (addr & mask)) & ~0xfff
+        return (page, pte & tlb.PTE_PERMS, ptes)
 
-    def execute(self, inst) -> bool | trap.EXCEPTION:
-        opcode = inst & 0x7f
-        rd = (inst >> 7) & 0x1f
-        rs1 = (inst >> 15) & 0x1f
-        rs2 = (inst >> 20) & 0x1f
-        funct3 = (inst >> 12) & 0x7;
-        funct7 = (inst >> 25) & 0x7f;
+    def decode(self, inst):
+        return self.decode_fields(predecode.decode_word(inst))
+
+    # Turn the extracted fields of an instruction (see predecode.FIELDS) into
+    # a ready-to-run tuple of (handler, rd, rs1, rs2, imm, inst). Immediates
+    # are converted here once, so handlers only do the actual work.
+    def decode_fields(self, fields):
+        inst, opcode, rd, rs1, rs2, funct3, funct7, imm_i, imm_s, imm_b, imm_u, imm_j = fields
 
+        handler = None
+        imm = None
         match opcode:
             case 0x03:  # load
-                imm = np.uint64((np.int32(inst) >> 20))
-                # print("loadinst imm ", hex(imm))
-                # print("loadinst base ", hex(self.xreg.read(rs1)))
-                # print('load inst rs1 ', rs1)
-                addr = int(self.xreg.read(rs1) + imm)
-                # print('load inst addr  ', hex(addr))
-                val = np.uint64(0)
+                imm = imm_i & MASK64
                 match funct3:
                     case 0x0:
-                        # lb, load byte
-                        # x[rd] = sext(M[x[rs1] + sext(offset)][7:0])
-                        val = self.loadint(addr, 1)
-                        # logging.debug(f"lb addr {hex(addr)}")
+                        handler = Cpu.op_lb
                     case 0x1:
-                        # lh, load half word
-                        val = self.loadint(addr, 2)
-                        # logging.debug(f"lh addr {hex(addr)}")
+                        handler = Cpu.op_lh
                     case 0x2:
-                        # lw, load word
-                        val = self.loadint(addr, 4)
-                        # print("load word ", val)
-                        # logging.debug(f"lw addr {hex(addr)}")
+                        handler = Cpu.op_lw
                     case 0x3:
-                        # ld, load double word
-                        val = self.loadint(addr, 8)
-                        # logging.debug(f"ld addr {hex(addr)}")
+                        handler = Cpu.op_ld
                     case 0x4:
-                        # lbu, load byte unsigned
-                        val = self.loaduint(addr, 1)
-                        # logging.debug(f"lbu addr {hex(addr)}")
+                        handler = Cpu.op_lbu
                     case 0x5:
-                        # lhu
-                        val = self.loaduint(addr, 2)
-                        # logging.debug(f"lhu addr {hex(addr)}")
+                        handler = Cpu.op_lhu
                     case 0x6:
-                        # lwu
-                        val = self.loaduint(addr, 4)
-                        # logging.debug(f"lwu addr {hex(addr)}")
-                    case other:
-                        # print("UnSupported load inst: {}, funct3({}) is unknown!".format(hex(inst), hex(funct3)))
-                        return trap.EXCEPTION.IllegalInstruction
-                if isinstance(val, trap.EXCEPTION):
-                    logging.debug(f"wirte {val}, addr {hex(addr)}, funct3 {funct3}")
-                    return val
-                self.xreg.write(rd, val)
+                        handler = Cpu.op_lwu
             case 0x0f:  # fence
                 match funct3:
                     case 0x0:
-                        pass
+                        handler = Cpu.op_fence
                     case other:
                         logging.debug("fence illegal")
-                        return trap.EXCEPTION.IllegalInstruction
             case 0x13:
-                imm = np.uint64(np.int32(inst&0xfff00000)>>20)
-                shamt = (imm & np.uint64(0x3f))
-                value = 0
+                imm = imm_i & MASK64
                 match funct3:
                     case 0x0:
-                        # addi
-                        value = np.uint64(self.xreg.read(rs1) + imm)
-                        # if imm == 0:
-                        #     logging.debug(f'addi imm is {hex(imm)}, rs1 is {hex(self.xreg.read(rs1))} value: {hex(value)}')
+                        handler = Cpu.op_addi
                     case 0x1:
-                        # slli
-                        value = self.xreg.read(rs1) << shamt
+                        handler = Cpu.op_slli
+                        imm = imm & 0x3f
                     case 0x2:
-                        # slti
-                        value = 1 if np.int64(self.xreg.read(rs1)) < np.int64(imm) else 0
+                        handler = Cpu.op_slti
                     case 0x3:
-                        # sltiu
-                        value = 1 if self.xreg.read(rs1) < imm else 0
+                        handler = Cpu.op_sltiu
                     case 0x4:
-                        # xori
-                        value = self.xreg.read(rs1) ^ imm
+                        handler = Cpu.op_xori
                     case 0x5:
                         match funct7 >> 1:
                             case 0x00:
-                                value = self.xreg.read(rs1) >> shamt
+                                handler = Cpu.op_srli
                             case 0x10:
-                                value = int(self.xreg.read(rs1)) >> int(shamt)
-                            case other:
-                                # print("Unsupport inst", hex(inst))
-                                return trap.EXCEPTION.IllegalInstruction
+                                handler = Cpu.op_srai
+                        imm = imm & 0x3f
                     case 0x6:
-                        value = self.xreg.read(rs1) | imm  # ori
+                        handler = Cpu.op_ori
                     case 0x7:
-                        value = self.xreg.read(rs1) & imm  # andi
-                    case other:
-                        print("Unsupport inst", hex(inst))
-                        return trap.EXCEPTION.IllegalInstruction
-                logging.debug(f"wirte {hex(value)}")
-                self.xreg.write(rd, np.uint64(value))
+                        handler = Cpu.op_andi
             case 0x17:  # auipc
-                # print("auipc*************************")
-                imm = np.uint64(np.int32(inst & 0xfffff000))
-                self.xreg.write(rd, self.pc + imm - np.uint64(4))
+                imm = imm_u & MASK64
+                handler = Cpu.op_auipc
             case 0x1b:
-                imm = np.uint64(np.int32(inst&0xfffff000) >> 20)
-                shamt = imm & np.uint64(0x1f)
-                value = np.uint64(0)
+                imm = imm_i & MASK64
                 match funct3:
                     case 0x0:
-                        # addiw
-                        value = (self.xreg.read(rs1) + imm).astype('int32')
+                        handler = Cpu.op_addiw
                     case 0x1:
-                        # slliw
-                        value = (self.xreg.read(rs1) << shamt).astype('int32')
+                        handler = Cpu.op_slliw
+                        imm = imm & 0x1f
                     case 0x5:
                         match funct7:
                             case 0x00:
-                                value = int(self.xreg.read(rs1).astype('uint32')) >> int(shamt)
+                                handler = Cpu.op_srliw
                             case 0x20:
-                                value = int(self.xreg.read(rs1).astype('int32')) >> int(shamt)
-                            case other:
-                                print("Unsupport inst", hex(inst))
-                                return trap.EXCEPTION.IllegalInstruction
-                    case other:
-                        print("Unsupport inst", hex(inst))
-                        return trap.EXCEPTION.IllegalInstruction
-                logging.debug(f"wirte {value}")
-                self.xreg.write(rd, np.uint64(value))
+                                handler = Cpu.op_sraiw
+                        imm = imm & 0x1f
             case 0x23:  # store
-                imm = np.uint64((np.int32(inst & 0xfe000000) >> 20)) |\
-                      np.uint64(((inst >> 7) & 0x1f))
-                # print("imm", np.int64(imm))
-                addr = int(np.uint64(self.xreg.read(rs1)) + imm)
-                # print("addr", hex(addr))
-                # print(rs2, self.xreg.read(rs2))
-                # print(type(self.xreg.read(rs2)))
-                value = np.uint64(self.xreg.read(rs2))
-                vbytes = value.tobytes()
+                imm = imm_s & MASK64
                 match funct3:
                     case 0x0:
-                        self.store(addr, 1, vbytes[0:1])  # sb
+                        handler = Cpu.op_sb
                     case 0x1:
-                        self.store(addr, 2, vbytes[0:2])  # sh
+                        handler = Cpu.op_sh
                     case 0x2:
-                        self.store(addr, 4, vbytes[0:4])  # sw
+                        handler = Cpu.op_sw
                     case 0x3:
-                        self.store(addr, 8, vbytes[0:8])  # sd
-                    case other:
-                        return trap.EXCEPTION.IllegalInstruction
+                        handler = Cpu.op_sd
             case 0x2f:  # rv64a
                 funct5 = (funct7 & 0b1111100) >> 2
                 _aq = (funct7 & 0b0000010) >> 1
                 _rl = funct7 & 0b0000001
                 match (funct3, funct5):
-                    case (0x2, 0x00):  # amoadd.w
-                        t = self.loadint(self.xreg.read(rs1), 4)
-                        value = t + self.xreg.read(rs2)
-                        vbytes = value.tobytes()
-                        self.store(self.xreg.read(rs1), 4, vbytes[0:4])
-                        self.xreg.write(rd, t)
-                    case (0x3, 0x00):  # amoadd.d
-                        t = self.loadint(self.xreg.read(rs1), 8)
-                        value = t + self.xreg.read(rs2)
-                        vbytes = value.tobytes()
-                        self.store(self.xreg.read(rs1), 8, vbytes[0:8])
-                        self.xreg.write(rd, t)
-                    case (0x2, 0x01):  # amoswap.w
-                        t = self.loadint(self.xreg.read(rs1), 4)
-                        value = self.xreg.read(rs2)
-                        vbytes = value.tobytes()
-                        self.store(self.xreg.read(rs1), 4, vbytes[0:4])
-                        self.xreg.write(rd, t)
-                    case (0x3, 0x1):  # amoswap.d
-                        t = self.loadint(self.xreg.read(rs1), 8)
-                        value = self.xreg.read(rs2)
-                        vbytes = value.tobytes()
-                        self.store(self.xreg.read(rs1), 4, vbytes[0:8])
-                        self.xreg.write(rd, t)
-                    case other:
-                        return trap.EXCEPTION.IllegalInstruction
-
+                    case (0x2, 0x00):
+                        handler = Cpu.op_amoadd_w
+                    case (0x3, 0x00):
+                        handler = Cpu.op_amoadd_d
+                    case (0x2, 0x01):
+                        handler = Cpu.op_amoswap_w
+                    case (0x3, 0x1):
+                        handler = Cpu.op_amoswap_d
             case 0x33:  # add
-                shamt = (self.xreg.read(rs2) & np.uint64(0x3f)).astype('uint32')
-                value = 0
                 match (funct3, funct7):
-                    case (0x0, 0x00):  # add
-                        value = self.xreg.read(rs1) + self.xreg.read(rs2)
-                    case (0x0, 0x01):  # mul
-                        value = self.xreg.read(rs1) * self.xreg.read(rs2)
-                    case (0x0, 0x20):  # sub
-                        value = self.xreg.read(rs1) - self.xreg.read(rs2)
-                    case (0x1, 0x00):  # sll
-                        logging.debug(f"sll rs1 {self.xreg.read(rs1)}   shamt {shamt}")
-                        value = self.xreg.read(rs1) << shamt
-                    case (0x2, 0x00):  # slt
-                        logging.debug(f"slt rs1 {self.xreg.read(rs1)}   shamt {shamt}")
-                        cond = np.int64(self.xreg.read(rs1)) < np.int64(self.xreg.read(rs2))
-                        value = 1 if cond else 0
-                    case (0x3, 0x00):  # sltu
-                        cond = self.xreg.read(rs1) < self.xreg.read(rs2)
-                        value = 1 if cond else 0
-                    case (0x4, 0x00):  # xor
-                        value = self.xreg.read(rs1) ^ self.xreg.read(rs2)
-                    case (0x5, 0x00):  # srl
-                        logging.debug(f"srl rs1 {hex(self.xreg.read(rs1))}   shamt {shamt}")
-                        value = self.xreg.read(rs1) >> shamt
-                    case (0x5, 0x20):  # sra
-                        logging.debug(f"sra rs1 {hex(self.xreg.read(rs1))}   shamt {shamt}")
-                        value = np.int64(self.xreg.read(rs1)) >> shamt
-                    case (0x6, 0x00):  # or
-                        value = self.xreg.read(rs1) | self.xreg.read(rs2)
-                        # logging.debug(f"or  {hex(self.xreg.read(rs1))}   {hex(self.xreg.read(rs2))} rd is {hex(rd)}")
-                    case (0x7, 0x00):  # and
-                        value = self.xreg.read(rs1) & self.xreg.read(rs2)
-                    case other:
-                        return trap.EXCEPTION.IllegalInstruction
-                logging.debug(f"wirte {value}")
-                self.xreg.write(rd, np.uint64(value))
+                    case (0x0, 0x00):
+                        handler = Cpu.op_add
+                    case (0x0, 0x01):
+                        handler = Cpu.op_mul
+                    case (0x0, 0x20):
+                        handler = Cpu.op_sub
+                    case (0x1, 0x00):
+                        handler = Cpu.op_sll
+                    case (0x2, 0x00):
+                        handler = Cpu.op_slt
+                    case (0x3, 0x00):
+                        handler = Cpu.op_sltu
+                    case (0x4, 0x00):
+                        handler = Cpu.op_xor
+                    case (0x5, 0x00):
+                        handler = Cpu.op_srl
+                    case (0x5, 0x20):
+                        handler = Cpu.op_sra
+                    case (0x6, 0x00):
+                        handler = Cpu.op_or
+                    case (0x7, 0x00):
+                        handler = Cpu.op_and
             case 0x37:  # lui
-                value = np.uint64(np.int32(inst & 0xfffff000))
-                self.xreg.write(rd, value)
+                imm = imm_u & MASK64
+                handler = Cpu.op_lui
             case 0x3b:
-                shamt = np.uint32(self.xreg.read(rs2) & np.uint64(0x1f))
-                value = 0
                 match (funct3, funct7):
                     case (0x0, 0x00):
-                        # addw
-                        value = np.int32(self.xreg.read(rs1) +  self.xreg.read(rs2))
-                        # print('addw ', value)
+                        handler = Cpu.op_addw
                     case (0x0, 0x20):
-                        # subw
-                        value = np.int32(self.xreg.read(rs1) -  self.xreg.read(rs2))
+                        handler = Cpu.op_subw
                     case (0x1, 0x00):
-                        # sllw
-                        logging.debug(f"sllw rs1 {self.xreg.read(rs1)}   shamt {shamt}")
-                        value = np.uint32(self.xreg.read(rs1)) << shamt
+                        handler = Cpu.op_sllw
                     case (0x5, 0x00):
-                        # srlw
-                        logging.debug(f"srlw rs1 {self.xreg.read(rs1)}   shamt {shamt}")
-                        value = np.uint32(self.xreg.read(rs1)) >> shamt
+                        handler = Cpu.op_srlw
                     case (0x5, 0x01):
-                        # divu
-                        value = 0
-                        match self.xreg.read(rs2):
-                            case 0:
-                                # exception
-                                value = 0xffffffff_ffffffff
-                                pass
-                            case other:
-                                dividend = self.xreg.read(rs1)
-                                divisor = self.xreg.read(rs2)
-                                value = np.uint64(dividend / divisor)
+                        handler = Cpu.op_divuw
                     case (0x5, 0x20):
-                        # sraw
-                        value = np.int32(self.xreg.read(rs1)) >> shamt
+                        handler = Cpu.op_sraw
                     case (0x7, 0x01):
-                        # remuw
-                        value = 0
-                        match self.xreg.read(rs2):
-                            case 0:
-                                value = self.xreg.read(rs1)
-                            case other:
-                                dividend = np.uint32(self.xreg.read(rs1))
-                                divisor = np.uint32(self.xreg.read(rs2))
-                                value = np.uint64(dividend % divisor)
-                    case other:
-                        return trap.EXCEPTION.IllegalInstruction
-                logging.debug(f"wirte {value}")
-                self.xreg.write(rd, np.uint64(value))
+                        handler = Cpu.op_remuw
             case 0x63:
-                imm = (np.int32(inst & 0x80000000) >> 19).astype('uint64') |\
-                      np.uint64(((inst & 0x80) << 4)) |\
-                      np.uint64(((inst >> 20) & 0x7e0)) |\
-                      np.uint64(((inst >> 7) & 0x1e))
-                cond = False
+                imm = imm_b & MASK64
                 match funct3:
                     case 0x0:
-                        # beq
-                        cond = self.xreg.read(rs1) == self.xreg.read(rs2)
+                        handler = Cpu.op_beq
                     case 0x1:
-                        # bne
-                        logging.debug(f"rs1 {self.xreg.read(rs1)}, rs2 {self.xreg.read(rs2)}")
-                        cond = self.xreg.read(rs1) != self.xreg.read(rs2)
+                        handler = Cpu.op_bne
                     case 0x4:
-                        # blt
-                        cond = self.xreg.read(rs1).astype('int64') < self.xreg.read(rs2).astype('int64')
+                        handler = Cpu.op_blt
                     case 0x5:
-                        # bge
-                        cond = self.xreg.read(rs1).astype('int64') >= self.xreg.read(rs2).astype('int64')
+                        handler = Cpu.op_bge
                     case 0x6:
-                        # bltu
-                        cond = self.xreg.read(rs1) < self.xreg.read(rs2)
+                        handler = Cpu.op_bltu
                     case 0x7:
-                        # bgeu
-                        cond = self.xreg.read(rs1) >= self.xreg.read(rs2)
-                    case other:
-                        return trap.EXCEPTION.IllegalInstruction
-                if cond:
-                    self.pc = np.uint64(self.pc + imm - 4)
+                        handler = Cpu.op_bgeu
             case 0x67:
-                # print("jalr inst******************************")
-                temp = self.pc
-                imm = np.uint64(np.int32(inst & 0xfff00000) >> 20)
-                self.pc = (np.uint64(self.xreg.read(rs1)) + imm) & np.uint64(~1)
-                self.xreg.write(rd, temp)
+                imm = imm_i & MASK64
+                handler = Cpu.op_jalr
             case 0x6f:
-                # print("jal inst******************************")
-                self.xreg.write(rd, self.pc)
-                imm = np.uint64(np.int32(inst&0x80000000)>>11) |\
-                      np.uint64((inst & 0xff000)) |\
-                      np.uint64(((inst >> 9) & 0x800)) |\
-                      np.uint64(((inst >> 20) & 0x7fe))
-                self.pc = np.uint64(self.pc) + np.uint64(imm) - np.uint64(4)
+                imm = imm_j & MASK64
+                handler = Cpu.op_jal
             case 0x73:
-                csr_addr = int((inst & 0xfff00000) >> 20)
+                # csr instructions carry the csr address in imm
+                imm = imm_i & 0xfff
                 match funct3:
                     case 0x0:
                         match (rs2, funct7):
-                            case (0x0, 0x0):  # ecall
-                                logging.debug(f"ecall from {self.mode}")
-                                match self.mode:
-                                    case MODE.MACHINE:
-                                        return trap.EXCEPTION.EnvironmentCallFromMMode
-                                    case MODE.SUPERVISOR:
-                                        return trap.EXCEPTION.EnvironmentCallFromSMode
-                                    case MODE.USER:
-                                        return trap.EXCEPTION.EnvironmentCallFromUMode
-                            case (0x1, 0x0):  # ebreak
-                                return trap.EXCEPTION.Breakpoint
-                            case (0x2, 0x8):  # sret
-                                logging.debug(f"sret old pc is {hex(self.pc)}, new pc is {hex(self.csrs.read(CSR.SEPC))}")
-                                self.pc = self.csrs.read(CSR.SEPC)
-                                flag = int(self.csrs.read(CSR.SSTATUS)) >> 8 & 1
-                                self.mode = MODE.SUPERVISOR if flag else MODE.USER
-                                flag = int(self.csrs.read(CSR.SSTATUS)) >> 5 & 1
-                                value = self.csrs.read(CSR.SSTATUS) | np.uint64(1 << 1) if flag else\
-                                        self.csrs.read(CSR.SSTATUS) & np.uint64(~(1 << 1))
-                                self.csrs.write(CSR.SSTATUS, value)
-                                self.csrs.write(CSR.SSTATUS, self.csrs.read(CSR.SSTATUS) | np.uint64((1 << 5)))
-                                self.csrs.write(CSR.SSTATUS, self.csrs.read(CSR.SSTATUS) & np.uint64(~(1 << 8)))
-                            case (0x2, 0x18):  # mret
-                                self.pc = self.csrs.read(CSR.MEPC)
-                                flag = (int(self.csrs.read(CSR.MSTATUS)) >> 11) & 0b11
-                                match flag:
-                                    case 0x2:
-                                        self.mode = MODE.MACHINE
-                                    case 0x1:
-                                        self.mode = MODE.SUPERVISOR
-                                    case other:
-                                        self.mode = MODE.USER
-                                flag = (int(self.csrs.read(CSR.MSTATUS)) >> 7) & 1
-                                value = int(self.csrs.read(CSR.MSTATUS)) | (1 << 3) if flag else\
-                                        int(self.csrs.read(CSR.MSTATUS)) & ~(1 << 3)
-                                self.csrs.write(CSR.MSTATUS, value)
-                                self.csrs.write(CSR.MSTATUS, int(self.csrs.read(CSR.MSTATUS)) | (1 << 7))
-                                self.csrs.write(CSR.MSTATUS, int(self.csrs.read(CSR.MSTATUS)) & ~(0b11 << 11))
-                            case (_, 0x9):  # sfence.vma
-                                pass
-                            case other:
-                                return trap.EXCEPTION.IllegalInstruction
-                    case 0x1:  # csrrw
-                        temp = self.csrs.read(csr_addr)
-                        self.csrs.write(csr_addr, self.xreg.read(rs1))
-                        self.xreg.write(rd, temp)
-                        self.update_paging(csr_addr)
-                    case 0x2:  # csrrs
-                        temp = self.csrs.read(csr_addr)
-                        self.csrs.write(csr_addr, temp | self.xreg.read(rs1))
-                        self.xreg.write(rd, temp)
-                        self.update_paging(csr_addr)
-                    case 0x3:  # csrrc
-                        temp = self.csrs.read(csr_addr)
-                        self.csrs.write(csr_addr, temp & (~self.xreg.read(rs1)))
-                        self.xreg.write(rd, temp)
-                        self.update_paging(csr_addr)
-                    case 0x5:  # csrrwi
-                        imm = np.uint64(rs1)
-                        self.xreg.write(rd, self.csrs.read(csr_addr))
-                        self.csrs.write(csr_addr, imm)
-                        self.update_paging(csr_addr)
-                    case 0x6:  # csrrsi
-                        imm = np.uint64(rs1)
-                        temp = self.csrs.read(csr_addr)
-                        self.csrs.write(csr_addr, imm | temp)
-                        self.xreg.write(rd, temp)
-                        self.update_paging(csr_addr)
-                    case 0x7:  # csrrci
-                        imm = np.uint64(rs1)
-                        temp = self.csrs.read(csr_addr)
-                        self.csrs.write(csr_addr, (~imm) &  temp)
-                        self.xreg.write(rd, temp)
-                        self.update_paging(csr_addr)
-                    case other:
-                        return trap.EXCEPTION.IllegalInstruction
+                            case (0x0, 0x0):
+                                handler = Cpu.op_ecall
+                            case (0x1, 0x0):
+                                handler = Cpu.op_ebreak
+                            case (0x2, 0x8):
+                                handler = Cpu.op_sret
+                            case (0x2, 0x18):
+                                handler = Cpu.op_mret
+                            case (0x5, 0x8):
+                                handler = Cpu.op_wfi
+                            case (_, 0x9):
+                                handler = Cpu.op_sfence_vma
+                    case 0x1:
+                        handler = Cpu.op_csrrw
+                    case 0x2:
+                        handler = Cpu.op_csrrs
+                    case 0x3:
+                        handler = Cpu.op_csrrc
+                    case 0x5:
+                        handler = Cpu.op_csrrwi
+                    case 0x6:
+                        handler = Cpu.op_csrrsi
+                    case 0x7:
+                        handler = Cpu.op_csrrci
+
+        if handler is None:
+            handler = Cpu.op_illegal
+        return (handler, rd, rs1, rs2, imm, inst)
+
+    def execute(self, inst) -> bool | trap.EXCEPTION:
+        d = self.decode(inst)
+        return d[0](self, d[1], d[2], d[3], d[4])
+
+    def op_illegal(self, rd, rs1, rs2, imm):
+        return trap.EXCEPTION.IllegalInstruction
+
+    def load_reg(self, rd, val):
+        if isinstance(val, trap.EXCEPTION):
+            return val
+        self.xreg.write(rd, val)
+        return True
+
+    # a faulting store traps, anything else a device returned is dropped
+    def store_done(self, ret):
+        if ret.__class__ is trap.EXCEPTION:
+            return ret
+        return True
+
+    # lb, load byte
+    # x[rd] = sext(M[x[rs1] + sext(offset)][7:0])
+    def op_lb(self, rd, rs1, rs2, imm):
+        return self.load_reg(rd, self.loadint((self.xreg.read(rs1) + imm) & MASK64, 1))
+
+    # lh, load half word
+    def op_lh(self, rd, rs1, rs2, imm):
+        return self.load_reg(rd, self.loadint((self.xreg.read(rs1) + imm) & MASK64, 2))
+
+    # lw, load word
+    def op_lw(self, rd, rs1, rs2, imm):
+        return self.load_reg(rd, self.loadint((self.xreg.read(rs1) + imm) & MASK64, 4))
+
+    # ld, load double word
+    def op_ld(self, rd, rs1, rs2, imm):
+        return self.load_reg(rd, self.loadint((self.xreg.read(rs1) + imm) & MASK64, 8))
+
+    # lbu, load byte unsigned
+    def op_lbu(self, rd, rs1, rs2, imm):
+        return self.load_reg(rd, self.loaduint((self.xreg.read(rs1) + imm) & MASK64, 1))
+
+    def op_lhu(self, rd, rs1, rs2, imm):
+        return self.load_reg(rd, self.loaduint((self.xreg.read(rs1) + imm) & MASK64, 2))
+
+    def op_lwu(self, rd, rs1, rs2, imm):
+        return self.load_reg(rd, self.loaduint((self.xreg.read(rs1) + imm) & MASK64, 4))
+
+    def op_fence(self, rd, rs1, rs2, imm):
+        return True
+
+    def op_addi(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) + imm)
+        return True
+
+    def op_slli(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) << imm)
+        return True
+
+    def op_slti(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, 1 if util.signed64(self.xreg.read(rs1)) < util.signed64(imm) else 0)
+        return True
+
+    def op_sltiu(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, 1 if self.xreg.read(rs1) < imm else 0)
+        return True
+
+    def op_xori(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) ^ imm)
+        return True
+
+    def op_srli(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) >> imm)
+        return True
+
+    def op_srai(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.signed64(self.xreg.read(rs1)) >> imm)
+        return True
+
+    def op_ori(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) | imm)
+        return True
+
+    def op_andi(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) & imm)
+        return True
+
+    def op_auipc(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.pc + imm - 4)
+        return True
+
+    def op_addiw(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.sext32(self.xreg.read(rs1) + imm))
+        return True
+
+    def op_slliw(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.sext32(self.xreg.read(rs1) << imm))
+        return True
+
+    def op_srliw(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.sext32((self.xreg.read(rs1) & MASK32) >> imm))
+        return True
+
+    def op_sraiw(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.signed32(self.xreg.read(rs1)) >> imm)
+        return True
+
+    def op_sb(self, rd, rs1, rs2, imm):
+        return self.store_done(self.store((self.xreg.read(rs1) + imm) & MASK64, 1, self.xreg.read(rs2)))
+
+    def op_sh(self, rd, rs1, rs2, imm):
+        return self.store_done(self.store((self.xreg.read(rs1) + imm) & MASK64, 2, self.xreg.read(rs2)))
+
+    def op_sw(self, rd, rs1, rs2, imm):
+        return self.store_done(self.store((self.xreg.read(rs1) + imm) & MASK64, 4, self.xreg.read(rs2)))
+
+    def op_sd(self, rd, rs1, rs2, imm):
+        return self.store_done(self.store((self.xreg.read(rs1) + imm) & MASK64, 8, self.xreg.read(rs2)))
+
+    def amo(self, rd, rs1, rs2, size, op):
+        addr = self.xreg.read(rs1)
+        t = self.loadint(addr, size)
+        if isinstance(t, trap.EXCEPTION):
+            return t
+        ret = self.store(addr, size, op(t, self.xreg.read(rs2)))
+        if ret.__class__ is trap.EXCEPTION:
+            return ret
+        self.xreg.write(rd, t)
+        return True
+
+    def op_amoadd_w(self, rd, rs1, rs2, imm):
+        return self.amo(rd, rs1, rs2, 4, lambda t, v: t + v)
+
+    def op_amoadd_d(self, rd, rs1, rs2, imm):
+        return self.amo(rd, rs1, rs2, 8, lambda t, v: t + v)
+
+    def op_amoswap_w(self, rd, rs1, rs2, imm):
+        return self.amo(rd, rs1, rs2, 4, lambda t, v: v)
+
+    def op_amoswap_d(self, rd, rs1, rs2, imm):
+        return self.amo(rd, rs1, rs2, 8, lambda t, v: v)
+
+    def op_add(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) + self.xreg.read(rs2))
+        return True
+
+    def op_mul(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) * self.xreg.read(rs2))
+        return True
+
+    def op_sub(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) - self.xreg.read(rs2))
+        return True
+
+    def op_sll(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) << (self.xreg.read(rs2) & 0x3f))
+        return True
+
+    def op_slt(self, rd, rs1, rs2, imm):
+        cond = util.signed64(self.xreg.read(rs1)) < util.signed64(self.xreg.read(rs2))
+        self.xreg.write(rd, 1 if cond else 0)
+        return True
+
+    def op_sltu(self, rd, rs1, rs2, imm):
+        cond = self.xreg.read(rs1) < self.xreg.read(rs2)
+        self.xreg.write(rd, 1 if cond else 0)
+        return True
+
+    def op_xor(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) ^ self.xreg.read(rs2))
+        return True
+
+    def op_srl(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) >> (self.xreg.read(rs2) & 0x3f))
+        return True
+
+    def op_sra(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.signed64(self.xreg.read(rs1)) >> (self.xreg.read(rs2) & 0x3f))
+        return True
+
+    def op_or(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) | self.xreg.read(rs2))
+        return True
+
+    def op_and(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.xreg.read(rs1) & self.xreg.read(rs2))
+        return True
+
+    def op_lui(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, imm)
+        return True
+
+    def op_addw(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.sext32(self.xreg.read(rs1) + self.xreg.read(rs2)))
+        return True
+
+    def op_subw(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.sext32(self.xreg.read(rs1) - self.xreg.read(rs2)))
+        return True
+
+    def op_sllw(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.sext32(self.xreg.read(rs1) << (self.xreg.read(rs2) & 0x1f)))
+        return True
+
+    def op_srlw(self, rd, rs1, rs2, imm):
+        value = (self.xreg.read(rs1) & MASK32) >> (self.xreg.read(rs2) & 0x1f)
+        self.xreg.write(rd, util.sext32(value))
+        return True
+
+    def op_divuw(self, rd, rs1, rs2, imm):
+        divisor = self.xreg.read(rs2) & MASK32
+        if divisor == 0:
+            # division by zero sets all bits of the result
+            value = MASK64
+        else:
+            value = util.sext32((self.xreg.read(rs1) & MASK32) // divisor)
+        self.xreg.write(rd, value)
+        return True
+
+    def op_sraw(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, util.signed32(self.xreg.read(rs1)) >> (self.xreg.read(rs2) & 0x1f))
+        return True
+
+    def op_remuw(self, rd, rs1, rs2, imm):
+        dividend = self.xreg.read(rs1) & MASK32
+        divisor = self.xreg.read(rs2) & MASK32
+        if divisor == 0:
+            value = util.sext32(dividend)
+        else:
+            value = util.sext32(dividend % divisor)
+        self.xreg.write(rd, value)
+        return True
+
+    def op_beq(self, rd, rs1, rs2, imm):
+        if self.xreg.read(rs1) == self.xreg.read(rs2):
+            self.pc = (self.pc + imm - 4) & MASK64
+        return True
+
+    def op_bne(self, rd, rs1, rs2, imm):
+        if self.xreg.read(rs1) != self.xreg.read(rs2):
+            self.pc = (self.pc + imm - 4) & MASK64
+        return True
+
+    def op_blt(self, rd, rs1, rs2, imm):
+        if util.signed64(self.xreg.read(rs1)) < util.signed64(self.xreg.read(rs2)):
+            self.pc = (self.pc + imm - 4) & MASK64
+        return True
+
+    def op_bge(self, rd, rs1, rs2, imm):
+        if util.signed64(self.xreg.read(rs1)) >= util.signed64(self.xreg.read(rs2)):
+            self.pc = (self.pc + imm - 4) & MASK64
+        return True
+
+    def op_bltu(self, rd, rs1, rs2, imm):
+        if self.xreg.read(rs1) < self.xreg.read(rs2):
+            self.pc = (self.pc + imm - 4) & MASK64
+        return True
+
+    def op_bgeu(self, rd, rs1, rs2, imm):
+        if self.xreg.read(rs1) >= self.xreg.read(rs2):
+            self.pc = (self.pc + imm - 4) & MASK64
+        return True
+
+    def op_jalr(self, rd, rs1, rs2, imm):
+        temp = self.pc
+        self.pc = ((self.xreg.read(rs1) + imm) & MASK64) & ~1
+        self.xreg.write(rd, temp)
+        return True
+
+    def op_jal(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.pc)
+        self.pc = (self.pc + imm - 4) & MASK64
+        return True
+
+    def op_ecall(self, rd, rs1, rs2, imm):
+        match self.mode:
+            case MODE.MACHINE:
+                return trap.EXCEPTION.EnvironmentCallFromMMode
+            case MODE.SUPERVISOR:
+                return trap.EXCEPTION.EnvironmentCallFromSMode
+            case MODE.USER:
+                return trap.EXCEPTION.EnvironmentCallFromUMode
+
+    def op_ebreak(self, rd, rs1, rs2, imm):
+        return trap.EXCEPTION.Breakpoint
+
+    def op_sret(self, rd, rs1, rs2, imm):
+        self.pc = self.csrs.read(CSR.SEPC)
+        sstatus = self.csrs.read(CSR.SSTATUS)
+        self.mode = MODE.SUPERVISOR if (sstatus >> 8) & 1 else MODE.USER
+        # SIE = SPIE, SPIE = 1, SPP = 0
+        sstatus = sstatus | (1 << 1) if (sstatus >> 5) & 1 else sstatus & ~(1 << 1)
+        sstatus = (sstatus | (1 << 5)) & ~(1 << 8)
+        self.csrs.write(CSR.SSTATUS, sstatus)
+        self.update_interrupts()
+        return True
+
+    def op_mret(self, rd, rs1, rs2, imm):
+        self.pc = self.csrs.read(CSR.MEPC)
+        mstatus = self.csrs.read(CSR.MSTATUS)
+        match (mstatus >> 11) & 0b11:
+            case 0x2:
+                self.mode = MODE.MACHINE
+            case 0x1:
+                self.mode = MODE.SUPERVISOR
             case other:
-                # print("UnSupported inst", hex(inst))
-                return trap.EXCEPTION.IllegalInstruction
+                self.mode = MODE.USER
+        # MIE = MPIE, MPIE = 1, MPP = 0
+        mstatus = mstatus | (1 << 3) if (mstatus >> 7) & 1 else mstatus & ~(1 << 3)
+        mstatus = (mstatus | (1 << 7)) & ~(0b11 << 11)
+        self.csrs.write(CSR.MSTATUS, mstatus)
+        self.update_interrupts()
+        return True
+
+    def op_wfi(self, rd, rs1, rs2, imm):
+        self.idle()
+        return True
+
+    # The tlb follows writes to page tables by itself (see tlb.py), so there
+    # are no stale translations or blocks to drop here.
+    def op_sfence_vma(self, rd, rs1, rs2, imm):
+        return True
+
+    def op_csrrw(self, rd, rs1, rs2, imm):
+        temp = self.csrs.read(imm)
+        self.csrs.write(imm, self.xreg.read(rs1))
+        self.xreg.write(rd, temp)
+        self.csr_written(imm)
+        return True
+
+    def op_csrrs(self, rd, rs1, rs2, imm):
+        temp = self.csrs.read(imm)
+        self.csrs.write(imm, temp | self.xreg.read(rs1))
+        self.xreg.write(rd, temp)
+        self.csr_written(imm)
+        return True
+
+    def op_csrrc(self, rd, rs1, rs2, imm):
+        temp = self.csrs.read(imm)
+        self.csrs.write(imm, temp & ~self.xreg.read(rs1))
+        self.xreg.write(rd, temp)
+        self.csr_written(imm)
+        return True
+
+    # for the immediate csr forms the 5-bit immediate sits in the rs1 field
+    def op_csrrwi(self, rd, rs1, rs2, imm):
+        self.xreg.write(rd, self.csrs.read(imm))
+        self.csrs.write(imm, rs1)
+        self.csr_written(imm)
+        return True
+
+    def op_csrrsi(self, rd, rs1, rs2, imm):
+        temp = self.csrs.read(imm)
+        self.csrs.write(imm, rs1 | temp)
+        self.xreg.write(rd, temp)
+        self.csr_written(imm)
+        return True
+
+    def op_csrrci(self, rd, rs1, rs2, imm):
+        temp = self.csrs.read(imm)
+        self.csrs.write(imm, ~rs1 & temp)
+        self.xreg.write(rd, temp)
+        self.csr_written(imm)
         return True
 
     def dump_regs(self):
@@ -696,77 +994,82 @@ class Cpu():
         print("machine mode:", self.mode)
         self.xreg.dump()
         self.csrs.dump()
+        print("tlb:", " ".join(f"{k}={v}" for k, v in self.tlb.stats().items()))
+        if self.trace is not None:
+            self.trace.dump()
+
+    # recorded before it is taken: an unhandled exception ends the run in
+    # handle_trap, dumping the trace
+    def handle_trap_traced(self, e, offset, intr = False):
+        cause = (1 << 63) | e.value if intr else e.value
+        self.trace.trap((self.pc + offset) & MASK64, cause, self.mode.value)
+        Cpu.handle_trap(self, e, offset, intr)
 
     def handle_trap(self, e, offset, intr = False):
-        exception_pc = self.pc + np.uint64(offset)
+        exception_pc = (self.pc + offset) & MASK64
         previous_mode = self.mode
         cause = e.value
-        medeleg = self.csrs.read(CSR.MEDELEG)
         if intr:
             cause = (1 << 63) | cause
-        if (previous_mode.value <= MODE.SUPERVISOR.value) and (int(medeleg) >> int(np.uint32(cause))) & 1 != 0:
-            logging.debug("handle trap in supervisor")
+            # interrupts go by mideleg, and machine level ones stay in m-mode
+            deleg = self.csrs.read(CSR.MIDELEG) & ~M_INTERRUPTS
+        else:
+            deleg = self.csrs.read(CSR.MEDELEG)
+        if (previous_mode.value <= MODE.SUPERVISOR.value) and (deleg >> e.value) & 1 != 0:
             # handle trap in s-mode
             self.mode = MODE.SUPERVISOR
 
             # Set the program counter to the supervisor trap-handler base address (stvec).
-            if intr:
-                stvec = self.csrs.read(CSR.STVEC) & np.uint64(1)
-                vector = 4 * cause if stvec else 0
-                self.pc = self.csrs.read(CSR.STVEC) & np.uint64(~1) + np.uint64(vector)
+            stvec = self.csrs.read(CSR.STVEC)
+            if intr and stvec & 1:
+                self.pc = (stvec & ~1) + 4 * e.value
             else:
-                self.pc = self.csrs.read(CSR.STVEC) & np.uint64(~1)
+                self.pc = stvec & ~1
 
-            self.csrs.write(CSR.SEPC, exception_pc & np.uint64(~1))
+            self.csrs.write(CSR.SEPC, exception_pc & ~1)
             self.csrs.write(CSR.SCAUSE, cause)
             self.csrs.write(CSR.STVAL, 0)
 
+            sstatus = self.csrs.read(CSR.SSTATUS)
             # Set a previous interrupt-enable bit for supervisor mode (SPIE, 5) to the value
             # of a global interrupt-enable bit for supervisor mode (SIE, 1).
-            value = 0
-            if (int(self.csrs.read(CSR.SSTATUS)) >> 1) & 1 == 1:
-                value = self.csrs.read(CSR.SSTATUS) | np.uint64((1 << 5))
+            if (sstatus >> 1) & 1 == 1:
+                sstatus |= 1 << 5
             else:
-                value = self.csrs.read(CSR.SSTATUS) & ~np.uint64(1 << 5)
-            self.csrs.write(CSR.SSTATUS, value)
+                sstatus &= ~(1 << 5)
             # Set a global interrupt-enable bit for supervisor mode (SIE, 1) to 0.
-            value = self.csrs.read(CSR.SSTATUS) & ~np.uint64((1 << 1))
-            self.csrs.write(CSR.SSTATUS, value)
+            sstatus &= ~(1 << 1)
             # 4.1.1 Supervisor Status Register (sstatus)
             # "When a trap is taken, SPP is set to 0 if the trap originated from user mode, or
             # 1 otherwise."
-            value = self.csrs.read(CSR.SSTATUS) & ~np.uint64((1 << 8))
+            sstatus &= ~(1 << 8)
             if previous_mode == MODE.SUPERVISOR:
-                value = self.csrs.read(CSR.SSTATUS) | np.uint64(1 << 8)
-            self.csrs.write(CSR.SSTATUS, value)
+                sstatus |= 1 << 8
+            self.csrs.write(CSR.SSTATUS, sstatus)
         else:
-            logging.debug("handle trap in machine")
             # handle trap in machine mode
             self.mode = MODE.MACHINE
 
             # Set the program counter to the machine trap-handler base address (mtvec).
-            if intr:
-                stvec = self.csrs.read(CSR.MTVEC) & np.uint64(1)
-                vector = 4 * cause if stvec else 0
-                self.pc = (self.csrs.read(CSR.MTVEC) & np.uint64(~1)) + vector
-            else:
-                self.pc = (self.csrs.read(CSR.MTVEC) & np.uint64(~1))
-
-            self.pc = self.csrs.read(CSR.MTVEC) & ~np.uint64(1)
-            self.csrs.write(CSR.MEPC, exception_pc & ~np.uint64(1))
+            self.pc = self.csrs.read(CSR.MTVEC) & ~1
+            self.csrs.write(CSR.MEPC, exception_pc & ~1)
             self.csrs.write(CSR.MCAUSE, cause)
             self.csrs.write(CSR.MTVAL, 0)
 
+            mstatus = self.csrs.read(CSR.MSTATUS)
             #  Set a previous interrupt-enable bit for supervisor mode (MPIE, 7) to the value
             #  of a global interrupt-enable bit for supervisor mode (MIE, 3).
-            value = self.csrs.read(CSR.MSTATUS) | np.uint64(1 << 7)
-            if (int(self.csrs.read(CSR.MSTATUS)) >> 3 & 1) == 0:
-                value = self.csrs.read(CSR.MSTATUS) & ~np.uint64(1 << 7)
-            self.csrs.write(CSR.MSTATUS, value)
+            if (mstatus >> 3) & 1 == 0:
+                mstatus &= ~(1 << 7)
+            else:
+                mstatus |= 1 << 7
             # Set a global interrupt-enable bit for supervisor mode (MIE, 3) to 0.
-            self.csrs.write(CSR.MSTATUS, self.csrs.read(CSR.MSTATUS) & ~np.uint64(1 << 3))
-            # Set a previous privilege mode for supervisor mode (MPP, 11..13) to 0.
-            self.csrs.write(CSR.MSTATUS, self.csrs.read(CSR.MSTATUS) & ~np.uint64(0b11 << 11))
+            mstatus &= ~(1 << 3)
+            # Set the previous privilege mode (MPP, 11..12) to the mode the
+            # trap came from, where mret returns to.
+            mstatus = (mstatus & ~(0b11 << 11)) | (previous_mode.value << 11)
+            self.csrs.write(CSR.MSTATUS, mstatus)
+        self.update_interrupts()
         abort_e = [
                       trap.EXCEPTION.InstructionAddressMisaligned,
                       trap.EXCEPTION.InstructionAccessFault,
@@ -781,67 +1084,190 @@ class Cpu():
             self.dump_regs()
             sys.exit(0)
 
-    def handle_intr(self):
+    # Whether taking an interrupt is possible right now, into
+    # plic.deliverable: a pending interrupt (an external line that is up
+    # counts as SEIP) enabled in mie and for the current mode, or a device
+    # waiting to be served.
+    def update_interrupts(self):
+        plic = self.plic
+        plic.deliverable = bool(plic.service) or bool(self.takeable_interrupts())
+        # a worker thread may have queued a device between reading service
+        # and clearing the flag: look again so its request is not lost
+        if plic.service:
+            plic.deliverable = True
+
+    # The pending and enabled interrupts the hart may take in its current
+    # mode, as mip bits. An interrupt is handled in s-mode if mideleg says
+    # so (never the machine level ones) and in m-mode otherwise; it is
+    # globally enabled below the mode that handles it, and in that mode by
+    # its xIE bit. An external line that is up counts as SEIP.
+    def takeable_interrupts(self):
+        plic = self.plic
+        csrs = self.csrs.csrs
+        mip = csrs[CSR.MIP.value]
+        if plic.lines & ~plic.claimed:
+            mip |= MIP.SEIP.value
+        pending = csrs[CSR.MIE.value] & mip
+        if not pending:
+            return 0
+        deleg = csrs[CSR.MIDELEG.value] & ~M_INTERRUPTS
         match self.mode:
             case MODE.MACHINE:
-                if (int(self.csrs.read(CSR.MSTATUS)) >> 3) & 1 == 0:
-                    return
+                return pending & ~deleg if csrs[CSR.MSTATUS.value] >> 3 & 1 else 0
             case MODE.SUPERVISOR:
-                if (int(self.csrs.read(CSR.SSTATUS)) >> 1) & 1 == 0:
-                    return
-        irq = 0
-        if self.bus.uart.is_interrupting():
-            irq = uart.UART.IRQ.value
-        elif self.bus.virtio.is_interrupting():
-            self.bus.virtio.disk_access()
-            irq = virtio.VIRTIO.IRQ.value
-
-        if irq:
-            logging.debug(f"handle irq {irq}")
-            self.bus.plic.store(plic.PLIC.SCLAIM.value, 4, irq)
-            self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) | np.uint64(MIP.SEIP.value))
-
-        pending = int(self.csrs.read(CSR.MIE) & self.csrs.read(CSR.MIP))
+                return pending if csrs[CSR.SSTATUS.value] >> 1 & 1 else pending & ~deleg
+            case other:
+                return pending
+
+    def reschedule(self):
+        self.next_event = min(self.poll_at, self.clint.deadline)
+
+    # next_event was reached: poll the devices' host files and the uart if
+    # it is time to, and have the clint look at the timer
+    def events(self):
+        if self.insts >= self.poll_at:
+            self.poll_at = self.insts + POLL_INSTS
+            self.plic.wait(0)
+            self.bus.uart.poll()
+        self.clint.schedule()
+
+    # wfi, or a block the jit found spinning (see jit.py): nothing changes
+    # until an interrupt is pending or a device wants service, so unless one
+    # already is, let time pass up to the next event instead of running.
+    def idle(self):
+        plic = self.plic
+        csrs = self.csrs.csrs
+        mip = csrs[CSR.MIP.value]
+        if plic.lines & ~plic.claimed:
+            mip |= MIP.SEIP.value
+        if plic.service or csrs[CSR.MIE.value] & mip:
+            if plic.service:
+                plic.deliverable = True
+            return
+        self.bus.uart.flush()
+        self.clint.idle(plic.wait)
+
+    # The slow path, taken only while plic.deliverable is set: serve devices,
+    # hand an external interrupt to the hart and take the highest priority
+    # interrupt that is pending and enabled.
+    def handle_intr(self):
+        self.plic.serve()
+        takeable = self.takeable_interrupts()
+        if not takeable:
+            self.update_interrupts()
+            return
+        if takeable & MIP.SEIP.value:
+            irq = self.plic.next_irq()
+            if irq:
+                self.plic.claim(irq)
+                self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) | MIP.SEIP.value)
 
         e = None
-        if pending & MIP.MEIP.value != 0:
-            self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) & np.uint64(~MIP.MEIP.value))
-            e = trap.INTERRUPT.MachineExternelInterrupt
-        elif pending & MIP.MSIP.value != 0:
-            self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) & np.uint64(~MIP.MSIP.value))
-            e = trap.INTERRUPT.SoftwareInterrupt
-        elif pending & MIP.MTIP.value != 0:
-            self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) & np.uint64(~MIP.MTIP.value))
-            e = trap.INTERRUPT.MachineTimerInterrupt
-        elif pending & MIP.SEIP.value != 0:
-            self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) & np.uint64(~MIP.SEIP.value))
-            e = trap.INTERRUPT.SupervisorExternalInterrupt
-        elif pending & MIP.SSIP.value != 0:
-            self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) & np.uint64(~MIP.SSIP.value))
-            e = trap.INTERRUPT.SupervisorSoftwareInterrupt
-        elif pending & MIP.STIP.value != 0:
-            self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) & np.uint64(~MIP.STIP.value))
-            e = trap.INTERRUPT.SupervisorTimerInterrupt
+        for bit, interrupt in INTERRUPT_ORDER:
+            if takeable & bit:
+                # MTIP stays up until the guest moves mtimecmp
+                if bit != MIP.MTIP.value:
+                    self.csrs.write(CSR.MIP, self.csrs.read(CSR.MIP) & ~bit)
+                e = interrupt
+                break
 
+        # taken between instructions: pc is where the guest resumes
         if e:
-            return self.handle_trap(e, -4, True)
+            return self.handle_trap(e, 0, True)
+        self.update_interrupts()
 
-    def run(self):
-        while True:
+    def step(self):
+        self.insts += 1
+        d = self.fetch_decoded()
+        if isinstance(d, trap.EXCEPTION):
+            self.handle_trap(d, 0)
+        else:
+            self.pc += 4
+            ret = d[0](self, d[1], d[2], d[3], d[4])
+            if isinstance(ret, trap.EXCEPTION):
+                self.handle_trap(ret, -4)
 
-             inst = self.fetch()
-             ret = True
-             if isinstance(inst, trap.EXCEPTION):
-                 logging.debug(inst)
-                 self.handle_trap(inst, 0)
-             else:
-                 logging.debug(f"pc {hex(self.pc)} {hex(inst)}")
+        if self.insts >= self.next_event:
+            self.events()
+        if self.plic.deliverable:
+            self.handle_intr()
 
-             self.pc += np.uint64(4)
-             ret = self.execute(inst)
+    # step with every retired instruction handed to the tracer, bound in
+    # place of step when the cpu has one
+    def step_traced(self):
+        self.insts += 1
+        d = self.fetch_decoded()
+        if isinstance(d, trap.EXCEPTION):
+            self.handle_trap(d, 0)
+        else:
+            pc = self.pc
+            mode = self.mode.value
+            self.pc += 4
+            ret = d[0](self, d[1], d[2], d[3], d[4])
+            if isinstance(ret, trap.EXCEPTION):
+                self.handle_trap(ret, -4)
+            else:
+                self.trace.retire(pc, d[5], d[1], self.xreg.xregs[d[1]], mode)
 
-             if isinstance(ret, trap.EXCEPTION):
-                 logging.debug(f"exception inst {hex(inst)}")
-                 self.handle_trap(ret, -4)
+        if self.insts >= self.next_event:
+            self.events()
+        if self.plic.deliverable:
+            self.handle_intr()
+
+    # Run one translated block, or a single interpreted instruction when pc is
+    # outside dram. Returns the block that ran so the next call can follow its
+    # direct link instead of looking pc up again.
+    def step_block(self, prev=None):
+        blk = self.translator.next_block(prev, self.pc)
+        if blk is None:
+            self.step()
+            return None
+        if isinstance(blk, trap.EXCEPTION):
+            self.insts += 1
+            self.handle_trap(blk, 0)
+            if self.plic.deliverable:
+                self.handle_intr()
+            return None
+        # a block that traps half way counts in full: time only needs to be
+        # the same from one run to the next
+        self.insts += blk.ninsts
+        ret = blk.fn(self, blk)
+        if ret is not True:
+            if ret is jit.IDLE:
+                self.idle()
+            else:
+                self.handle_trap(ret, -4)
+                blk = None
+        if self.insts >= self.next_event:
+            self.events()
+        if self.plic.deliverable:
+            self.handle_intr()
+        return blk
+
+    # Run until stop() is called, e.g. by a device hook, or for about
+    # max_insts instructions; with the jit the limit is checked between
+    # blocks, so a run may go a block past it. Returns the count executed
+    # when there is a limit.
+    def run(self, max_insts=None):
+        self.running = True
+        if max_insts is None:
+            if not self.jit_enabled:
+                while self.running:
+                    self.step()
+                return None
+            blk = None
+            while self.running:
+                blk = self.step_block(blk)
+            return None
+        start = self.insts
+        if not self.jit_enabled:
+            while self.running and self.insts - start < max_insts:
+                self.step()
+            return self.insts - start
+        blk = None
+        while self.running and self.insts - start < max_insts:
+            blk = self.step_block(blk)
+        return self.insts - start
 
-             self.handle_intr()
+    def stop(self):
+        self.running = False
@@ -0,0 +1,259 @@
+# The disk module holds the backing store of the virtio block device. A disk
+# image is mapped into memory with mmap, so it can be any size, a request is
+# a slice copy between the mapping and guest dram, and writes end up in the
+# image file itself (flush forces them out). Without an image the disk is an
+# anonymous mapping of DEFAULT_SIZE bytes that is gone at exit.
+#
+# An Overlay leaves its base image untouched instead: the base is mapped
+# read-only, so every emulator running from the same image shares its pages
+# in the host page cache, and a guest write copies the block it lands in
+# into a per-instance delta first. The delta is a sparse file (or an
+# anonymous mapping) laid out as a header page, a bitmap of the blocks it
+# holds and then the blocks themselves at their offset in the image, so it
+# only costs host disk and memory for blocks actually written. On close the
+# delta is discarded, kept for the next run, or committed into the base.
+# The base can also be another disk object, e.g. to give a forked machine a
+# private layer over its parent's disk.
+
+import logging
+import mmap
+import os
+import struct
+import threading
+
+SECTOR_SIZE = 512
+DEFAULT_SIZE = 0x40_0000
+
+
+class Disk():
+    def __init__(self, path=None, size=DEFAULT_SIZE):
+        self.path = path
+        self.file = None
+        self.writable = False
+        if path is None:
+            self.map = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE)
+            self.size = size
+            return
+        try:
+            self.file = open(path, "r+b")
+            access = mmap.ACCESS_WRITE
+            self.writable = True
+        except PermissionError:
+            logging.warning(f"{path} is read-only, disk writes will not be saved")
+            self.file = open(path, "rb")
+            access = mmap.ACCESS_COPY
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size == 0:
+            raise ValueError(f"disk image {path} is empty")
+        self.map = mmap.mmap(self.file.fileno(), self.size, access=access)
+
+    def in_range(self, offset, size):
+        return 0 <= offset and offset + size <= self.size
+
+    # a zero-copy window into the disk
+    def view(self, offset, size):
+        return memoryview(self.map)[offset:offset + size]
+
+    def read(self, offset, size):
+        return self.map[offset:offset + size]
+
+    def write(self, offset, data):
+        self.map[offset:offset + len(data)] = data
+
+    # Copy between the disk and a writable buffer (a dram view). A writable
+    # image file goes through pread/pwrite, which drop the GIL, so async
+    # virtio workers overlap with the cpu; both stay coherent with the
+    # shared mapping.
+    def read_into(self, offset, buf):
+        if self.writable:
+            while len(buf):
+                n = os.preadv(self.file.fileno(), [buf], offset)
+                if n <= 0:
+                    raise OSError(f"short read from {self.path}")
+                buf, offset = buf[n:], offset + n
+        else:
+            buf[:] = memoryview(self.map)[offset:offset + len(buf)]
+
+    def write_from(self, offset, buf):
+        if self.writable:
+            while len(buf):
+                n = os.pwritev(self.file.fileno(), [buf], offset)
+                buf, offset = buf[n:], offset + n
+        else:
+            self.map[offset:offset + len(buf)] = buf
+
+    def flush(self):
+        if self.writable and not self.map.closed:
+            self.map.flush()
+
+    def close(self):
+        self.flush()
+        if not self.map.closed:
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+
+
+OVERLAY_MAGIC = b"PYFIVEOV"
+OVERLAY_VERSION = 1
+OVERLAY_BLOCK = 4096
+OVERLAY_MODES = ("discard", "keep", "commit")
+# magic, version, block size, base size, base mtime in ns
+OVERLAY_HEADER = struct.Struct('<8sB3xIQQ')
+
+
+class Overlay():
+    # base is an image path, or a disk object to lay over
+    def __init__(self, base, path=None, mode="discard"):
+        if mode not in OVERLAY_MODES:
+            raise ValueError(f"unknown overlay mode {mode!r}")
+        if mode == "keep" and path is None:
+            raise ValueError("keeping an overlay needs a delta file")
+        self.path = path
+        self.mode = mode
+        self.lower = None
+        self.base_path = None
+        self.base_view = None
+        if isinstance(base, (str, os.PathLike)):
+            self.base_path = base
+            self.base_file = open(base, "rb")
+            stat = os.fstat(self.base_file.fileno())
+            self.size = stat.st_size
+            if self.size == 0:
+                raise ValueError(f"disk image {base} is empty")
+            self.base = mmap.mmap(self.base_file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.base_view = memoryview(self.base)
+            mtime = stat.st_mtime_ns
+        else:
+            self.lower = base
+            self.size = base.size
+            mtime = 0
+        self.nblocks = (self.size + OVERLAY_BLOCK - 1) // OVERLAY_BLOCK
+        bitmap_size = ((self.nblocks + 7) // 8 + OVERLAY_BLOCK - 1) // OVERLAY_BLOCK * OVERLAY_BLOCK
+        self.data_offset = OVERLAY_BLOCK + bitmap_size
+        length = self.data_offset + self.nblocks * OVERLAY_BLOCK
+        header = OVERLAY_HEADER.pack(OVERLAY_MAGIC, OVERLAY_VERSION, OVERLAY_BLOCK, self.size, mtime)
+        self.file = None
+        # only a delta file this overlay made is removed on close: one kept
+        # by an earlier run is read, and in discard mode left as it was
+        self.created = False
+        if path is None:
+            self.map = mmap.mmap(-1, length, flags=mmap.MAP_PRIVATE)
+            self.map[:len(header)] = header
+        elif os.path.exists(path) and os.path.getsize(path):
+            self.file = open(path, "rb" if mode == "discard" else "r+b")
+            if self.file.read(len(header)) != header or os.path.getsize(path) != length:
+                self.file.close()
+                raise ValueError(f"overlay {path} does not belong to {base} as it is now")
+            if mode == "discard":
+                # this run's writes stay in private memory
+                self.map = mmap.mmap(self.file.fileno(), length, access=mmap.ACCESS_COPY)
+            else:
+                self.map = mmap.mmap(self.file.fileno(), length)
+        else:
+            self.created = True
+            self.file = open(path, "w+b")
+            self.file.truncate(length)
+            self.file.write(header)
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), length)
+        # blocks held by the delta, mirrored in the bitmap
+        self.dirty = set()
+        for index, byte in enumerate(self.map[OVERLAY_BLOCK:self.data_offset]):
+            for bit in range(8):
+                if byte >> bit & 1:
+                    self.dirty.add(8 * index + bit)
+        self.delta_view = memoryview(self.map)
+        # async virtio workers may write different sectors of one block
+        self.lock = threading.Lock()
+
+    def in_range(self, offset, size):
+        return 0 <= offset and offset + size <= self.size
+
+    # the pieces of [offset, offset + size) that fall in each block, as
+    # (block, offset, length, position in the request)
+    def pieces(self, offset, size):
+        pos = 0
+        while pos < size:
+            block, within = divmod(offset + pos, OVERLAY_BLOCK)
+            length = min(OVERLAY_BLOCK - within, size - pos)
+            yield block, offset + pos, length, pos
+            pos += length
+
+    def read_into(self, offset, buf):
+        for block, start, length, pos in self.pieces(offset, len(buf)):
+            if block in self.dirty:
+                src = self.data_offset + start
+                buf[pos:pos + length] = self.delta_view[src:src + length]
+            else:
+                self.read_base(start, buf[pos:pos + length])
+
+    def read_base(self, offset, buf):
+        if self.lower is not None:
+            self.lower.read_into(offset, buf)
+        else:
+            buf[:] = self.base_view[offset:offset + len(buf)]
+
+    def write_from(self, offset, buf):
+        with self.lock:
+            for block, start, length, pos in self.pieces(offset, len(buf)):
+                if block not in self.dirty:
+                    self.copy_up(block)
+                dst = self.data_offset + start
+                self.delta_view[dst:dst + length] = buf[pos:pos + length]
+
+    # bring a block of the base into the delta before its first write
+    def copy_up(self, block):
+        start = block * OVERLAY_BLOCK
+        end = min(start + OVERLAY_BLOCK, self.size)
+        self.read_base(start, self.delta_view[self.data_offset + start:self.data_offset + end])
+        self.map[OVERLAY_BLOCK + block // 8] |= 1 << block % 8
+        self.dirty.add(block)
+
+    def read(self, offset, size):
+        buf = bytearray(size)
+        self.read_into(offset, memoryview(buf))
+        return bytes(buf)
+
+    def write(self, offset, data):
+        self.write_from(offset, memoryview(data))
+
+    def flush(self):
+        if self.file is not None and not self.map.closed:
+            self.map.flush()
+
+    # write the blocks of the delta back into the base
+    def commit(self):
+        if self.lower is not None:
+            for block in sorted(self.dirty):
+                start = block * OVERLAY_BLOCK
+                end = min(start + OVERLAY_BLOCK, self.size)
+                self.lower.write_from(start, self.delta_view[self.data_offset + start:self.data_offset + end])
+            return
+        with open(self.base_path, "r+b") as base:
+            for block in sorted(self.dirty):
+                start = block * OVERLAY_BLOCK
+                end = min(start + OVERLAY_BLOCK, self.size)
+                os.pwrite(base.fileno(), self.delta_view[self.data_offset + start:self.data_offset + end],
+                          start)
+            os.fsync(base.fileno())
+        logging.info(f"committed {len(self.dirty)} overlay blocks to {self.base_path}")
+
+    # a disk object underneath is left open, it belongs to the caller
+    def close(self):
+        if self.map.closed:
+            return
+        if self.mode == "commit":
+            self.commit()
+        elif self.mode == "keep":
+            self.flush()
+        self.delta_view.release()
+        self.map.close()
+        if self.lower is None:
+            self.base_view.release()
+            self.base.close()
+            self.base_file.close()
+        if self.file is not None:
+            self.file.close()
+            if self.created and self.mode != "keep":
+                os.remove(self.path)
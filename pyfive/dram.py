@@ -1,28 +1,254 @@
-import logging
-import numpy as np
+import array
+import ctypes
+import mmap
+import os
+import struct
 
+PAGE_SHIFT = 12
+# pagemap entry bits: page present in memory, page swapped out
+PAGEMAP_PRESENT_OR_SWAPPED = 3 << 62
+
+# Typed accesses unpack straight from / pack straight into the backing
+# buffer, so a load or store creates nothing but the resulting int.
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+U64 = struct.Struct('<Q')
+I8 = struct.Struct('<b')
+I16 = struct.Struct('<h')
+I32 = struct.Struct('<i')
+I64 = struct.Struct('<q')
+
+# Whether pages of this process can be swapped out; when that cannot be
+# told, assume so.
+def host_has_swap():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("SwapTotal:"):
+                    return int(line.split()[1]) != 0
+    except (OSError, ValueError, IndexError):
+        pass
+    return True
+
+
+# Backed by an anonymous mapping, so the host only commits the pages the guest
+# actually touches and a large configured size costs nothing up front. The
+# mapping is private, so a forked copy of the machine gets the memory
+# copy-on-write instead of sharing it.
 class Memory():
     def __init__(self, size, dram_bin):
-        self.ram = bytearray(size)
+        self.ram = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE)
         self.size = size
+        # Pages that somebody (e.g. the decode cache) derived state from. A
+        # store into one of them calls every watcher with the page number,
+        # after which the page is unwatched until it is registered again.
+        self.watched_pages = set()
+        self.watchers = []
+        # With dirty tracking on, one byte per granule of 1 << dirty_shift
+        # bytes, set by every store into it. dirty_base tags what the changes
+        # are relative to (e.g. the snapshot saved when it was last cleared).
+        self.dirty = None
+        self.dirty_shift = PAGE_SHIFT
+        self.dirty_base = None
+        # bytes loaded from dram_bin at the start of memory
+        self.image_size = 0
         if dram_bin:
+            # copied from a read-only mapping of the image, so emulators
+            # loading the same kernel read it from one shared page cache copy
             with open(dram_bin, 'rb') as f:
-                data = f.read()
-                data_len = len(data) if len(data) < self.size else self.size
-                self.store(0, data_len, data)
+                image_len = os.fstat(f.fileno()).st_size
+                if image_len:
+                    with mmap.mmap(f.fileno(), image_len, access=mmap.ACCESS_READ) as image:
+                        data_len = min(image_len, self.size)
+                        self.store(0, data_len, memoryview(image)[:data_len])
+                        self.image_size = data_len
 
     def load(self, addr, size):
-        addr = int(addr)
-        # if addr == 0x3ff010:
-        #     logging.info(f"load {self.ram[addr:addr+size]}")
         return self.ram[addr:addr+size]
 
     def store(self, addr, size, data):
-        addr = int(addr)
-        if addr == 0x3ff010:
-            logging.info(f"store {data}")
-        if isinstance(data, int) or isinstance(data, np.uint64):
-            data = np.uint64(data).tobytes()
-        self.ram[addr:addr+size] = data[:size]
+        if isinstance(data, int):
+            data = (data & ((1 << (8 * size)) - 1)).to_bytes(size, 'little')
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data[:size])
+        data = data[:size]
+        self.ram[addr:addr+len(data)] = data
+        if self.watched_pages or self.dirty is not None:
+            self.notify_write(addr, size)
+        return True
+
+    # a zero-copy window into memory, e.g. for device dma
+    def view(self, addr, size):
+        return memoryview(self.ram)[addr:addr+size]
+
+    # Bytes of memory the host really holds, from /proc/self/smaps. None
+    # where that is not available.
+    def resident(self):
+        start = self.address()
+        end = start + self.size
+        rss = 0
+        inside = False
+        try:
+            with open("/proc/self/smaps") as f:
+                for line in f:
+                    fields = line.split()
+                    if "-" in fields[0] and not fields[0].endswith(":"):
+                        lo, hi = (int(x, 16) for x in fields[0].split("-"))
+                        inside = lo < end and hi > start
+                    elif inside and fields[0] == "Rss:":
+                        rss += int(fields[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            return None
+        return rss
+
+    # Numbers of the pages the guest may have written, the only ones that can
+    # hold anything but zeros, so a scan for data need not fault in (and
+    # count as resident) the rest. A page that is resident now is one of
+    # them, but so is a page swapped out: /proc/self/pagemap knows both.
+    # Without it, mincore's resident pages will do on a host without swap,
+    # where nothing can have left memory; otherwise every page.
+    def touched_pages(self):
+        pages = self.pagemap_pages()
+        if pages is None and not host_has_swap():
+            pages = self.resident_pages()
+        return pages if pages is not None else range(self.size >> PAGE_SHIFT)
+
+    def address(self):
+        buf = ctypes.c_char.from_buffer(self.ram)
+        start = ctypes.addressof(buf)
+        del buf
+        return start
+
+    # pages present or swapped out, None where pagemap is not readable
+    def pagemap_pages(self):
+        npages = self.size >> PAGE_SHIFT
+        entries = array.array('Q')
+        try:
+            with open("/proc/self/pagemap", "rb") as f:
+                f.seek((self.address() >> PAGE_SHIFT) * 8)
+                entries.frombytes(f.read(npages * 8))
+        except (OSError, ValueError):
+            return None
+        if len(entries) != npages:
+            return None
+        return [page for page, entry in enumerate(entries) if entry & PAGEMAP_PRESENT_OR_SWAPPED]
+
+    # pages resident right now, None where mincore is not available
+    def resident_pages(self):
+        npages = self.size >> PAGE_SHIFT
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            vec = (ctypes.c_ubyte * npages)()
+            if libc.mincore(ctypes.c_void_p(self.address()), ctypes.c_size_t(self.size), vec) != 0:
+                return None
+        except (OSError, AttributeError):
+            return None
+        return [page for page, flags in enumerate(bytes(vec)) if flags & 1]
+
+    def read_u8(self, addr):
+        return self.ram[addr]
+
+    def read_u16(self, addr):
+        return U16.unpack_from(self.ram, addr)[0]
+
+    def read_u32(self, addr):
+        return U32.unpack_from(self.ram, addr)[0]
+
+    def read_u64(self, addr):
+        return U64.unpack_from(self.ram, addr)[0]
+
+    def read_i8(self, addr):
+        return I8.unpack_from(self.ram, addr)[0]
+
+    def read_i16(self, addr):
+        return I16.unpack_from(self.ram, addr)[0]
+
+    def read_i32(self, addr):
+        return I32.unpack_from(self.ram, addr)[0]
+
+    def read_i64(self, addr):
+        return I64.unpack_from(self.ram, addr)[0]
+
+    # the write_* accessors take any int and store its low bytes, so signed
+    # values need no variants of their own
+    def write_u8(self, addr, value):
+        self.ram[addr] = value & 0xff
+        if self.dirty is not None:
+            self.dirty[addr >> self.dirty_shift] = 1
+        if self.watched_pages:
+            self.notify_write(addr, 1)
+        return True
+
+    def write_u16(self, addr, value):
+        U16.pack_into(self.ram, addr, value & 0xffff)
+        if self.dirty is not None:
+            self.dirty[addr >> self.dirty_shift] = 1
+            self.dirty[(addr + 1) >> self.dirty_shift] = 1
+        if self.watched_pages:
+            self.notify_write(addr, 2)
+        return True
+
+    def write_u32(self, addr, value):
+        U32.pack_into(self.ram, addr, value & 0xffff_ffff)
+        if self.dirty is not None:
+            self.dirty[addr >> self.dirty_shift] = 1
+            self.dirty[(addr + 3) >> self.dirty_shift] = 1
+        if self.watched_pages:
+            self.notify_write(addr, 4)
         return True
 
+    def write_u64(self, addr, value):
+        U64.pack_into(self.ram, addr, value & 0xffff_ffff_ffff_ffff)
+        if self.dirty is not None:
+            self.dirty[addr >> self.dirty_shift] = 1
+            self.dirty[(addr + 7) >> self.dirty_shift] = 1
+        if self.watched_pages:
+            self.notify_write(addr, 8)
+        return True
+
+    def add_watcher(self, callback):
+        self.watchers.append(callback)
+
+    def watch_page(self, page):
+        self.watched_pages.add(page)
+
+    # Start tracking the granules stores go to, granularity bytes each (a
+    # power of two, at least a page), from a clean slate.
+    def track_dirty(self, granularity=1 << PAGE_SHIFT):
+        if granularity < 1 << PAGE_SHIFT or granularity & (granularity - 1):
+            raise ValueError("dirty granularity must be a power of two of at least a page")
+        self.dirty_shift = granularity.bit_length() - 1
+        self.dirty = bytearray((self.size + granularity - 1) >> self.dirty_shift)
+        self.dirty_base = None
+
+    def clear_dirty(self, base=None):
+        self.dirty[:] = bytes(len(self.dirty))
+        self.dirty_base = base
+
+    # numbers of the pages in dirty granules
+    def dirty_pages(self):
+        per_granule = 1 << (self.dirty_shift - PAGE_SHIFT)
+        npages = self.size >> PAGE_SHIFT
+        pages = []
+        granule = self.dirty.find(1)
+        while granule != -1:
+            first = granule * per_granule
+            pages.extend(range(first, min(first + per_granule, npages)))
+            granule = self.dirty.find(1, granule + 1)
+        return pages
+
+    # called for every write into dram: device dma reports its writes here
+    def notify_write(self, addr, size):
+        if self.dirty is not None:
+            lo, hi = addr >> self.dirty_shift, (addr + size - 1) >> self.dirty_shift
+            self.dirty[lo:hi + 1] = b"\x01" * (hi - lo + 1)
+        first = addr >> PAGE_SHIFT
+        last = (addr + size - 1) >> PAGE_SHIFT
+        if first == last and first not in self.watched_pages:
+            return
+        for page in range(first, last + 1):
+            if page in self.watched_pages:
+                self.watched_pages.discard(page)
+                for callback in self.watchers:
+                    callback(page)
+
@@ -0,0 +1,199 @@
+# The fleet module runs a batch of guest jobs on a pool of processes, one
+# emulator per job, for CI. A job is a kernel image, an optional disk image,
+# a scripted console session and the output that means success. Jobs come
+# from a json manifest:
+#
+#   {"defaults": {"kernel": "kernel.img", "disk": "fs.img", "max_insts": 500000000},
+#    "jobs": [{"name": "ls", "script": [{"wait": "$ ", "send": "ls\n"}], "expect": "README"}]}
+#
+# Paths are relative to the manifest. A job stops when its expected output
+# shows up, or fails once it has used up max_insts instructions or timeout
+# seconds. timeout defaults to DEFAULT_TIMEOUT and a job must keep at least
+# one of the two, so a hung guest cannot hold up the batch. Every job reads
+# its images through read-only mappings (the disk behind a private in-memory
+# overlay), so the host holds one copy of each in its page cache however many
+# jobs use them. The results file lists status, runtime and instruction count
+# per job.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import traceback
+from typing import List
+from pyfive import bus
+from pyfive import cli
+from pyfive import cpu
+from pyfive import disk
+from pyfive import tcache
+
+# instructions run between checks of the time budget
+SLICE = 1_000_000
+# seconds a job may run when the manifest sets no budget
+DEFAULT_TIMEOUT = 3600
+DEFAULTS = {
+    "disk": None,
+    "memory": bus.DRAM_SIZE,
+    "script": [],
+    "expect": None,
+    "max_insts": None,
+    "timeout": DEFAULT_TIMEOUT,
+    "cache_dir": tcache.DEFAULT_DIR,
+}
+
+
+# Feeds a job's script to the console and watches for its expected output.
+class Session():
+    def __init__(self, emu, script, expect):
+        self.emu = emu
+        self.uart = emu.bus.uart
+        self.script = list(script)
+        self.expect = expect.encode() if expect else None
+        self.output = bytearray()
+        # where in output to look for the next wait text
+        self.mark = 0
+        self.passed = False
+        self.uart.output_hooks.append(self.on_output)
+        self.advance()
+
+    # send every step whose wait text has shown up since the previous one
+    def advance(self):
+        while self.script:
+            wait = self.script[0].get("wait", "").encode()
+            found = self.output.find(wait, self.mark) if wait else self.mark
+            if found < 0:
+                return
+            self.mark = found + len(wait)
+            self.uart.push_input(self.script.pop(0).get("send", "").encode())
+
+    def on_output(self, byte):
+        self.output.append(byte)
+        self.advance()
+        if self.expect and not self.script and not self.passed and self.output.endswith(self.expect):
+            self.passed = True
+            self.emu.stop()
+
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for n, entry in enumerate(manifest["jobs"]):
+        job = dict(DEFAULTS)
+        job.update(manifest.get("defaults", {}))
+        job.update(entry)
+        job.setdefault("name", f"job{n}")
+        if isinstance(job["memory"], str):
+            job["memory"] = cli.parse_size(job["memory"])
+        for key in ("kernel", "disk", "cache_dir"):
+            if job.get(key):
+                job[key] = os.path.join(base, os.path.expanduser(job[key]))
+        if not job.get("kernel"):
+            raise ValueError(f"job {job['name']} has no kernel")
+        if job["max_insts"] is None and job["timeout"] is None:
+            raise ValueError(f"job {job['name']} has neither a max_insts nor a timeout budget")
+        for key in ("max_insts", "timeout"):
+            if job[key] is not None and job[key] <= 0:
+                raise ValueError(f"job {job['name']}: {key} must be positive")
+        jobs.append(job)
+    return jobs
+
+
+# Run one job; called in a pool process.
+def run_job(job):
+    result = {"name": job["name"], "status": "fail", "reason": None,
+              "instructions": 0, "runtime": 0.0, "output": ""}
+    start = time.monotonic()
+    session = None
+    mybus = None
+    try:
+        disk_bin = disk.Overlay(job["disk"]) if job["disk"] else None
+        mybus = bus.Bus(size=job["memory"], dram_bin=job["kernel"], disk_bin=disk_bin)
+        emu = cpu.Cpu(mybus)
+        cache = None
+        if job["cache_dir"]:
+            cache = tcache.TranslationCache.for_image(job["kernel"], job["cache_dir"])
+            emu.translator.cache = cache
+        session = Session(emu, job["script"], job["expect"])
+        deadline = start + job["timeout"] if job["timeout"] else None
+        budget = job["max_insts"]
+        while not session.passed:
+            step = SLICE
+            if budget is not None:
+                step = min(step, budget - result["instructions"])
+            result["instructions"] += emu.run(step)
+            if session.passed:
+                break
+            if budget is not None and result["instructions"] >= budget:
+                result["reason"] = "instruction budget"
+                break
+            if deadline and time.monotonic() >= deadline:
+                result["reason"] = "time budget"
+                break
+        if session.passed:
+            result["status"] = "pass"
+        elif not session.expect:
+            # nothing to wait for, running out of budget is the end of the job
+            result["status"] = "done"
+        if cache is not None:
+            cache.save()
+    except BaseException:
+        result["status"] = "error"
+        result["reason"] = traceback.format_exc()
+    finally:
+        if mybus is not None:
+            mybus.close()
+    result["runtime"] = round(time.monotonic() - start, 3)
+    if session is not None:
+        result["output"] = session.output.decode(errors="replace")
+    return result
+
+
+def run_fleet(jobs, workers=None):
+    results = [None] * len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        futures = {pool.submit(run_job, job): n for n, job in enumerate(jobs)}
+        for future in concurrent.futures.as_completed(futures):
+            n = futures[future]
+            try:
+                results[n] = future.result()
+            except Exception as e:
+                # the worker process itself died
+                results[n] = {"name": jobs[n]["name"], "status": "error", "reason": repr(e),
+                              "instructions": 0, "runtime": 0.0, "output": ""}
+            print(f"{results[n]['name']}: {results[n]['status']}", file=sys.stderr)
+    return results
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="pyfive.fleet", description="run a batch of pyfive guest jobs")
+    parser.add_argument("manifest", help="json job manifest")
+    parser.add_argument("-o", "--output", default="results.json", help="results file")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: host cores)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not load or save translated blocks")
+    args = parser.parse_args(argv[1:])
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ValueError, KeyError, argparse.ArgumentTypeError) as e:
+        print(f"pyfive.fleet: bad manifest: {e!r}", file=sys.stderr)
+        return 2
+    if args.no_cache:
+        for job in jobs:
+            job["cache_dir"] = None
+    start = time.monotonic()
+    results = run_fleet(jobs, args.jobs)
+    summary = {status: sum(1 for r in results if r["status"] == status)
+               for status in ("pass", "done", "fail", "error")}
+    summary["runtime"] = round(time.monotonic() - start, 3)
+    with open(args.output, "w") as f:
+        json.dump({"summary": summary, "jobs": results}, f, indent=2)
+    return 0 if summary["fail"] == summary["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(argv=sys.argv))
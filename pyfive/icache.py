@@ -0,0 +1,41 @@
+# The icache module holds decoded instructions keyed by physical pc, so an
+# instruction word is fetched and decoded once and then reused every time the
+# same address executes again. Entries of a page are dropped as soon as
+# anything (a guest store or device DMA) writes into that page of dram.
+
+from pyfive import dram
+
+
+class ICache():
+    def __init__(self, ram, base):
+        self.ram = ram
+        self.base_page = base >> dram.PAGE_SHIFT
+        self.entries = {}
+        # page number -> physical pcs cached in that page
+        self.pages = {}
+        ram.add_watcher(self.invalidate_page)
+
+    def lookup(self, paddr):
+        return self.entries.get(paddr)
+
+    def insert(self, paddr, decoded):
+        page = paddr >> dram.PAGE_SHIFT
+        pcs = self.pages.get(page)
+        if pcs is None:
+            pcs = self.pages[page] = []
+            self.ram.watch_page(page - self.base_page)
+        pcs.append(paddr)
+        self.entries[paddr] = decoded
+
+    # called by dram with the page number relative to the start of dram
+    def invalidate_page(self, page):
+        pcs = self.pages.pop(page + self.base_page, None)
+        if pcs:
+            for pc in pcs:
+                self.entries.pop(pc, None)
+
+    # pages stay watched in dram since other watchers may share them; a
+    # notification for a page that is no longer cached is simply ignored
+    def flush(self):
+        self.entries.clear()
+        self.pages.clear()
@@ -0,0 +1,385 @@
+# The jit module translates straight-line runs of guest instructions (basic
+# blocks) into Python source, compiles each one into a code object and runs
+# the whole block with one call. Guest registers live in Python locals for the
+# duration of a block and are written back on every exit.
+#
+# A block ends at a branch, jump, system instruction, illegal instruction or
+# page boundary. Direct successors are linked to the block by the dispatcher
+# in Cpu.step_block, so chained blocks skip the lookup and the page walk.
+# Blocks are keyed by virtual pc within an address space (a satp value), and
+# an address space loses its blocks when the tlb drops one of its instruction
+# translations; writes into a code page only drop the blocks of that page.
+#
+# A block that branches back to its own start without a store, a call into a
+# handler or an mmio load is checked for spinning: when an iteration left its
+# registers as they were, nothing but an interrupt or a device can end the
+# loop, and the block returns IDLE so the cpu lets time pass instead.
+
+from pyfive import dram
+from pyfive import trap
+
+BLOCK_MAX = 64
+MASK64 = (1 << 64) - 1
+PAGE_SIZE = 1 << dram.PAGE_SHIFT
+
+# instructions that leave the block; everything after them is translated into
+# the next block
+TERMINATORS = {
+    "op_beq", "op_bne", "op_blt", "op_bge", "op_bltu", "op_bgeu",
+    "op_jal", "op_jalr",
+    "op_ecall", "op_ebreak", "op_sret", "op_mret", "op_wfi", "op_sfence_vma",
+    "op_csrrw", "op_csrrs", "op_csrrc", "op_csrrwi", "op_csrrsi", "op_csrrci",
+    "op_illegal",
+}
+
+# instructions without side effects other than writing rd; skipped when rd is x0
+PURE = {
+    "op_addi", "op_slli", "op_slti", "op_sltiu", "op_xori", "op_srli",
+    "op_srai", "op_ori", "op_andi", "op_auipc", "op_addiw", "op_slliw",
+    "op_srliw", "op_sraiw", "op_add", "op_mul", "op_sub", "op_sll",
+    "op_slt", "op_sltu", "op_xor", "op_srl", "op_sra", "op_or", "op_and",
+    "op_lui", "op_addw", "op_subw", "op_sllw", "op_srlw", "op_sraw",
+}
+
+# value expressions for register-writing instructions, in terms of
+# {s1}/{s2} (source registers), {k} (the immediate as an unsigned 64-bit
+# value) and {kx} (the immediate with its sign bit flipped, for signed
+# compares); they mirror the op_* handlers in cpu.py. Flipping the sign bit of
+# both sides turns an unsigned compare into a signed one, and SEXT32 sign
+# extends the low 32 bits of a value.
+SEXT32 = "((({0}) & 0xffffffff) ^ 0x80000000) - 0x80000000 & M"
+SIGNED32 = "((({0}) & 0xffffffff) ^ 0x80000000) - 0x80000000"
+SIGNED64 = "(({0}) ^ SB) - SB"
+ALU = {
+    "op_addi": "({s1} + {k}) & M",
+    "op_slli": "({s1} << {k}) & M",
+    "op_slti": "1 if ({s1} ^ SB) < {kx} else 0",
+    "op_sltiu": "1 if {s1} < {k} else 0",
+    "op_xori": "{s1} ^ {k}",
+    "op_srli": "{s1} >> {k}",
+    "op_srai": "(" + SIGNED64.format("{s1}") + ") >> {k} & M",
+    "op_ori": "{s1} | {k}",
+    "op_andi": "{s1} & {k}",
+    "op_addiw": SEXT32.format("{s1} + {k}"),
+    "op_slliw": SEXT32.format("{s1} << {k}"),
+    "op_srliw": SEXT32.format("({s1} & 0xffffffff) >> {k}"),
+    "op_sraiw": "(" + SIGNED32.format("{s1}") + ") >> {k} & M",
+    "op_add": "({s1} + {s2}) & M",
+    "op_mul": "({s1} * {s2}) & M",
+    "op_sub": "({s1} - {s2}) & M",
+    "op_sll": "({s1} << ({s2} & 0x3f)) & M",
+    "op_slt": "1 if ({s1} ^ SB) < ({s2} ^ SB) else 0",
+    "op_sltu": "1 if {s1} < {s2} else 0",
+    "op_xor": "{s1} ^ {s2}",
+    "op_srl": "{s1} >> ({s2} & 0x3f)",
+    "op_sra": "(" + SIGNED64.format("{s1}") + ") >> ({s2} & 0x3f) & M",
+    "op_or": "{s1} | {s2}",
+    "op_and": "{s1} & {s2}",
+    "op_addw": SEXT32.format("{s1} + {s2}"),
+    "op_subw": SEXT32.format("{s1} - {s2}"),
+    "op_sllw": SEXT32.format("{s1} << ({s2} & 0x1f)"),
+    "op_srlw": SEXT32.format("({s1} & 0xffffffff) >> ({s2} & 0x1f)"),
+    "op_sraw": "(" + SIGNED32.format("{s1}") + ") >> ({s2} & 0x1f) & M",
+}
+
+LOADS = {
+    "op_lb": ("loadint", 1), "op_lh": ("loadint", 2),
+    "op_lw": ("loadint", 4), "op_ld": ("loadint", 8),
+    "op_lbu": ("loaduint", 1), "op_lhu": ("loaduint", 2),
+    "op_lwu": ("loaduint", 4),
+}
+
+STORES = {"op_sb": 1, "op_sh": 2, "op_sw": 4, "op_sd": 8}
+
+BRANCHES = {
+    "op_beq": "{s1} == {s2}",
+    "op_bne": "{s1} != {s2}",
+    "op_blt": "({s1} ^ SB) < ({s2} ^ SB)",
+    "op_bge": "({s1} ^ SB) >= ({s2} ^ SB)",
+    "op_bltu": "{s1} < {s2}",
+    "op_bgeu": "{s1} >= {s2}",
+}
+
+
+# returned by a block found spinning, see above
+IDLE = object()
+
+
+class Block():
+    def __init__(self, pc, ppc, ninsts, code, exits):
+        self.pc = pc
+        self.ppc = ppc
+        self.ninsts = ninsts
+        self.code = code
+        self.fn = make_function(code)
+        self.valid = True
+        # the address space (pc -> block) the block was inserted into
+        self.space = None
+        # direct successors by pc, linked lazily by the dispatcher
+        self.links = dict.fromkeys(exits)
+
+
+def make_function(code):
+    namespace = {"EXC": trap.EXCEPTION, "M": MASK64, "SB": 1 << 63, "IDLE": IDLE}
+    exec(code, namespace)
+    return namespace["block"]
+
+
+class BlockBuilder():
+    def __init__(self, pc):
+        self.pc = pc
+        self.used = set()
+        self.written = set()
+        self.body = []
+        self.exits = []
+        # whether an iteration of the block can be seen to have had no effect
+        self.spin = True
+        self.loads = False
+
+    def u64(self, value):
+        return hex(value & MASK64)
+
+    def reg(self, index):
+        if index == 0:
+            return "0"
+        self.used.add(index)
+        return f"x{index}"
+
+    def emit(self, line, indent=1):
+        self.body.append("    " * indent + line)
+
+    def spill(self, indent):
+        for index in sorted(self.written):
+            self.emit(f"xr[{index}] = x{index}", indent)
+
+    def leave(self, next_pc, ret, indent=1):
+        self.spill(indent)
+        self.emit(f"cpu.pc = {self.u64(next_pc)}", indent)
+        self.emit(f"return {ret}", indent)
+
+    def set_reg(self, rd, expr):
+        self.used.add(rd)
+        self.written.add(rd)
+        self.emit(f"x{rd} = {expr}")
+
+    # On a jump back to the start: if no register changed and no load went
+    # to a device, this iteration did nothing and neither will the next.
+    def spin_check(self, indent):
+        conds = [f"x{index} == xr[{index}]" for index in sorted(self.written)]
+        if self.loads:
+            conds.append("cpu.bus.mmio_loads == m")
+        if conds:
+            self.emit(f"if {' and '.join(conds)}:", indent)
+            indent += 1
+        self.emit(f"cpu.pc = {self.u64(self.pc)}", indent)
+        self.emit("return IDLE", indent)
+
+    # run an op_* handler on the register file itself, for instructions not
+    # worth inlining; returns the handler call expression
+    def call_handler(self, name, rd, rs1, rs2, imm, pc):
+        self.spin = False
+        self.spill(1)
+        self.emit(f"cpu.pc = {self.u64(pc + 4)}")
+        return f"cpu.{name}({rd}, {rs1}, {rs2}, {imm})"
+
+    def add(self, d, pc):
+        handler, rd, rs1, rs2, imm, inst = d
+        name = handler.__name__
+        self.emit(f"# {hex(pc)}: {hex(inst)} {name[3:]}")
+        if name in PURE and rd == 0:
+            return
+        if name in ALU:
+            fields = {"s1": self.reg(rs1)}
+            if "{s2}" in ALU[name]:
+                fields["s2"] = self.reg(rs2)
+            if imm is not None:
+                fields["k"] = self.u64(imm)
+                fields["kx"] = self.u64(imm ^ (1 << 63))
+            self.set_reg(rd, ALU[name].format(**fields))
+        elif name == "op_lui":
+            self.set_reg(rd, self.u64(imm))
+        elif name == "op_auipc":
+            self.set_reg(rd, self.u64(pc + imm))
+        elif name in LOADS:
+            method, size = LOADS[name]
+            self.loads = True
+            self.emit(f"v = cpu.{method}(({self.reg(rs1)} + {self.u64(imm)}) & M, {size})")
+            self.emit("if v.__class__ is EXC:")
+            self.leave(pc + 4, "v", 2)
+            if rd != 0:
+                self.set_reg(rd, "v")
+        elif name in STORES:
+            size = STORES[name]
+            self.spin = False
+            self.emit(f"r = cpu.store(({self.reg(rs1)} + {self.u64(imm)}) & M, {size}, {self.reg(rs2)})")
+            self.emit("if r.__class__ is EXC:")
+            self.leave(pc + 4, "r", 2)
+            # the store may have hit the page this block was translated from
+            self.emit("if not blk.valid:")
+            self.leave(pc + 4, "True", 2)
+            self.exits.append(pc + 4)
+        elif name == "op_fence":
+            pass
+        elif name in BRANCHES:
+            cond = BRANCHES[name].format(s1=self.reg(rs1), s2=self.reg(rs2))
+            taken = (pc + imm) & MASK64
+            self.emit(f"if {cond}:")
+            if taken == self.pc and self.spin:
+                self.spin_check(2)
+            self.leave(taken, "True", 2)
+            self.leave(pc + 4, "True")
+            self.exits += [taken, pc + 4]
+        elif name == "op_jal":
+            target = (pc + imm) & MASK64
+            if rd != 0:
+                self.set_reg(rd, self.u64(pc + 4))
+            if target == self.pc and self.spin:
+                self.spin_check(1)
+            self.leave(target, "True")
+            self.exits.append(target)
+        elif name == "op_jalr":
+            self.emit(f"t = ({self.reg(rs1)} + {self.u64(imm)}) & 0xfffffffffffffffe")
+            if rd != 0:
+                self.set_reg(rd, self.u64(pc + 4))
+            self.spill(1)
+            self.emit("cpu.pc = t")
+            self.emit("return True")
+        elif name in TERMINATORS:
+            self.emit(f"return {self.call_handler(name, rd, rs1, rs2, imm, pc)}")
+        else:
+            self.emit(f"r = {self.call_handler(name, rd, rs1, rs2, imm, pc)}")
+            self.emit("if r is not True:")
+            self.emit("return r", 2)
+            if rd != 0:
+                self.used.add(rd)
+                self.emit(f"x{rd} = xr[{rd}]")
+            self.emit("if not blk.valid:")
+            self.leave(pc + 4, "True", 2)
+            self.exits.append(pc + 4)
+
+    # falls through to the next page or past BLOCK_MAX instructions
+    def finish(self, next_pc):
+        self.leave(next_pc, "True")
+        self.exits.append(next_pc)
+
+    def source(self):
+        lines = ["def block(cpu, blk, M=M, SB=SB):", "    xr = cpu.xreg.xregs"]
+        lines += [f"    x{index} = xr[{index}]" for index in sorted(self.used)]
+        if self.spin and self.loads:
+            lines.append("    m = cpu.bus.mmio_loads")
+        return "\n".join(lines + self.body) + "\n"
+
+
+class Translator():
+    def __init__(self, cpu, ram, base):
+        self.cpu = cpu
+        self.ram = ram
+        self.base = base
+        # satp -> pc -> block, blocks is the table of the current satp
+        self.spaces = {}
+        self.blocks = None
+        self.switch(0)
+        # physical page -> blocks translated from it
+        self.pages = {}
+        # optional tcache.TranslationCache shared with later runs
+        self.cache = None
+        ram.add_watcher(self.invalidate_page)
+
+    def switch(self, satp):
+        blocks = self.spaces.get(satp)
+        if blocks is None:
+            blocks = self.spaces[satp] = {}
+        self.blocks = blocks
+
+    def lookup(self, pc):
+        blk = self.blocks.get(pc)
+        if blk is None:
+            blk = self.translate(pc)
+        return blk
+
+    # Returns the block to run at pc, following (and recording) the direct
+    # link from the previous block when there is one. None means pc is not
+    # in translatable memory and has to be interpreted.
+    def next_block(self, prev, pc):
+        if prev is not None and prev.space is self.blocks and pc in prev.links:
+            blk = prev.links[pc]
+            if blk is None or not blk.valid:
+                blk = self.lookup(pc)
+                if isinstance(blk, Block):
+                    prev.links[pc] = blk
+            return blk
+        return self.lookup(pc)
+
+    def translate(self, pc):
+        ppc = self.cpu.fetch_paddr(pc)
+        if isinstance(ppc, trap.EXCEPTION):
+            return ppc
+        ppc = int(ppc)
+        if ppc < self.base or ppc >= self.base + self.ram.size:
+            return None
+        offset = ppc - self.base
+        if self.cache is not None:
+            blk = self.cache.lookup(pc, ppc, self.ram.ram, offset)
+            if blk is not None:
+                self.insert(blk)
+                return blk
+        builder = BlockBuilder(pc)
+        count = 0
+        while True:
+            d = self.cpu.decode_at(ppc + count * 4)
+            builder.add(d, pc + count * 4)
+            count += 1
+            if d[0].__name__ in TERMINATORS:
+                break
+            if (ppc + count * 4) % PAGE_SIZE == 0 or count == BLOCK_MAX:
+                builder.finish(pc + count * 4)
+                break
+        code = compile(builder.source(), f"<block {hex(pc)}>", "exec")
+        blk = Block(pc, ppc, count, code, builder.exits)
+        self.insert(blk)
+        if self.cache is not None:
+            self.cache.add(blk, self.ram.ram[offset:offset + count * 4])
+        return blk
+
+    def insert(self, blk):
+        page = blk.ppc >> dram.PAGE_SHIFT
+        blocks = self.pages.get(page)
+        if blocks is None:
+            blocks = self.pages[page] = set()
+            self.ram.watch_page(page - (self.base >> dram.PAGE_SHIFT))
+        blocks.add(blk)
+        blk.space = self.blocks
+        self.blocks[blk.pc] = blk
+
+    # called by dram with the page number relative to the start of dram
+    def invalidate_page(self, page):
+        blocks = self.pages.pop(page + (self.base >> dram.PAGE_SHIFT), None)
+        if blocks:
+            for blk in blocks:
+                blk.valid = False
+                if blk.space.get(blk.pc) is blk:
+                    del blk.space[blk.pc]
+
+    # called by the tlb when translations of satp changed, so the virtual pcs
+    # of its blocks may now map to other code
+    def flush_space(self, satp):
+        blocks = self.spaces.get(satp)
+        if blocks is None:
+            return
+        for blk in blocks.values():
+            blk.valid = False
+            page = self.pages.get(blk.ppc >> dram.PAGE_SHIFT)
+            if page is not None:
+                page.discard(blk)
+        blocks.clear()
+        # switch() makes a new table when the space is used again
+        if blocks is not self.blocks:
+            del self.spaces[satp]
+
+    def flush(self):
+        for blocks in self.pages.values():
+            for blk in blocks:
+                blk.valid = False
+        for blocks in self.spaces.values():
+            blocks.clear()
+        self.pages.clear()
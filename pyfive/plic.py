@@ -2,11 +2,22 @@
 # The plic connects all external interrupts in the system to all hart
 # contexts in the system, via the external interrupt source in each hart.
 # It's the global interrupt controller in a RISC-V system.
+#
+# Devices raise and lower their interrupt line here instead of being polled.
+# Whether the hart has anything to do about interrupts is kept in one flag,
+# deliverable, that the cpu tests between blocks: device events set it, and
+# the cpu recomputes it on its slow path and whenever a csr that gates
+# interrupts is written (see Cpu.update_interrupts).
+#
+# Devices with a host file to read (the console) have the plic watch it in a
+# selector, which the cpu polls now and then and an idle hart sleeps on; a
+# pipe in the same selector wakes it for requests from other threads.
 
 
-import numpy as np
 from enum import Enum
-import logging
+import collections
+import os
+import selectors
 
 class PLIC(Enum):
     PENDING = 0x1000
@@ -16,16 +27,114 @@ class PLIC(Enum):
 
 class Plic():
     def __init__(self, size):
-        self.pending = np.uint32(0)
-        self.senable = np.uint32(0)
-        self.spriority = np.uint32(0)
-        self.sclaim = np.uint32(0)
+        self.pending = 0
+        self.senable = 0
+        self.spriority = 0
+        self.sclaim = 0
+        # device lines that are up and irqs handed to the hart but not
+        # completed yet, a bit per irq
+        self.lines = 0
+        self.claimed = 0
+        # devices waiting for a service() call on the cpu thread
+        self.service = collections.deque()
+        self.deliverable = False
+        self.selector = None
+        self.open_wakeup()
+
+    # A new selector and wakeup pipe, e.g. for a forked machine that must
+    # not share them with its parent. Watched files are dropped.
+    def open_wakeup(self):
+        if self.selector is not None:
+            self.close()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+    def close(self):
+        self.selector.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        self.selector = None
+
+    # device.service() is called on the cpu thread when f has input
+    def watch(self, f, device):
+        self.selector.register(f, selectors.EVENT_READ, device)
+
+    def unwatch(self, f):
+        self.selector.unregister(f)
+
+    def raise_irq(self, irq):
+        self.lines |= 1 << irq
+        self.deliverable = True
+
+    def lower_irq(self, irq):
+        self.lines &= ~(1 << irq)
+
+    # For devices working on other threads (async disk i/o):
+    # device.service() is called on the cpu thread at the next check.
+    def request_service(self, device):
+        self.service.append(device)
+        self.deliverable = True
+        try:
+            os.write(self.wakeup_w, b"\0")
+        except BlockingIOError:
+            # the pipe is full of wakeups already
+            pass
+
+    # Queue the devices whose files have input, waiting up to timeout
+    # seconds (0: just poll) for one of them or a service request.
+    def wait(self, timeout):
+        if self.service:
+            timeout = 0
+        for key, _events in self.selector.select(timeout):
+            if key.fd == self.wakeup_r:
+                try:
+                    while os.read(self.wakeup_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                self.service.append(key.data)
+                self.deliverable = True
+        # a request that came in through the pipe, in case the cpu cleared
+        # the flag after request_service set it
+        if self.service:
+            self.deliverable = True
+
+    def serve(self):
+        while self.service:
+            self.service.popleft().service()
+
+    # the line to hand to the hart next, 0 for none: the highest numbered
+    # one, so the console goes before the disk
+    def next_irq(self):
+        ready = self.lines & ~self.claimed
+        return ready.bit_length() - 1 if ready else 0
+
+    def claim(self, irq):
+        self.claimed |= 1 << irq
+        self.sclaim = irq
+
+    def save_state(self):
+        return {"pending": self.pending, "senable": self.senable,
+                "spriority": self.spriority, "sclaim": self.sclaim,
+                "lines": self.lines, "claimed": self.claimed}
+
+    def load_state(self, state):
+        self.pending = state["pending"]
+        self.senable = state["senable"]
+        self.spriority = state["spriority"]
+        self.sclaim = state["sclaim"]
+        self.lines = state.get("lines", 0)
+        self.claimed = state.get("claimed", 0)
+        self.deliverable = True
 
     def load32(self, addr):
-        logging.debug(f"plic load {hex(addr)}")
         match PLIC(addr):
             case PLIC.PENDING:
-                return self.pending
+                return self.lines & 0xffffffff
             case PLIC.SENABLE:
                 return self.senable
             case PLIC.SPRIORITY:
@@ -33,27 +142,29 @@ class Plic():
             case PLIC.SCLAIM:
                 return self.sclaim
             case other:
-                logging.debug(f"plic load other {hex(addr)}")
-                return np.uint32(0)
+                return 0
 
     def store32(self, addr, value):
-        logging.debug(f"plic store {hex(addr)} val{value}")
         match addr:
             case PLIC.PENDING.value:
-                self.pending = np.uint32(value)
+                self.pending = value & 0xffffffff
             case PLIC.SENABLE.value:
-                self.senable = np.uint32(value)
+                self.senable = value & 0xffffffff
             case PLIC.SPRIORITY.value:
-                self.spriority = np.uint32(value)
+                self.spriority = value & 0xffffffff
             case PLIC.SCLAIM.value:
-                self.sclaim = np.uint32(value)
+                # completion: the line may be taken again
+                self.sclaim = value & 0xffffffff
+                self.claimed &= ~(1 << (value & 0x1f))
+                if self.lines:
+                    self.deliverable = True
             case other:
-                logging.debug("plic write some regs")
+                pass
 
     def load(self, addr, size):
         if size != 4:
             raise("loading plic size is not 4")
-        return int(self.load32(addr)).to_bytes(4, byteorder='little', signed=False)
+        return self.load32(addr).to_bytes(4, byteorder='little', signed=False)
 
     def store(self, addr, size, data):
         if size != 4:
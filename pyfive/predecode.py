@@ -0,0 +1,99 @@
+# The predecode module extracts the fields of every instruction word of a
+# memory range in one vectorized numpy pass, instead of bit twiddling each
+# word in python the first time it executes. The results are kept as
+# struct-of-arrays tables indexed by (paddr - base) >> 2. A page written after
+# it was predecoded is marked stale and predecoded again, the same way, the
+# next time an instruction is looked up in it.
+
+import numpy as np
+from pyfive import dram
+
+FIELDS = ("inst", "opcode", "rd", "rs1", "rs2", "funct3", "funct7",
+          "imm_i", "imm_s", "imm_b", "imm_u", "imm_j")
+
+WORDS_PER_PAGE = (1 << dram.PAGE_SHIFT) >> 2
+
+
+# Decode an array of little-endian instruction words. Immediates are sign
+# extended to int64.
+def decode_words(words):
+    w = words.astype(np.int64)
+    s = words.view(np.int32).astype(np.int64)
+    return {
+        "inst": w,
+        "opcode": w & 0x7f,
+        "rd": (w >> 7) & 0x1f,
+        "rs1": (w >> 15) & 0x1f,
+        "rs2": (w >> 20) & 0x1f,
+        "funct3": (w >> 12) & 0x7,
+        "funct7": (w >> 25) & 0x7f,
+        "imm_i": s >> 20,
+        "imm_s": ((s >> 25) << 5) | ((w >> 7) & 0x1f),
+        "imm_b": ((s >> 31) << 12) | (((w >> 7) & 0x1) << 11) |
+                 (((w >> 25) & 0x3f) << 5) | (((w >> 8) & 0xf) << 1),
+        "imm_u": (s >> 12) << 12,
+        "imm_j": ((s >> 31) << 20) | (((w >> 12) & 0xff) << 12) |
+                 (((w >> 20) & 0x1) << 11) | (((w >> 21) & 0x3ff) << 1),
+    }
+
+
+# The same as decode_words for a single word, in FIELDS order.
+def decode_word(inst):
+    s = inst - (1 << 32) if inst & 0x8000_0000 else inst
+    return (
+        inst,
+        inst & 0x7f,
+        (inst >> 7) & 0x1f,
+        (inst >> 15) & 0x1f,
+        (inst >> 20) & 0x1f,
+        (inst >> 12) & 0x7,
+        (inst >> 25) & 0x7f,
+        s >> 20,
+        ((s >> 25) << 5) | ((inst >> 7) & 0x1f),
+        ((s >> 31) << 12) | (((inst >> 7) & 0x1) << 11) |
+        (((inst >> 25) & 0x3f) << 5) | (((inst >> 8) & 0xf) << 1),
+        (s >> 12) << 12,
+        ((s >> 31) << 20) | (((inst >> 12) & 0xff) << 12) |
+        (((inst >> 20) & 0x1) << 11) | (((inst >> 21) & 0x3ff) << 1),
+    )
+
+
+class Predecoder():
+    def __init__(self, ram, base, size):
+        self.ram = ram
+        self.base = base
+        # whole pages only, the tail of a partial page is decoded too
+        self.npages = (size + (1 << dram.PAGE_SHIFT) - 1) >> dram.PAGE_SHIFT
+        self.nwords = min(self.npages * WORDS_PER_PAGE, ram.size >> 2)
+        self.tables = {name: [] for name in FIELDS}
+        self.columns = [self.tables[name] for name in FIELDS]
+        self.stale = set()
+        if self.nwords:
+            self.fill(0, self.nwords)
+            ram.add_watcher(self.invalidate_page)
+            for page in range(self.npages):
+                ram.watch_page(page)
+
+    def fill(self, first, last):
+        words = np.frombuffer(self.ram.ram, dtype='<u4', count=last - first, offset=first * 4)
+        decoded = decode_words(words)
+        for name in FIELDS:
+            self.tables[name][first:last] = decoded[name].tolist()
+
+    def invalidate_page(self, page):
+        if page < self.npages:
+            self.stale.add(page)
+
+    # Fields of the instruction at paddr in FIELDS order, or None when paddr
+    # is outside the predecoded range.
+    def fields_at(self, paddr):
+        index = (paddr - self.base) >> 2
+        if index < 0 or index >= self.nwords:
+            return None
+        if self.stale:
+            page = index // WORDS_PER_PAGE
+            if page in self.stale:
+                self.stale.discard(page)
+                self.fill(page * WORDS_PER_PAGE, min((page + 1) * WORDS_PER_PAGE, self.nwords))
+                self.ram.watch_page(page)
+        return tuple(column[index] for column in self.columns)
@@ -0,0 +1,192 @@
+# The snapshot module saves and restores a whole machine: the cpu registers
+# and mode, the state of every device and the contents of dram. A snapshot
+# file starts with MAGIC, a version and a json header holding everything but
+# memory; dram follows as one zlib stream of (page number, page) records in
+# which pages that are all zero are left out, so a 2 GiB guest that has
+# touched 30 MiB makes a snapshot of a few MiB. The disk image is not part of
+# a snapshot: restore with the same image, or with an overlay kept from the
+# run that saved it.
+#
+# A snapshot can also be incremental: with dirty tracking on in dram it holds
+# only the pages written since its parent was saved (zero or not) and names
+# the parent by path, relative to its own directory, and id. Loading one
+# walks the chain back to the full snapshot at its root, newest pages first;
+# merge flattens a chain into a full snapshot again. Run this module for the
+# chain and merge tools.
+
+import argparse
+import json
+import os
+import struct
+import sys
+import uuid
+import zlib
+from typing import List
+from pyfive import dram
+
+MAGIC = b"PYFIVESN"
+VERSION = 1
+# magic, version, header length
+PREFIX = struct.Struct('<8sII')
+PAGE_SIZE = 1 << dram.PAGE_SHIFT
+ZERO_PAGE = bytes(PAGE_SIZE)
+PAGE_NUMBER = struct.Struct('<I')
+COMPRESS_LEVEL = 6
+
+
+def machine_state(cpu):
+    mybus = cpu.bus
+    state = {
+        "dram_size": mybus.ram.size,
+        "cpu": cpu.save_state(),
+        "clint": mybus.clint.save_state(),
+        "plic": mybus.plic.save_state(),
+        "uart": mybus.uart.save_state(),
+        "virtio": mybus.virtio.save_state(),
+    }
+    if mybus.vconsole is not None:
+        state["vconsole"] = mybus.vconsole.save_state()
+    return state
+
+
+# pages is an iterable of (page number, page); zero pages are dropped
+# unless keep_zero, which incremental snapshots need to record a page that
+# was cleared.
+def write_file(path, state, pages, keep_zero=False):
+    header = json.dumps(state).encode()
+    compressor = zlib.compressobj(COMPRESS_LEVEL)
+    with open(path, "wb") as f:
+        f.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for number, page in pages:
+            if keep_zero or page != ZERO_PAGE:
+                f.write(compressor.compress(PAGE_NUMBER.pack(number) + page))
+        f.write(compressor.flush())
+
+
+# Save the machine to path, in full or, given the parent snapshot, only what
+# changed since it. Dirty tracking, when on, restarts from the new snapshot.
+def save(cpu, path, parent=None):
+    ram = cpu.bus.ram
+    state = machine_state(cpu)
+    state["id"] = uuid.uuid4().hex
+    state["parent"] = None
+    if parent is None:
+        numbers = ram.touched_pages()
+    else:
+        parent_id = read_header(parent)["id"]
+        if ram.dirty is None or ram.dirty_base != parent_id:
+            raise ValueError(f"dram writes since {parent} were not tracked")
+        state["parent"] = os.path.relpath(os.path.abspath(parent), os.path.dirname(os.path.abspath(path)))
+        state["parent_id"] = parent_id
+        numbers = ram.dirty_pages()
+    pages = ((n, ram.ram[n * PAGE_SIZE:(n + 1) * PAGE_SIZE]) for n in numbers)
+    write_file(path, state, pages, keep_zero=parent is not None)
+    if ram.dirty is not None:
+        ram.clear_dirty(state["id"])
+    return state["id"]
+
+
+# The header of a snapshot, e.g. to size dram before loading it.
+def read_header(path):
+    with open(path, "rb") as f:
+        magic, version, length = PREFIX.unpack(f.read(PREFIX.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a pyfive snapshot")
+        return json.loads(f.read(length))
+
+
+def read_pages(path):
+    with open(path, "rb") as f:
+        _magic, _version, length = PREFIX.unpack(f.read(PREFIX.size))
+        f.seek(length, 1)
+        data = zlib.decompress(f.read())
+    record = PAGE_NUMBER.size + PAGE_SIZE
+    for offset in range(0, len(data), record):
+        yield PAGE_NUMBER.unpack_from(data, offset)[0], data[offset + PAGE_NUMBER.size:offset + record]
+
+
+# The snapshots path depends on, from path itself back to the full one.
+def chain(path):
+    paths = [path]
+    state = read_header(path)
+    while state.get("parent"):
+        parent = os.path.join(os.path.dirname(os.path.abspath(paths[-1])), state["parent"])
+        parent_state = read_header(parent)
+        if parent_state["id"] != state["parent_id"]:
+            raise ValueError(f"{parent} is not the snapshot {paths[-1]} was saved against")
+        paths.append(parent)
+        state = parent_state
+    return paths
+
+
+# page number -> page for the memory of the snapshot at path
+def collect_pages(path):
+    pages = {}
+    for link in chain(path):
+        for number, data in read_pages(link):
+            pages.setdefault(number, data)
+    return pages
+
+
+# Load a snapshot into a machine built with the same dram size. Memory is
+# written through the usual stores, so decode caches, translated blocks and
+# tlb entries derived from the old contents are dropped on the way.
+def load(cpu, path):
+    state = read_header(path)
+    ram = cpu.bus.ram
+    if state["dram_size"] != ram.size:
+        raise ValueError(f"{path} needs {state['dram_size']} bytes of dram, not {ram.size}")
+    pages = collect_pages(path)
+    for page, data in pages.items():
+        ram.store(page * PAGE_SIZE, PAGE_SIZE, data)
+    for page in ram.touched_pages():
+        if page not in pages and ram.ram[page * PAGE_SIZE:(page + 1) * PAGE_SIZE] != ZERO_PAGE:
+            ram.store(page * PAGE_SIZE, PAGE_SIZE, ZERO_PAGE)
+    mybus = cpu.bus
+    mybus.clint.load_state(state["clint"])
+    mybus.plic.load_state(state["plic"])
+    mybus.uart.load_state(state["uart"])
+    mybus.virtio.load_state(state["virtio"])
+    if mybus.vconsole is not None and "vconsole" in state:
+        mybus.vconsole.load_state(state["vconsole"])
+    cpu.load_state(state["cpu"])
+    if ram.dirty is not None:
+        ram.clear_dirty(state["id"])
+
+
+# Flatten the chain ending at path into the full snapshot out. It keeps the
+# id, so incremental snapshots can go on from it in place of path.
+def merge(path, out):
+    state = read_header(path)
+    state["parent"] = None
+    state.pop("parent_id", None)
+    pages = collect_pages(path)
+    write_file(out, state, sorted(pages.items()))
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="pyfive.snapshot", description="pyfive snapshot chains")
+    commands = parser.add_subparsers(dest="command", required=True)
+    show = commands.add_parser("chain", help="list the snapshots a snapshot depends on")
+    show.add_argument("path")
+    flatten = commands.add_parser("merge", help="flatten a chain into one full snapshot")
+    flatten.add_argument("path")
+    flatten.add_argument("out")
+    args = parser.parse_args(argv[1:])
+    try:
+        match args.command:
+            case "chain":
+                for link in chain(args.path):
+                    npages = sum(1 for _ in read_pages(link))
+                    print(f"{link}\t{read_header(link)['id']}\t{npages} pages\t{os.path.getsize(link)} bytes")
+            case "merge":
+                merge(args.path, args.out)
+    except (OSError, ValueError) as e:
+        print(f"pyfive.snapshot: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(argv=sys.argv))
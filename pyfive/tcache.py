@@ -0,0 +1,100 @@
+# The tcache module keeps translated blocks on disk between runs. A cache file
+# belongs to one kernel image: its name is a hash of the image bytes, the
+# python version (marshal is not portable across versions) and the sources
+# the generated code depends on. Each entry stores the guest bytes it was
+# translated from, and is only reused when those bytes are still the ones in
+# dram, so entries for code that was since overwritten are simply skipped.
+
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import zlib
+
+from pyfive import jit
+
+MAGIC = b"PYFIVETC"
+FORMAT_VERSION = 1
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pyfive")
+
+
+def emulator_version():
+    h = hashlib.sha256(sys.implementation.cache_tag.encode())
+    here = os.path.dirname(os.path.realpath(__file__))
+    for name in ("cpu.py", "jit.py", "predecode.py", "util.py"):
+        with open(os.path.join(here, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class TranslationCache():
+    def __init__(self, path):
+        self.path = path
+        # (pc, ppc) -> (guest bytes, ninsts, code object, exits)
+        self.entries = {}
+        self.added = 0
+        self.reused = 0
+
+    @classmethod
+    def for_image(cls, image, cache_dir=DEFAULT_DIR):
+        h = hashlib.sha256(emulator_version().encode())
+        with open(image, "rb") as f:
+            h.update(f.read())
+        cache = cls(os.path.join(cache_dir, h.hexdigest() + ".tc"))
+        cache.load()
+        return cache
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        header = len(MAGIC) + 1 + 32
+        if len(data) < header or data[:len(MAGIC)] != MAGIC or\
+           data[len(MAGIC)] != FORMAT_VERSION:
+            logging.info(f"ignoring translation cache {self.path}: bad header")
+            return
+        digest = data[len(MAGIC) + 1:header]
+        payload = data[header:]
+        if hashlib.sha256(payload).digest() != digest:
+            logging.info(f"ignoring translation cache {self.path}: checksum mismatch")
+            return
+        try:
+            entries = marshal.loads(zlib.decompress(payload))
+        except (ValueError, EOFError, TypeError, zlib.error):
+            logging.info(f"ignoring translation cache {self.path}: corrupted payload")
+            return
+        for pc, ppc, raw, ninsts, code, exits in entries:
+            self.entries[(pc, ppc)] = (raw, ninsts, code, exits)
+
+    def save(self):
+        if not self.added:
+            return
+        entries = [(pc, ppc) + entry for (pc, ppc), entry in self.entries.items()]
+        payload = zlib.compress(marshal.dumps(entries))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + bytes([FORMAT_VERSION]) + hashlib.sha256(payload).digest())
+            f.write(payload)
+        # atomic, so concurrent runs never see a half written file
+        os.replace(tmp, self.path)
+        self.added = 0
+
+    # Returns a ready block for pc if one was cached from the same guest
+    # bytes, which are compared against ram at ppc (relative to dram).
+    def lookup(self, pc, ppc, ram, offset):
+        entry = self.entries.get((pc, ppc))
+        if entry is None:
+            return None
+        raw, ninsts, code, exits = entry
+        if ram[offset:offset + len(raw)] != raw:
+            return None
+        self.reused += 1
+        return jit.Block(pc, ppc, ninsts, code, exits)
+
+    def add(self, blk, raw):
+        self.entries[(blk.pc, blk.ppc)] = (bytes(raw), blk.ninsts, blk.code, list(blk.links))
+        self.added += 1
@@ -0,0 +1,115 @@
+# The tlb module caches Sv39 translations, so a page walk (three pte loads
+# through the bus) only happens the first time a virtual page is touched.
+# Instruction fetches and data accesses have separate tables. Every table
+# belongs to one satp value, so switching between address spaces (as the xv6
+# trampoline does on every trap) just selects another set of tables.
+#
+# Entries are kept coherent with the page tables themselves instead of
+# relying on the guest: the dram pages a walk read its ptes from are watched,
+# and a write to one of them drops every entry derived from it. A cached
+# translation is therefore always the one a fresh walk would return, and
+# sfence.vma has nothing left to invalidate.
+#
+# Only the MAX_SPACES address spaces used last keep their tables: a guest
+# that makes a new page table for every process would otherwise leave one
+# behind for each. Evicting a space also tells the listeners, so blocks
+# translated in it go as well.
+
+from pyfive import dram
+
+# pte permission bits kept in an entry
+PTE_R = 1 << 1
+PTE_W = 1 << 2
+PTE_X = 1 << 3
+PTE_U = 1 << 4
+PTE_PERMS = PTE_R | PTE_W | PTE_X | PTE_U
+# address spaces whose tables are kept
+MAX_SPACES = 32
+
+
+class TLB():
+    def __init__(self, ram, base):
+        self.ram = ram
+        self.base_page = base >> dram.PAGE_SHIFT
+        # satp -> (instruction table, data table), each vpn -> (physical page
+        # address, permission bits); least recently used first
+        self.spaces = {}
+        self.satp = None
+        self.itlb = None
+        self.dtlb = None
+        # physical page of a page table -> (satp, table, vpn) read from it
+        self.pages = {}
+        # called with the satp whose instruction entries were dropped
+        self.listeners = []
+        self.ihits = 0
+        self.imisses = 0
+        self.dhits = 0
+        self.dmisses = 0
+        self.switch(0)
+        ram.add_watcher(self.invalidate_page)
+
+    def switch(self, satp):
+        self.satp = satp
+        space = self.spaces.pop(satp, None)
+        if space is None:
+            space = ({}, {})
+            if len(self.spaces) >= MAX_SPACES:
+                self.evict(next(iter(self.spaces)))
+        self.spaces[satp] = space
+        self.itlb, self.dtlb = space
+
+    # forget the tables of an address space that has not been used for long
+    def evict(self, satp):
+        del self.spaces[satp]
+        for page, users in list(self.pages.items()):
+            kept = [user for user in users if user[0] != satp]
+            if len(kept) != len(users):
+                if kept:
+                    self.pages[page] = kept
+                else:
+                    del self.pages[page]
+        for callback in self.listeners:
+            callback(satp)
+
+    # Cache a translation of the current address space; pt_pages are the
+    # physical addresses of the page table pages the walk read.
+    def insert(self, table, vpn, entry, pt_pages):
+        npages = self.ram.size >> dram.PAGE_SHIFT
+        for addr in pt_pages:
+            if not 0 <= (addr >> dram.PAGE_SHIFT) - self.base_page < npages:
+                # only dram is watched for writes, so never cache a walk
+                # through page tables anywhere else
+                return
+        for addr in pt_pages:
+            page = addr >> dram.PAGE_SHIFT
+            users = self.pages.get(page)
+            if users is None:
+                users = self.pages[page] = []
+                self.ram.watch_page(page - self.base_page)
+            users.append((self.satp, table, vpn))
+        table[vpn] = entry
+
+    # called by dram with the page number relative to the start of dram
+    def invalidate_page(self, page):
+        users = self.pages.pop(page + self.base_page, None)
+        if not users:
+            return
+        dropped = set()
+        for satp, table, vpn in users:
+            if table.pop(vpn, None) is not None and table is self.spaces[satp][0]:
+                dropped.add(satp)
+        for satp in dropped:
+            for callback in self.listeners:
+                callback(satp)
+
+    def flush(self):
+        for satp in self.spaces:
+            for callback in self.listeners:
+                callback(satp)
+        self.spaces.clear()
+        self.pages.clear()
+        self.switch(self.satp)
+
+    def stats(self):
+        return {"itlb_hits": self.ihits, "itlb_misses": self.imisses,
+                "dtlb_hits": self.dhits, "dtlb_misses": self.dmisses}
@@ -0,0 +1,271 @@
+# The trace module keeps a record of what the hart did. Tracing is chosen
+# when the cpu is built (Cpu(bus, trace=Ring(n))): without a tracer the cpu
+# runs its plain step and nothing in the run loop looks at tracing; with one
+# it runs step_traced, on the interpreter, which hands every retired
+# instruction to the tracer, and every trap goes to it as well. A tracer
+# with memory set also hears of every load and store the instruction made.
+#
+# Ring holds the last n records in a preallocated array, four words each:
+# pc, raw instruction, a value and an info word (rd, privilege mode, kind).
+# For an instruction the value is what rd holds after it, for a trap the
+# record has the trapping pc and the cause instead of the instruction. The
+# cpu prints the ring with its registers, on an unhandled exception and on
+# ^C in the cli.
+#
+# BinaryTrace writes every record to a file for offline analysis. After a
+# header, records are five little-endian 64 bit words (DTYPE):
+#
+#   pc, value, addr, data, inst | rd << 32 | mode << 40 | kind << 48 | access << 56
+#
+# value is rd after the instruction, or the cause of a trap. access is the
+# size of the memory access (0 for none) with ACCESS_LOAD/ACCESS_STORE, addr
+# its virtual address and data what was stored. Records pile up in an array
+# and go to a writer thread CHUNK at a time, zlib compressed if asked. read()
+# loads a trace as a numpy structured array, spike() turns it into spike's
+# commit log:
+#
+#   python -m pyfive.trace TRACE [-o OUT]
+
+from array import array
+import argparse
+import queue
+import struct
+import sys
+import threading
+import zlib
+from typing import List
+import numpy as np
+from pyfive import trap
+
+# words per record
+RECORD = 4
+# kinds in the info word
+RETIRE = 0
+TRAP = 1
+INTERRUPT_BIT = 1 << 63
+# opcodes whose rd field is part of something else
+NO_RD = (0x23, 0x27, 0x63, 0x0f)
+MODES = {0: "U", 1: "S", 3: "M"}
+
+MAGIC = b"PYFIVETR"
+VERSION = 1
+# version, flags, record size
+HEADER = struct.Struct("<HHI")
+FLAG_ZLIB = 1
+DTYPE = np.dtype([("pc", "<u8"), ("value", "<u8"), ("addr", "<u8"), ("data", "<u8"),
+                  ("inst", "<u4"), ("rd", "u1"), ("mode", "u1"), ("kind", "u1"), ("access", "u1")])
+WORDS = DTYPE.itemsize // 8
+ACCESS_LOAD = 0x10
+ACCESS_STORE = 0x20
+ACCESS_SIZE = 0xf
+# records handed to the writer thread at a time, about 2.5 MB
+CHUNK = 1 << 16
+# chunks waiting to be written before the cpu waits for the writer
+QUEUE_DEPTH = 4
+
+
+# info word: rd in bits 0-7, mode in 8-15, kind from 16
+def info(kind, mode, rd=0):
+    return kind << 16 | mode << 8 | rd
+
+
+def cause_name(cause):
+    if cause & INTERRUPT_BIT:
+        return trap.INTERRUPT(cause & ~INTERRUPT_BIT).name
+    return trap.EXCEPTION(cause).name
+
+
+# One retired instruction as spike --log-commits prints it.
+def commit_line(mode, pc, inst, rd, value, access=0, addr=0, data=0):
+    line = f"core   0: {mode} 0x{pc:016x} (0x{inst:08x})"
+    if rd and inst & 0x7f not in NO_RD:
+        line += f" x{rd:<2d} 0x{value:016x}"
+    if access & ACCESS_LOAD:
+        line += f" mem 0x{addr:016x}"
+    if access & ACCESS_STORE:
+        line += f" mem 0x{addr:016x} 0x{data:0{2 * (access & ACCESS_SIZE)}x}"
+    return line
+
+
+class Ring():
+    memory = False
+
+    def __init__(self, size):
+        if size <= 0:
+            raise ValueError("trace ring size must be positive")
+        self.size = size
+        self.records = array('Q', bytes(8 * RECORD * size))
+        self.end = RECORD * size
+        # slot of the next record
+        self.next = 0
+        # records made since the start, so a dump knows how many are real
+        self.count = 0
+
+    def retire(self, pc, inst, rd, value, mode):
+        i = self.next
+        records = self.records
+        records[i] = pc
+        records[i + 1] = inst
+        records[i + 2] = value
+        records[i + 3] = mode << 8 | rd
+        i += RECORD
+        self.next = 0 if i == self.end else i
+        self.count += 1
+
+    def trap(self, pc, cause, mode):
+        i = self.next
+        self.records[i:i + RECORD] = array('Q', (pc, cause, 0, info(TRAP, mode)))
+        i += RECORD
+        self.next = 0 if i == self.end else i
+        self.count += 1
+
+    # (kind, mode, pc, inst or cause, rd, value), oldest first
+    def entries(self):
+        n = min(self.count, self.size)
+        start = (self.next - RECORD * n) % self.end
+        out = []
+        for k in range(n):
+            i = (start + RECORD * k) % self.end
+            pc, inst, value, word = self.records[i:i + RECORD]
+            out.append((word >> 16, (word >> 8) & 0xff, pc, inst, word & 0xff, value))
+        return out
+
+    # in the style of spike's commit log
+    def format(self, entry):
+        kind, mode, pc, inst, rd, value = entry
+        if kind == TRAP:
+            return f"core   0: {MODES.get(mode, mode)} trap {cause_name(inst)}, epc 0x{pc:016x}"
+        return commit_line(mode, pc, inst, rd, value)
+
+    def dump(self, file=None):
+        file = file if file is not None else sys.stdout
+        print(f"=====================trace================ last {min(self.count, self.size)} "
+              f"of {self.count}", file=file)
+        for entry in self.entries():
+            print(self.format(entry), file=file)
+
+
+class BinaryTrace():
+    memory = True
+
+    def __init__(self, path, compress=False, chunk=CHUNK):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + HEADER.pack(VERSION, FLAG_ZLIB if compress else 0, DTYPE.itemsize))
+        self.compress = compress
+        self.limit = chunk * WORDS
+        self.records = array('Q')
+        # the memory access of the instruction being run
+        self.access = 0
+        self.addr = 0
+        self.data = 0
+        self.count = 0
+        self.chunks = queue.Queue(QUEUE_DEPTH)
+        self.writer = threading.Thread(target=self.write_chunks, name="trace", daemon=True)
+        self.writer.start()
+
+    def load(self, addr, size):
+        self.access |= ACCESS_LOAD | size
+        self.addr = addr
+
+    def store(self, addr, size, data):
+        self.access |= ACCESS_STORE | size
+        self.addr = addr
+        self.data = data & ((1 << (8 * size)) - 1)
+
+    def retire(self, pc, inst, rd, value, mode):
+        self.records.extend((pc, value, self.addr, self.data,
+                             inst | rd << 32 | mode << 40 | self.access << 56))
+        if self.access:
+            self.access = self.addr = self.data = 0
+        self.count += 1
+        if len(self.records) >= self.limit:
+            self.chunks.put(self.records)
+            self.records = array('Q')
+
+    def trap(self, pc, cause, mode):
+        # an access the instruction made before it trapped did not retire
+        self.access = self.addr = self.data = 0
+        self.records.extend((pc, cause, 0, 0, TRAP << 48 | mode << 40))
+        self.count += 1
+        if len(self.records) >= self.limit:
+            self.chunks.put(self.records)
+            self.records = array('Q')
+
+    def write_chunks(self):
+        compressor = zlib.compressobj() if self.compress else None
+        while True:
+            records = self.chunks.get()
+            if records is None:
+                break
+            if sys.byteorder == "big":
+                records.byteswap()
+            data = records.tobytes()
+            self.file.write(compressor.compress(data) if compressor else data)
+        if compressor:
+            self.file.write(compressor.flush())
+        self.file.close()
+
+    def dump(self, file=None):
+        file = file if file is not None else sys.stdout
+        print(f"=====================trace================ {self.count} records to {self.path}", file=file)
+
+    # write out what is left and wait for the writer; safe to call twice
+    def close(self):
+        if self.records is None:
+            return
+        if self.records:
+            self.chunks.put(self.records)
+        self.records = None
+        self.chunks.put(None)
+        self.writer.join()
+
+
+# A trace file as a numpy array of DTYPE records.
+def read(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a pyfive trace")
+    version, flags, size = HEADER.unpack_from(data, len(MAGIC))
+    if version != VERSION or size != DTYPE.itemsize:
+        raise ValueError(f"{path}: unsupported trace version {version}")
+    data = data[len(MAGIC) + HEADER.size:]
+    if flags & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    if len(data) % size:
+        raise ValueError(f"{path}: truncated trace")
+    return np.frombuffer(data, dtype=DTYPE)
+
+
+# The retired instructions of records, in spike's commit log format, one
+# line each; traps are not commits and are left out.
+def spike(records):
+    for r in records[records["kind"] == RETIRE].tolist():
+        pc, value, addr, data, inst, rd, mode, _kind, access = r
+        yield commit_line(mode, pc, inst, rd, value, access, addr, data)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="pyfive.trace",
+                                     description="convert a pyfive binary trace to a spike commit log")
+    parser.add_argument("trace", help="trace file written with --trace-file")
+    parser.add_argument("-o", "--output", help="commit log file (default: stdout)")
+    args = parser.parse_args(argv[1:])
+    try:
+        records = read(args.trace)
+    except (OSError, ValueError, zlib.error) as e:
+        print(f"pyfive.trace: {e}", file=sys.stderr)
+        return 1
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for line in spike(records):
+            print(line, file=out)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(argv=sys.argv))
@@ -1,70 +1,206 @@
+# The uart module is the console device. Output is collected in a buffer and
+# written to the console backend (see console.py) at a newline, once
+# TX_BUFFER bytes have piled up, when the cpu polls its devices and when the
+# hart goes idle. Input is read from the backend on the cpu thread, when the
+# plic finds its input file ready, and handed to the guest through the
+# receive fifo of a 16550.
+
 from enum import Enum
-import numpy as np
-import threading
+import collections
 import sys
-import time
-import copy
-import os
+from pyfive import console
 
 class UART(Enum):
     RHR = 0
     THR = 0
+    IER = 1
+    IIR = 2
+    FCR = 2
     LCR = 3
+    MCR = 4
     LSR = 5
+    MSR = 6
+    SCR = 7
     LSR_RX = 1
     LSR_TX = 1 << 5
     IRQ = 10
 
-def keyboard_thread(uart):
-    while True:
-        c = sys.stdin.read(1)
-        if len(c) == 0:
-            print("keyboard exit")
-            os.abort()
-        while (uart.regs[UART.LSR.value] & np.uint64(UART.LSR_RX.value)) == 1:
-             uart.cond.acquire()
-             uart.cond.wait()
-             uart.cond.release()
-        uart.mutex.acquire()
-        uart.regs[UART.RHR.value] = np.uint64(ord(c))
-        uart.intr = True
-        uart.regs[UART.LSR.value] |= np.uint64(UART.LSR_RX.value)
-        uart.mutex.release()
-        #print("keyboard get=====", ord(c))
+# output bytes held back before a write to the console
+TX_BUFFER = 4096
+NEWLINE = ord("\n")
+
+# 16550 registers: interrupt enable bits, interrupt ids in IIR (lowest bit
+# clear when one is pending), fifo control bits and trigger levels
+FIFO_SIZE = 16
+IER_RX = 1
+IER_THRE = 1 << 1
+IIR_NONE = 0x1
+IIR_THRE = 0x2
+IIR_RX = 0x4
+IIR_TIMEOUT = 0xc
+IIR_FIFO = 0xc0
+FCR_ENABLE = 1
+FCR_CLEAR_RX = 1 << 1
+TRIGGER_LEVELS = (1, 4, 8, 14)
+LCR_DLAB = 1 << 7
+# transmitter empty: output goes out as soon as it is written
+LSR_TEMT = 1 << 6
 
 class Uart():
-    def __init__(self, size):
-        self.regs = [np.uint64(0)] * size
-        self.cond = threading.Condition()
-        self.thread = threading.Thread(target=keyboard_thread,
-                                       args=(self,))
-        self.regs[UART.LSR.value] |= np.uint64(UART.LSR_TX.value)
-        self.intr = False
-        self.mutex = threading.Lock()
-        self.thread.setDaemon(True)
-        self.thread.start()
-
-    def is_interrupting(self):
-        if self.intr:
-            self.intr = False
-            return True
-        return False
+    # A 16550 with its fifos: received bytes wait in a 16 byte fifo and the
+    # interrupt goes up once it holds the trigger level, or when a few
+    # bytes sit below it with nothing happening for a while (the character
+    # timeout, here a whole device poll without a byte coming or going).
+    # Bytes beyond the fifo wait in pending and move in as the guest reads.
+    # The transmit fifo empties as soon as it is written, so its interrupt
+    # is pending whenever it is enabled, until the guest reads IIR or
+    # writes THR. Without a console, output is dropped and input only
+    # comes from push_input.
+    def __init__(self, size, plic, backend=None):
+        self.regs = [0] * size
+        self.plic = plic
+        self.rx = collections.deque()
+        self.fcr = 0
+        # divisor latch, at offsets 0 and 1 while LCR_DLAB is set
+        self.dll = 0
+        self.dlm = 0
+        self.thre_pending = False
+        self.timeout = False
+        # whether a byte came in or went to the guest since the last poll
+        self.rx_active = False
+        # called with every byte the guest writes to the console
+        self.output_hooks = []
+        self.txbuf = bytearray()
+        # bytes read or queued by push_input that do not fit in the fifo
+        self.pending = collections.deque()
+        self.console = None
+        self.watched = None
+        self.set_console(backend if backend is not None else console.Console())
+
+    # Switch to another backend, e.g. a fork leaving its parent's terminal
+    # alone; output still buffered goes to the old one.
+    def set_console(self, backend):
+        if self.console is not None:
+            self.flush()
+        if self.watched is not None:
+            self.plic.unwatch(self.watched)
+            self.watched = None
+        self.console = backend
+        if backend.input() is not None:
+            self.watched = backend.input()
+            self.plic.watch(self.watched, self)
+
+    def flush(self):
+        if self.txbuf:
+            self.console.write(bytes(self.txbuf))
+            self.txbuf.clear()
+
+    def close(self):
+        self.flush()
+        self.set_console(console.Console())
+
+    def save_state(self):
+        return {"regs": list(self.regs), "pending": list(self.pending), "rx": list(self.rx),
+                "fcr": self.fcr, "dll": self.dll, "dlm": self.dlm,
+                "thre_pending": self.thre_pending, "timeout": self.timeout}
+
+    def load_state(self, state):
+        self.regs[:] = state["regs"]
+        self.pending = collections.deque(state.get("pending", []))
+        self.rx = collections.deque(state.get("rx", []))
+        self.fcr = state.get("fcr", 0)
+        self.dll = state.get("dll", 0)
+        self.dlm = state.get("dlm", 0)
+        self.thre_pending = state.get("thre_pending", False)
+        self.timeout = state.get("timeout", False)
+        if not self.rx and self.regs[UART.LSR.value] & UART.LSR_RX.value:
+            # saved before the fifo: the byte was in RHR
+            self.rx.append(self.regs[UART.RHR.value])
+        self.update_irq()
+
+    # Queue input for the guest besides what the console gives, e.g. the
+    # commands of a scripted run. On the cpu thread.
+    def push_input(self, data):
+        self.pending.extend(data)
+        self.refill()
+
+    def depth(self):
+        return FIFO_SIZE if self.fcr & FCR_ENABLE else 1
+
+    def trigger(self):
+        return TRIGGER_LEVELS[self.fcr >> 6] if self.fcr & FCR_ENABLE else 1
+
+    def refill(self):
+        if self.pending and len(self.rx) < self.depth():
+            while self.pending and len(self.rx) < self.depth():
+                self.rx.append(self.pending.popleft())
+            self.rx_active = True
+            self.update_irq()
+
+    def iir(self):
+        ier = self.regs[UART.IER.value]
+        iir = IIR_NONE
+        if ier & IER_RX and self.rx and len(self.rx) >= self.trigger():
+            iir = IIR_RX
+        elif ier & IER_RX and self.rx and self.timeout:
+            iir = IIR_TIMEOUT
+        elif ier & IER_THRE and self.thre_pending:
+            iir = IIR_THRE
+        return iir | IIR_FIFO if self.fcr & FCR_ENABLE else iir
+
+    # the line is up while IIR has an interrupt to report
+    def update_irq(self):
+        if self.iir() & IIR_NONE:
+            self.plic.lower_irq(UART.IRQ.value)
+        else:
+            self.plic.raise_irq(UART.IRQ.value)
+
+    # on the cpu thread, when the console's input is ready
+    def service(self):
+        data = self.console.read()
+        if self.console.input() is None and self.watched is not None:
+            # end of input
+            self.plic.unwatch(self.watched)
+            self.watched = None
+        self.push_input(data)
+
+    # Called at every device poll: flush output and time out bytes waiting
+    # below the trigger level.
+    def poll(self):
+        self.flush()
+        if self.rx_active:
+            self.rx_active = False
+        elif self.rx and not self.timeout:
+            self.timeout = True
+            self.update_irq()
 
     def load(self, addr, size):
         if size != 1:
             print("uart load size error, size is ", size)
             sys.exit(0)
+        dlab = self.regs[UART.LCR.value] & LCR_DLAB
         match addr:
+            case UART.RHR.value if dlab:
+                return self.dll
+            case UART.IER.value if dlab:
+                return self.dlm
             case UART.RHR.value:
-                self.mutex.acquire()
-                self.regs[UART.LSR.value] &= ~(np.uint64(UART.LSR_RX.value))
-                ret = copy.deepcopy(self.regs[UART.RHR.value])
-                self.mutex.release()
-                #print("uart get=====", ret)
-                self.cond.acquire()
-                self.cond.notify()
-                self.cond.release()
+                ret = self.rx.popleft() if self.rx else 0
+                self.rx_active = True
+                self.timeout = False
+                self.refill()
+                self.update_irq()
                 return ret
+            case UART.IIR.value:
+                iir = self.iir()
+                if iir & 0xf == IIR_THRE:
+                    # reading it is the acknowledgement
+                    self.thre_pending = False
+                    self.update_irq()
+                return iir
+            case UART.LSR.value:
+                lsr = UART.LSR_TX.value | LSR_TEMT
+                return lsr | UART.LSR_RX.value if self.rx else lsr
             case other:
                 return self.regs[addr]
 
@@ -72,9 +208,38 @@ class Uart():
         if size != 1:
             print("uart store size error, size is ", size)
             sys.exit(0)
-        data = int.from_bytes(data, byteorder='little', signed=False)
+        if isinstance(data, bytes) or isinstance(data, bytearray):
+            data = int.from_bytes(data, byteorder='little', signed=False)
+        data &= 0xff
+        dlab = self.regs[UART.LCR.value] & LCR_DLAB
         match addr:
+            case UART.THR.value if dlab:
+                self.dll = data
+            case UART.IER.value if dlab:
+                self.dlm = data
             case UART.THR.value:
-                print(chr(data), end="")
+                self.txbuf.append(data)
+                if data == NEWLINE or len(self.txbuf) >= TX_BUFFER:
+                    self.flush()
+                for hook in self.output_hooks:
+                    hook(data)
+                # gone at once, the fifo is empty again
+                self.thre_pending = True
+                self.update_irq()
+            case UART.IER.value:
+                if data & IER_THRE and not self.regs[addr] & IER_THRE:
+                    self.thre_pending = True
+                self.regs[addr] = data & 0xf
+                self.update_irq()
+            case UART.FCR.value:
+                if (data ^ self.fcr) & FCR_ENABLE or data & FCR_CLEAR_RX:
+                    self.rx.clear()
+                    self.timeout = False
+                # the clear bits do not stick
+                self.fcr = data & 0xc9
+                self.refill()
+                self.update_irq()
+            case UART.LSR.value:
+                pass
             case other:
-                self.regs[addr] = np.uint64(data)
+                self.regs[addr] = data
@@ -5,3 +5,25 @@ def complement_code(num, bits):
 # ((255+128)&0xff)-128 is -1
 def original_code(num, bits):
     return ((num+(1 << bits - 1)) & ((1 << bits) - 1)) - (1 << bits - 1)
+
+
+# Fast helpers for registers held as unsigned 64-bit python ints.
+MASK32 = (1 << 32) - 1
+MASK64 = (1 << 64) - 1
+
+
+# the signed value of a 64-bit register
+def signed64(num):
+    return num - (1 << 64) if num >> 63 else num
+
+
+# the signed value of the low 32 bits
+def signed32(num):
+    num &= MASK32
+    return num - (1 << 32) if num >> 31 else num
+
+
+# sign extend the low 32 bits to a 64-bit register value
+def sext32(num):
+    num &= MASK32
+    return num | 0xffff_ffff_0000_0000 if num >> 31 else num
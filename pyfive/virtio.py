@@ -1,9 +1,12 @@
 from enum import Enum
-from pyfive import dram
+from pyfive import disk
 from pyfive import trap
-from pyfive import bus
+from pyfive import virtqueue
+import collections
+import concurrent.futures
 import logging
-import numpy as np
+import os
+import struct
 
 class VIRTIO(Enum):
     MAGIC = 0x000
@@ -30,11 +33,34 @@ class VIRTIO(Enum):
     MMIO_DEVICE_DESC_HIGH = 0x0a4
     IRQ = 1
 
-class Virtio():
-    def __init__(self, size, bus, disk_bin):
+# virtio_blk_outhdr request types
+VIRTIO_BLK_T_IN = 0
+VIRTIO_BLK_T_OUT = 1
+VIRTIO_BLK_T_FLUSH = 4
+VIRTIO_BLK_F_FLUSH = 1 << 9
+# request status written back to the guest
+VIRTIO_BLK_S_OK = 0
+VIRTIO_BLK_S_IOERR = 1
+VIRTIO_BLK_S_UNSUPP = 2
+
+# the queue size offered by default in QUEUE_NUM_MAX
+QUEUE_SIZE = 64
+# virtio_blk_outhdr: type, reserved, sector
+BLK_HEADER = struct.Struct('<IIQ')
+
+# The virtio-mmio transport: the registers, the virtqueues and the interrupt
+# of a device. Devices subclass it with their DEVICE_ID, features and what a
+# notify of one of their queues does; the driver picks a queue with
+# QUEUE_SEL, and its addresses are taken when it is made ready. Device
+# configuration space, from CONFIG on, goes to config_load/config_store.
+class VirtioMmio():
+    DEVICE_ID = 0
+    CONFIG = 0x100
+
+    def __init__(self, size, bus, irq, queue_sizes):
         self.size = size  # not use
         self.bus = bus
-        self.id = 0
+        self.irq = irq
         self.driver_features = 0
         self.page_size = 4096
         self.queue_sel = 0
@@ -44,10 +70,55 @@ class Virtio():
         self.queue_rdy = 0
         self.status = 0
         self.intr_status = 0
-        self.intr_ack = 0
-        self.disk = dram.Memory(0x40_0000, disk_bin)  # 4M disk
+        self.queue_desc_low = 0
+        self.queue_desc_high = 0
+        self.driver_desc_low = 0
+        self.driver_desc_high = 0
+        self.device_desc_low = 0
+        self.device_desc_high = 0
+        self.queues = [virtqueue.Virtqueue(bus, queue_size) for queue_size in queue_sizes]
+        self.queue = self.queues[0]
+
+    # registers that hold state, in the order saved
+    STATE = ("driver_features", "page_size", "queue_sel", "queue_num", "queue_pfn",
+             "queue_notify", "queue_rdy", "status", "intr_status", "queue_desc_low",
+             "queue_desc_high", "driver_desc_low", "driver_desc_high", "device_desc_low",
+             "device_desc_high")
+
+    def save_state(self):
+        state = {name: getattr(self, name) for name in self.STATE}
+        state["queue"] = self.queue.save_state()
+        state["queues"] = [queue.save_state() for queue in self.queues[1:]]
+        return state
+
+    def load_state(self, state):
+        for name in self.STATE:
+            setattr(self, name, state[name])
+        self.queue.load_state(state["queue"])
+        for queue, queue_state in zip(self.queues[1:], state.get("queues", [])):
+            queue.load_state(queue_state)
+
+    def features(self):
+        return 0
+
+    # Called on a notify of queue index: serve what the driver made
+    # available there, returning the number of chains completed.
+    def notify(self, index):
+        return 0
+
+    def config_load(self, offset, size):
+        return 0
+
+    def config_store(self, offset, size, value):
+        pass
+
+    # the device part of a reset, the queues are reset already
+    def reset(self):
+        pass
 
     def load(self, addr, size):
+        if addr >= self.CONFIG:
+            return self.config_load(addr - self.CONFIG, size)
         if size != 4:
             return trap.EXCEPTION.LoadAccessFault
         value = 0
@@ -57,15 +128,16 @@ class Virtio():
             case VIRTIO.VERSION:
                 value = 0x2
             case VIRTIO.DEVICE_ID:
-                value = 0x2
+                value = self.DEVICE_ID
             case VIRTIO.VENDOR_ID:
                 value = 0x554d4551
             case VIRTIO.DEVICE_FEATURES:
-                value = 0
+                value = self.features()
             case VIRTIO.DRIVER_FEATURES:
                 value = self.driver_features
             case VIRTIO.QUEUE_NUM_MAX:
-                value = 8
+                if self.queue_sel < len(self.queues):
+                    value = self.queues[self.queue_sel].max_size
             case VIRTIO.QUEUE_PFN:
                 value = self.queue_pfn
             case VIRTIO.QUEUE_READY:
@@ -74,19 +146,19 @@ class Virtio():
                 value = self.status
             case VIRTIO.MMIO_INTERRUPT_STATUS:
                 value = self.intr_status
-            case VIRTIO.MMIO_INTERRUPT_ACK:
-                value = self.intr_ack
             case other:
                 pass
         return value
 
     def store(self, addr, size, data):
+        if isinstance(data, bytes) or isinstance(data, bytearray):
+            data = int.from_bytes(data, byteorder='little', signed=False)
+        if addr >= self.CONFIG:
+            return self.config_store(addr - self.CONFIG, size, data)
         if size != 4:
             return trap.EXCEPTION.StoreAMOPageFault
-        if isinstance(data, bytes):
-            data = int.from_bytes(data, byteorder='little', signed=False)
         match VIRTIO(addr):
-            case VIRTIO.DEVICE_FEATURES:
+            case VIRTIO.DRIVER_FEATURES:
                 self.driver_features = data
             case VIRTIO.GUEST_PAGE_SIZE:
                 self.page_size = data
@@ -98,100 +170,243 @@ class Virtio():
                 self.queue_pfn = data
             case VIRTIO.QUEUE_NOTIFY:
                 self.queue_notify = data
-                logging.debug(f"quenum notify is {data}")
+                if data < len(self.queues):
+                    self.signal(self.notify(data), self.queues[data])
             case VIRTIO.QUEUE_READY:
                 self.queue_rdy = data
-            case VIRTIO.MMIO_INTERRUPT_STATUS:
-                self.intr_status = data
+                if data and self.queue_sel < len(self.queues):
+                    self.setup_queue(self.queues[self.queue_sel])
             case VIRTIO.MMIO_INTERRUPT_ACK:
-                self.intr_ack = data
+                self.intr_status &= ~data
+                if not self.intr_status:
+                    self.bus.plic.lower_irq(self.irq)
             case VIRTIO.STATUS:
                 self.status = data
+                if data == 0:
+                    # a device reset forgets the queues
+                    for queue in self.queues:
+                        queue.reset()
+                    self.reset()
+                    self.intr_status = 0
+                    self.bus.plic.lower_irq(self.irq)
             case VIRTIO.MMIO_QUEUE_DESC_LOW:
                 self.queue_desc_low = data
             case VIRTIO.MMIO_QUEUE_DESC_HIGH:
                 self.queue_desc_high = data
             case VIRTIO.MMIO_DRIVER_DESC_LOW:
-                logging.debug(f"driver desc low addr {hex(data)}")
                 self.driver_desc_low = data
             case VIRTIO.MMIO_DRIVER_DESC_HIGH:
-                logging.debug(f"driver desc high addr {hex(data)}")
                 self.driver_desc_high = data
             case VIRTIO.MMIO_DEVICE_DESC_LOW:
                 self.device_desc_low = data
             case VIRTIO.MMIO_DEVICE_DESC_HIGH:
                 self.device_desc_high = data
 
-    def is_interrupting(self):
-        if self.queue_notify == 0:
-            self.queue_notify = 1
-            return True
-        return False
+    # Raise the interrupt for chains of queue just completed, unless the
+    # driver asked not to hear about them: one interrupt for the whole batch.
+    def signal(self, completed, queue=None):
+        queue = queue or self.queue
+        if completed and not queue.interrupt_suppressed():
+            self.intr_status |= 1
+            self.bus.plic.raise_irq(self.irq)
 
-    def get_new_id(self):
-        # self.id = (self.id + 1) % self.queue_num
-        self.id = (self.id + 1)
-        return self.id
+    # point queue at the rings whose addresses are in the registers
+    def setup_queue(self, queue):
+        queue.desc = self.desc_addr()
+        queue.avail = self.avail_addr()
+        queue.used = self.used_addr()
+        if 0 < self.queue_num <= queue.max_size:
+            queue.num = self.queue_num
 
-    def read_disk(self, addr):
-        return self.disk.load(addr, 1)
+    def desc_addr(self):
+        return ((self.queue_desc_high << 32) + self.queue_desc_low) & 0xffffffffffffffff
 
+    def avail_addr(self):
+        return ((self.driver_desc_high << 32) + self.driver_desc_low) & 0xffffffffffffffff
 
-    def write_disk(self, addr, data):
-        self.disk.store(addr, 1, data)
+    def used_addr(self):
+        return ((self.device_desc_high << 32) + self.device_desc_low) & 0xffffffffffffffff
 
 
-    def desc_addr(self):
-        return int(np.uint64((self.queue_desc_high << 32) + self.queue_desc_low))
+# The block device, on the first slot at VIRTIO_BASE.
+class Virtio(VirtioMmio):
+    DEVICE_ID = 2
 
-    def avail_addr(self):
-        return int(np.uint64((self.driver_desc_high << 32) + self.driver_desc_low))
+    def __init__(self, size, bus, disk_bin, queue_size=QUEUE_SIZE, io_workers=0):
+        super().__init__(size, bus, VIRTIO.IRQ.value, [queue_size])
+        # disk_bin is an image path, or a disk already set up (an overlay)
+        if disk_bin is None or isinstance(disk_bin, (str, os.PathLike)):
+            self.disk = disk.Disk(disk_bin)
+        else:
+            self.disk = disk_bin
+        # Requests run synchronously on the cpu thread unless io_workers is
+        # given, in which case a pool does the disk i/o while the guest keeps
+        # running. inflight holds the (request, future) pairs not completed
+        # yet, in the order the driver made them available.
+        self.io_workers = io_workers
+        self.pool = None
+        if io_workers:
+            self.pool = concurrent.futures.ThreadPoolExecutor(io_workers, thread_name_prefix="virtio")
+        self.inflight = collections.deque()
 
-    def used_addr(self):
-        return int(np.uint64((self.device_desc_high << 32) + self.device_desc_low))
+    # Requests in flight are finished first, so the state is the registers
+    # and the position of the queue; the disk itself is not part of it.
+    def save_state(self):
+        self.signal(self.drain())
+        return super().save_state()
+
+    def load_state(self, state):
+        self.drain()
+        super().load_state(state)
+
+    def features(self):
+        return VIRTIO_BLK_F_FLUSH
 
+    def notify(self, index):
+        return self.disk_access()
+
+    # called on the cpu thread after async requests finished
+    def service(self):
+        self.signal(self.retire())
+
+    # Take every request chain the driver made available. Synchronously they
+    # are carried out right away; in async mode they are handed to the
+    # worker pool and retired later. Returns the number of chains completed.
     def disk_access(self):
-        logging.debug("disk access")
-        VRING_DESC_SIZE = 16
-        desc_addr = self.desc_addr()
-        avail_addr = self.avail_addr()
-        used_addr = self.used_addr()
-
-        offset = self.bus.loadint(avail_addr + 2, 2)
-        # logging.debug(f"busload avail addr {hex(avail_addr)}  offset is {offset}")
-        # ring
-        index = self.bus.loadint(avail_addr + 4 + offset, 2)
-
-        desc_addr0 = desc_addr + VRING_DESC_SIZE * index
-        addr0 = self.bus.loadint(desc_addr0, 8)
-        next0 = self.bus.loadint(desc_addr0 + 14, 2)
-
-        desc_addr1 = desc_addr + VRING_DESC_SIZE * next0
-        addr1 = self.bus.loadint(desc_addr1, 8)
-        len1 = self.bus.loadint(desc_addr1 + 8, 4)
-        flag1 = self.bus.loadint(desc_addr1 + 12, 2)
-
-        blk_sector = self.bus.loadint(addr0 + 8, 8)
-
-        match (int(flag1) & 2) == 0:
-            case True:
-                for i in range(len1):
-                    data = self.bus.load(addr1 + i, 1)
-                    self.write_disk(blk_sector * 512 + i, data)
-            case False:
-                for i in range(len1):
-                    data = self.read_disk(blk_sector * 512 + i)
-                    self.bus.store(addr1 + i, 1, data)
-
-        # device write 0 on success
-        next1 = self.bus.loadint(desc_addr1 + 14, 2)
-        desc_addr2 = desc_addr + VRING_DESC_SIZE * next1
-        addr2 = self.bus.loadint(desc_addr2, 8)
-        logging.debug(f"next1 idx is {next1}")
-        logging.debug(f"desc addr2  / info0 status addr is {hex(int(desc_addr2))}")
-        logging.debug(f"write {hex(addr2)} to 0")
-        self.bus.store(addr2, 2, 0)
-
-        new_id = self.get_new_id()
-        logging.debug(f"new id is {new_id}")
-        self.bus.store(used_addr + 2, 2, new_id)
+        queue = self.queue
+        # the single queue, whether or not the driver made it ready
+        self.setup_queue(queue)
+        completed = 0
+        for head in queue.pop_available():
+            req = self.parse_chain(head, queue.chain(head))
+            if self.pool is None:
+                self.execute(req)
+                self.complete(req)
+                completed += 1
+            else:
+                self.submit(req)
+        return completed
+
+    # Turn a chain into a BlockRequest: a readable header, any number of data
+    # buffers and a writable status byte at its end. Everything that can be
+    # checked up front is, so executing it only moves the data.
+    def parse_chain(self, head, buffers):
+        req = BlockRequest(head)
+        if not buffers or len(buffers) < 2 or buffers[0][1] < BLK_HEADER.size or\
+           not buffers[-1][2] & virtqueue.VIRTQ_DESC_F_WRITE:
+            logging.debug("malformed block request")
+            return req
+        header = self.bus.dma_read(buffers[0][0], BLK_HEADER.size)
+        if isinstance(header, trap.EXCEPTION):
+            return req
+        status_addr, status_len, _flags = buffers[-1]
+        req.status_addr = status_addr + status_len - 1
+        req.req_type, _reserved, sector = BLK_HEADER.unpack(header)
+        if req.req_type == VIRTIO_BLK_T_FLUSH:
+            return req
+        if req.req_type != VIRTIO_BLK_T_IN and req.req_type != VIRTIO_BLK_T_OUT:
+            req.status = VIRTIO_BLK_S_UNSUPP
+            return req
+        offset = sector * disk.SECTOR_SIZE
+        for addr, length, flags in buffers[1:-1]:
+            # reads fill writable buffers, writes drain readable ones
+            if bool(flags & virtqueue.VIRTQ_DESC_F_WRITE) != (req.req_type == VIRTIO_BLK_T_IN) or\
+               not self.disk.in_range(offset, length) or not self.bus.in_dram(addr, length):
+                req.status = VIRTIO_BLK_S_IOERR
+                req.segments = []
+                return req
+            req.segments.append((offset, addr, length))
+            offset += length
+        return req
+
+    # Move the data of a request, one copy per buffer between the disk and
+    # dram. Runs on a worker thread in async mode, so it must not touch
+    # anything but the disk and the raw dram buffers; see complete.
+    def execute(self, req):
+        if req.status != VIRTIO_BLK_S_OK or req.status_addr is None:
+            return
+        try:
+            if req.req_type == VIRTIO_BLK_T_FLUSH:
+                self.disk.flush()
+            for offset, addr, length in req.segments:
+                view = self.bus.ram.view(addr - self.bus.dram_base, length)
+                if req.req_type == VIRTIO_BLK_T_IN:
+                    self.disk.read_into(offset, view)
+                else:
+                    self.disk.write_from(offset, view)
+        except OSError as e:
+            logging.warning(f"virtio disk i/o failed: {e}")
+            req.status = VIRTIO_BLK_S_IOERR
+
+    # Hand a finished request back to the driver, on the cpu thread: tell
+    # dram's watchers about the buffers that were filled, store the status
+    # and push the used ring element.
+    def complete(self, req):
+        written = 0
+        if req.status_addr is not None:
+            if req.req_type == VIRTIO_BLK_T_IN and req.status == VIRTIO_BLK_S_OK:
+                for offset, addr, length in req.segments:
+                    self.bus.ram.notify_write(addr - self.bus.dram_base, length)
+                    written += length
+            self.bus.dma_write(req.status_addr, bytes([req.status]))
+            written += 1
+        self.queue.push_used(req.head, written)
+
+    def submit(self, req):
+        # requests touching the same disk blocks or guest buffers as one in
+        # flight (and flushes, with everything) wait for it, so the data
+        # ends up as if they ran one after the other
+        deps = [future for other, future in self.inflight if req.conflicts(other)]
+        future = self.pool.submit(self.run_after, deps, req)
+        self.inflight.append((req, future))
+        future.add_done_callback(lambda _future: self.bus.plic.request_service(self))
+
+    def run_after(self, deps, req):
+        concurrent.futures.wait(deps)
+        self.execute(req)
+
+    # complete the requests that are done, in the order they were made
+    # available, as the synchronous mode does
+    def retire(self):
+        completed = 0
+        while self.inflight and self.inflight[0][1].done():
+            req, _future = self.inflight.popleft()
+            self.complete(req)
+            completed += 1
+        return completed
+
+    # wait for every request in flight and complete it
+    def drain(self):
+        completed = 0
+        while self.inflight:
+            concurrent.futures.wait([self.inflight[0][1]])
+            completed += self.retire()
+        return completed
+
+    def close(self):
+        self.drain()
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.disk.close()
+
+
+class BlockRequest():
+    def __init__(self, head):
+        self.head = head
+        self.req_type = None
+        self.status = VIRTIO_BLK_S_OK
+        # guest address of the status byte, None for a malformed chain
+        self.status_addr = None
+        # (disk offset, guest address, length) of every data buffer
+        self.segments = []
+
+    def conflicts(self, other):
+        if self.req_type == VIRTIO_BLK_T_FLUSH or other.req_type == VIRTIO_BLK_T_FLUSH:
+            return True
+        for offset, addr, length in self.segments:
+            for other_offset, other_addr, other_length in other.segments:
+                if offset < other_offset + other_length and other_offset < offset + length:
+                    return True
+                if addr < other_addr + other_length and other_addr < addr + length:
+                    return True
+        return False
@@ -0,0 +1,128 @@
+# The virtio_console module is a virtio console device (without multiport)
+# on the virtio-mmio transport: the driver hands the device whole buffers of
+# output on the transmit queue and empty buffers for input on the receive
+# queue, so console traffic costs a notify per batch of buffers instead of a
+# uart access per byte. It talks to a console backend like the uart does
+# (see console.py), with output written as one chunk per notify and input
+# read when the plic finds the backend's input file ready.
+
+from enum import Enum
+import collections
+from pyfive import console
+from pyfive import trap
+from pyfive import virtio
+from pyfive import virtqueue
+
+class VCONSOLE(Enum):
+    DEVICE_ID = 3
+    RECEIVEQ = 0
+    TRANSMITQ = 1
+    IRQ = 2
+
+
+class VirtioConsole(virtio.VirtioMmio):
+    DEVICE_ID = VCONSOLE.DEVICE_ID.value
+
+    def __init__(self, size, bus, backend=None, queue_size=virtio.QUEUE_SIZE):
+        super().__init__(size, bus, VCONSOLE.IRQ.value, [queue_size, queue_size])
+        # host input not in a guest buffer yet
+        self.pending = bytearray()
+        # (head, buffers) of the receive chains the driver made available
+        self.rx_chains = collections.deque()
+        self.console = None
+        self.watched = None
+        self.set_console(backend if backend is not None else console.Console())
+
+    def set_console(self, backend):
+        if self.watched is not None:
+            self.bus.plic.unwatch(self.watched)
+            self.watched = None
+        self.console = backend
+        if backend.input() is not None:
+            self.watched = backend.input()
+            self.bus.plic.watch(self.watched, self)
+
+    def close(self):
+        self.set_console(console.Console())
+
+    # Receive chains taken off the ring are part of the state, by head.
+    def save_state(self):
+        state = super().save_state()
+        state["pending"] = list(self.pending)
+        state["rx_heads"] = [head for head, _buffers in self.rx_chains]
+        return state
+
+    def load_state(self, state):
+        super().load_state(state)
+        self.pending = bytearray(state.get("pending", []))
+        receiveq = self.queues[VCONSOLE.RECEIVEQ.value]
+        self.rx_chains = collections.deque((head, receiveq.chain(head))
+                                           for head in state.get("rx_heads", []))
+
+    def reset(self):
+        self.rx_chains.clear()
+
+    def notify(self, index):
+        queue = self.queues[index]
+        match index:
+            case VCONSOLE.RECEIVEQ.value:
+                for head in queue.pop_available():
+                    self.rx_chains.append((head, queue.chain(head)))
+                return self.receive()
+            case VCONSOLE.TRANSMITQ.value:
+                return self.transmit()
+        return 0
+
+    # Write the readable buffers of every chain made available to the
+    # console in one go, and hand the chains back.
+    def transmit(self):
+        queue = self.queues[VCONSOLE.TRANSMITQ.value]
+        out = bytearray()
+        heads = queue.pop_available()
+        for head in heads:
+            for addr, length, flags in queue.chain(head) or []:
+                if flags & virtqueue.VIRTQ_DESC_F_WRITE:
+                    continue
+                data = self.bus.dma_read(addr, length)
+                if not isinstance(data, trap.EXCEPTION):
+                    out += data
+        if out:
+            self.console.write(bytes(out))
+        for head in heads:
+            queue.push_used(head, 0)
+        return len(heads)
+
+    # Fill receive chains with pending input, each as far as it goes.
+    # Returns the number of chains used.
+    def receive(self):
+        queue = self.queues[VCONSOLE.RECEIVEQ.value]
+        completed = 0
+        while self.pending and self.rx_chains:
+            head, buffers = self.rx_chains.popleft()
+            written = 0
+            for addr, length, flags in buffers or []:
+                if not flags & virtqueue.VIRTQ_DESC_F_WRITE or not self.pending:
+                    continue
+                data = self.pending[:length]
+                if isinstance(self.bus.dma_write(addr, data), trap.EXCEPTION):
+                    continue
+                del self.pending[:len(data)]
+                written += len(data)
+            queue.push_used(head, written)
+            completed += 1
+        return completed
+
+    # Queue input for the guest besides what the console gives, on the cpu
+    # thread.
+    def push_input(self, data):
+        self.pending += data
+        self.signal(self.receive(), self.queues[VCONSOLE.RECEIVEQ.value])
+
+    # on the cpu thread, when the console's input is ready
+    def service(self):
+        data = self.console.read()
+        if self.console.input() is None and self.watched is not None:
+            # end of input
+            self.bus.plic.unwatch(self.watched)
+            self.watched = None
+        self.push_input(data)
@@ -0,0 +1,105 @@
+# The virtqueue module implements the split virtqueue of the virtio spec: a
+# descriptor table, an available ring the driver puts request chains on and
+# a used ring the device returns them through, all in guest memory. A device
+# takes every chain made available since it last looked, so several requests
+# queued back to back are served by one notify and completed with one
+# interrupt.
+
+import struct
+from pyfive import trap
+
+VIRTQ_DESC_F_NEXT = 1
+VIRTQ_DESC_F_WRITE = 2
+VIRTQ_DESC_F_INDIRECT = 4
+VIRTQ_AVAIL_F_NO_INTERRUPT = 1
+
+# addr, len, flags, next
+DESC = struct.Struct('<QIHH')
+DESC_SIZE = 16
+U16 = struct.Struct('<H')
+# id, len
+USED_ELEM = struct.Struct('<II')
+
+
+class Virtqueue():
+    def __init__(self, bus, max_size):
+        self.bus = bus
+        self.max_size = max_size
+        self.reset()
+
+    def reset(self):
+        self.num = self.max_size
+        self.desc = 0
+        self.avail = 0
+        self.used = 0
+        self.last_avail = 0
+        self.used_idx = 0
+
+    def save_state(self):
+        return {"num": self.num, "desc": self.desc, "avail": self.avail, "used": self.used,
+                "last_avail": self.last_avail, "used_idx": self.used_idx}
+
+    def load_state(self, state):
+        self.num = state["num"]
+        self.desc = state["desc"]
+        self.avail = state["avail"]
+        self.used = state["used"]
+        self.last_avail = state["last_avail"]
+        self.used_idx = state["used_idx"]
+
+    def read_u16(self, addr):
+        data = self.bus.dma_read(addr, 2)
+        if isinstance(data, trap.EXCEPTION):
+            return None
+        return U16.unpack(data)[0]
+
+    # head indices of the chains made available since the last call
+    def pop_available(self):
+        avail_idx = self.read_u16(self.avail + 2)
+        if avail_idx is None:
+            return []
+        heads = []
+        while self.last_avail != avail_idx and len(heads) < self.num:
+            head = self.read_u16(self.avail + 4 + 2 * (self.last_avail % self.num))
+            if head is None:
+                break
+            heads.append(head)
+            self.last_avail = (self.last_avail + 1) & 0xffff
+        return heads
+
+    # The buffers of the chain starting at head, as (addr, len, flags)
+    # tuples in order, with indirect tables expanded in place. None for a
+    # chain that loops or points outside its table.
+    def chain(self, head):
+        buffers = []
+        table, size, index = self.desc, self.num, head
+        indirect = False
+        while True:
+            if index >= size or len(buffers) > self.num + size:
+                return None
+            data = self.bus.dma_read(table + DESC_SIZE * index, DESC_SIZE)
+            if isinstance(data, trap.EXCEPTION):
+                return None
+            addr, length, flags, next_index = DESC.unpack(data)
+            if flags & VIRTQ_DESC_F_INDIRECT:
+                # an indirect table replaces the rest of the chain
+                if indirect:
+                    return None
+                table, size, index = addr, length // DESC_SIZE, 0
+                indirect = True
+                continue
+            buffers.append((addr, length, flags))
+            if not flags & VIRTQ_DESC_F_NEXT:
+                return buffers
+            index = next_index
+
+    # return the chain at head to the driver, with written bytes stored
+    def push_used(self, head, written):
+        elem = self.used + 4 + USED_ELEM.size * (self.used_idx % self.num)
+        self.bus.dma_write(elem, USED_ELEM.pack(head, written))
+        self.used_idx = (self.used_idx + 1) & 0xffff
+        self.bus.dma_write(self.used + 2, U16.pack(self.used_idx))
+
+    def interrupt_suppressed(self):
+        flags = self.read_u16(self.avail)
+        return flags is not None and flags & VIRTQ_AVAIL_F_NO_INTERRUPT
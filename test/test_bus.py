@@ -0,0 +1,58 @@
+import sys
+import os
+import pytest
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import bus
+from pyfive import cpu
+from pyfive import trap
+
+
+class Scratch():
+    def __init__(self, size):
+        self.mem = bytearray(size)
+
+    def load(self, addr, size):
+        return self.mem[addr:addr + size]
+
+    def store(self, addr, size, data):
+        self.mem[addr:addr + size] = data.to_bytes(size, 'little')
+        return True
+
+
+def test_bus_dram_bounds():
+    mybus = bus.Bus()
+    last = bus.DRAM_BASE + mybus.ram.size - 8
+    # the last doubleword of dram is reachable by loads and stores alike
+    assert(mybus.store(last, 8, 0x1122334455667788) is True)
+    assert(mybus.loaduint(last, 8) == 0x1122334455667788)
+    assert(mybus.store(last + 4, 8, 0) == trap.EXCEPTION.StoreAMOAccessFault)
+    assert(mybus.load(last + 4, 8) == trap.EXCEPTION.LoadAccessFault)
+    assert(mybus.loadint(bus.DRAM_BASE - 4, 8) == trap.EXCEPTION.LoadAccessFault)
+
+
+def test_bus_register():
+    mybus = bus.Bus()
+    dev = Scratch(0x20)
+    mybus.register(0x3000_0010, 0x20, dev)
+    assert(mybus.store(0x3000_0018, 8, 0xfedc) is True)
+    assert(dev.mem[8:10] == b"\xdc\xfe")
+    assert(mybus.loaduint(0x3000_0018, 2) == 0xfedc)
+    assert(mybus.loadint(0x3000_0019, 1) == 0xffff_ffff_ffff_fffe)
+    # outside of the region, though in the same page
+    assert(mybus.load(0x3000_0008, 4) == trap.EXCEPTION.LoadAccessFault)
+    assert(mybus.load(0x3000_002c, 8) == trap.EXCEPTION.LoadAccessFault)
+
+    with pytest.raises(ValueError):
+        mybus.register(bus.UART_BASE, 0x10, Scratch(0x10))
+    with pytest.raises(ValueError):
+        mybus.register(bus.DRAM_BASE + 0x1000, 0x10, Scratch(0x10))
+
+
+def test_bus_dram_size():
+    mybus = bus.Bus(size=256 * 1024 * 1024)
+    mycpu = cpu.Cpu(mybus)
+    assert(mycpu.xreg.read(2) == bus.DRAM_BASE + 256 * 1024 * 1024)
+    assert(mybus.store(bus.DRAM_BASE + 0x0fff_fff8, 8, 7) is True)
+    assert(mybus.loaduint(bus.DRAM_BASE + 0x0fff_fff8, 8) == 7)
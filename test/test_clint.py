@@ -0,0 +1,155 @@
+import sys
+import os
+import time
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import bus
+from pyfive import clint
+from pyfive import cpu
+
+# j .
+LOOP = 0x0000006f
+WFI = 0x10500073
+# auipc t0, 1; 1: ld a0, 0(t0); beqz a0, 1b
+SPIN = [0x00001297, 0x0002b503, 0xfe050ee3]
+# 1: addi a0, a0, -1; bnez a0, 1b; j .
+COUNTDOWN = [0xfff50513, 0xfe051ee3, LOOP]
+# the timer path of xv6's timervec: csrsi sip, 2; lui t0, 0x2004 (mtimecmp);
+# li t1, -1; sd t1, 0(t0); mret
+TIMERVEC = [0x14416073, 0x020042b7, 0xfff00313, 0x0062b023, 0x30200073]
+MTIMECMP = bus.CLINT_BASE + clint.CLINT.MTIMECMP.value
+MTIME = bus.CLINT_BASE + clint.CLINT.MTIME.value
+
+
+def make_cpu(jit_enabled=False, **timer):
+    mybus = bus.Bus(**timer)
+    mybus.ram.store(0, 4, LOOP.to_bytes(4, 'little'))
+    mybus.ram.store(0x100, 4, LOOP.to_bytes(4, 'little'))
+    mycpu = cpu.Cpu(mybus, jit_enabled=jit_enabled)
+    mycpu.csrs.write(cpu.CSR.MTVEC, bus.DRAM_BASE + 0x100)
+    mycpu.csrs.write(cpu.CSR.MIE, cpu.MIP.MTIP.value)
+    mycpu.csrs.write(cpu.CSR.MSTATUS, 1 << 3)
+    return mycpu
+
+
+def test_clint_virtual_time():
+    mycpu = make_cpu(ips=2 * clint.FREQUENCY)
+    mycpu.run(40)
+    # two instructions per tick
+    assert(mycpu.bus.loaduint(MTIME, 8) == 20)
+    mycpu.bus.store(MTIMECMP, 8, 70)
+    assert(mycpu.next_event == 140)
+    mycpu.run(99)
+    assert(mycpu.pc == bus.DRAM_BASE)
+    mycpu.run(1)
+    assert(mycpu.pc == bus.DRAM_BASE + 0x100)
+    assert(mycpu.csrs.read(cpu.CSR.MCAUSE) == (1 << 63) | 7)
+    assert(mycpu.csrs.read(cpu.CSR.MIP) & cpu.MIP.MTIP.value)
+
+    # moving mtimecmp on lowers MTIP, setting mtime back does too
+    mycpu.bus.store(MTIMECMP, 8, 100)
+    assert(not mycpu.csrs.read(cpu.CSR.MIP) & cpu.MIP.MTIP.value)
+    mycpu.bus.store(MTIMECMP, 8, 0)
+    assert(mycpu.csrs.read(cpu.CSR.MIP) & cpu.MIP.MTIP.value)
+    mycpu.bus.store(MTIME, 8, 0)
+    mycpu.bus.store(MTIMECMP, 8, 1)
+    assert(not mycpu.csrs.read(cpu.CSR.MIP) & cpu.MIP.MTIP.value)
+    assert(mycpu.next_event == mycpu.insts + 2)
+
+
+def test_clint_realtime():
+    mycpu = make_cpu(timer="realtime", frequency=1000)
+    before = mycpu.bus.loaduint(MTIME, 8)
+    time.sleep(0.02)
+    assert(mycpu.bus.loaduint(MTIME, 8) >= before + 10)
+    mycpu.bus.store(MTIMECMP, 8, mycpu.bus.loaduint(MTIME, 8) + 10)
+    assert(not mycpu.csrs.read(cpu.CSR.MIP) & cpu.MIP.MTIP.value)
+    # the clock is looked at again on the next poll
+    assert(mycpu.clint.deadline == mycpu.insts + clint.REALTIME_POLL)
+    time.sleep(0.02)
+    mycpu.run(clint.REALTIME_POLL)
+    assert(mycpu.pc == bus.DRAM_BASE + 0x100)
+
+
+def load_program(mycpu, prog):
+    mycpu.bus.ram.store(0, 4 * len(prog), b"".join(i.to_bytes(4, 'little') for i in prog))
+
+
+def test_clint_idle():
+    # wfi skips to the timer
+    mycpu = make_cpu()
+    load_program(mycpu, [WFI, LOOP])
+    mycpu.bus.store(MTIMECMP, 8, 5000)
+    mycpu.run(2)
+    assert(mycpu.insts >= 5000)
+    assert(mycpu.pc == bus.DRAM_BASE + 0x100)
+
+    # so does a loop waiting on a flag in memory: ten seconds of guest time
+    mycpu = make_cpu(jit_enabled=True)
+    load_program(mycpu, SPIN)
+    mycpu.bus.store(MTIMECMP, 8, 10 * clint.FREQUENCY)
+    mycpu.run(10 * clint.IPS + 100)
+    assert(mycpu.pc == bus.DRAM_BASE + 0x100)
+    assert(mycpu.csrs.read(cpu.CSR.MCAUSE) == (1 << 63) | 7)
+
+    # a loop that gets somewhere is left alone
+    mycpu = make_cpu(jit_enabled=True)
+    load_program(mycpu, COUNTDOWN)
+    mycpu.xreg.write(10, 100)
+    mycpu.bus.store(MTIMECMP, 8, 10 * clint.FREQUENCY)
+    mycpu.run(150)
+    assert(mycpu.xreg.read(10) == 25)
+    assert(mycpu.insts == 150)
+    # and the j . it ends in is idle
+    mycpu.run(100)
+    assert(mycpu.xreg.read(10) == 0)
+    assert(mycpu.pc == bus.DRAM_BASE + 0x100)
+
+
+def test_clint_realtime_wfi():
+    mycpu = make_cpu(timer="realtime", frequency=1000)
+    load_program(mycpu, [WFI, LOOP])
+    mycpu.bus.store(MTIMECMP, 8, mycpu.bus.loaduint(MTIME, 8) + 30)
+    start = time.monotonic()
+    # wfi sleeps until the timer instead of spinning through instructions
+    while mycpu.pc != bus.DRAM_BASE + 0x100:
+        mycpu.run(1)
+    assert(time.monotonic() - start >= 0.025)
+    assert(mycpu.insts < 100)
+
+
+def test_clint_timer_to_supervisor():
+    for jit_enabled in (False, True):
+        mycpu = make_cpu(jit_enabled)
+        mycpu.bus.ram.store(0x100, 20, b"".join(i.to_bytes(4, 'little') for i in TIMERVEC))
+        mycpu.bus.ram.store(0x200, 4, LOOP.to_bytes(4, 'little'))
+        # as xv6 sets up: everything delegated, the timer in m-mode and the
+        # kernel at its loop in s-mode with interrupts on
+        mycpu.csrs.write(cpu.CSR.MEDELEG, 0xffff)
+        mycpu.csrs.write(cpu.CSR.MIDELEG, 0xffff)
+        mycpu.csrs.write(cpu.CSR.STVEC, bus.DRAM_BASE + 0x200)
+        mycpu.csrs.write(cpu.CSR.MIE, cpu.MIP.MTIP.value | cpu.MIP.SSIP.value)
+        mycpu.csrs.write(cpu.CSR.MSTATUS, 0)
+        mycpu.csrs.write(cpu.CSR.SSTATUS, 1 << 1)
+        mycpu.mode = cpu.MODE.SUPERVISOR
+        mycpu.update_interrupts()
+        mycpu.bus.store(MTIMECMP, 8, 50)
+        if not jit_enabled:
+            mycpu.run(40)
+            assert(mycpu.pc == bus.DRAM_BASE)
+
+        # MTIP is not delegated, whatever mideleg says: m-mode takes it even
+        # though sstatus.SIE gates s-mode
+        mycpu.run(120)
+        assert(mycpu.csrs.read(cpu.CSR.MCAUSE) == (1 << 63) | 7)
+        assert(mycpu.csrs.read(cpu.CSR.MEPC) == bus.DRAM_BASE)
+        # the handler raised SSIP through sip and returned to s-mode, where
+        # the software interrupt was taken
+        assert(mycpu.mode == cpu.MODE.SUPERVISOR)
+        assert(mycpu.pc == bus.DRAM_BASE + 0x200)
+        assert(mycpu.csrs.read(cpu.CSR.SCAUSE) == (1 << 63) | 1)
+        assert(mycpu.csrs.read(cpu.CSR.SEPC) == bus.DRAM_BASE)
+        assert(mycpu.csrs.read(cpu.CSR.SSTATUS) >> 8 & 1)
+        assert(not mycpu.csrs.read(cpu.CSR.MIP) & cpu.MIP.MTIP.value)
+        assert(mycpu.csrs.read(cpu.CSR.SIP) == 0)
@@ -0,0 +1,47 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import cpu
+from pyfive import bus
+
+# auipc t0, 0x10; loop: addi a0, a0, 1; sd a0, 0(t0); addi t0, t0, 8; j loop
+PROG = [0x00010297, 0x00150513, 0x00a2b023, 0x00828293, 0xff5ff06f]
+COUNTERS = bus.DRAM_BASE + 0x10000
+
+
+def scenario(mycpu, n):
+    mycpu.run(100 * n)
+    mycpu.bus.virtio.disk.write_from(0, memoryview(b"child%d" % n))
+    uart = mycpu.bus.uart
+    uart.push_input(b"ab")
+    got = bytes([uart.load(0, 1), uart.load(0, 1)])
+    for c in b"out%d" % n:
+        uart.store(0, 1, c)
+    if n == 3:
+        raise RuntimeError("scenario failed")
+    return (mycpu.xreg.read(10), mycpu.bus.virtio.disk.read(0, 6), got)
+
+
+def test_clone_fork(tmp_path):
+    image = tmp_path / "kernel.img"
+    image.write_bytes(b"".join(i.to_bytes(4, 'little') for i in PROG))
+    disk_image = tmp_path / "fs.img"
+    disk_image.write_bytes(bytes(4096))
+    mycpu = cpu.Cpu(bus.Bus(dram_bin=str(image), disk_bin=str(disk_image)))
+    mycpu.run(200)
+    before = (mycpu.save_state(), mycpu.bus.ram.load(COUNTERS - bus.DRAM_BASE, 0x1000))
+
+    results = mycpu.fork([1, 2, 3], scenario, jobs=2)
+    assert([r.index for r in results] == [0, 1, 2])
+    assert(results[0].value[1:] == (b"child1", b"ab"))
+    assert(results[1].value[1:] == (b"child2", b"ab"))
+    assert(results[0].value[0] < results[1].value[0])
+    assert([r.output for r in results] == [b"out1", b"out2", b"out3"])
+    assert(results[2].value is None and "scenario failed" in results[2].error)
+
+    # the parent's memory, registers and disk are untouched
+    assert((mycpu.save_state(), mycpu.bus.ram.load(COUNTERS - bus.DRAM_BASE, 0x1000)) == before)
+    mycpu.bus.virtio.close()
+    assert(disk_image.read_bytes() == bytes(4096))
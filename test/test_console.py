@@ -0,0 +1,52 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import console
+from pyfive import plic
+from pyfive import uart
+
+
+def write(myuart, text):
+    for c in text:
+        myuart.store(uart.UART.THR.value, 1, ord(c))
+
+
+def test_console_output():
+    memory = console.MemoryConsole()
+    myuart = uart.Uart(0x100, plic.Plic(0x400000), memory)
+    # held back until a newline
+    write(myuart, "$ ls")
+    assert(memory.output == b"")
+    write(myuart, "\nREADME")
+    assert(memory.output == b"$ ls\n")
+    myuart.flush()
+    assert(memory.output == b"$ ls\nREADME")
+
+
+def test_console_input():
+    rfd, wfd = os.pipe()
+    myplic = plic.Plic(0x400000)
+    backend = console.StreamConsole(os.fdopen(rfd, "rb", buffering=0), None, owned=True)
+    myuart = uart.Uart(0x100, myplic, backend)
+    myuart.store(uart.UART.IER.value, 1, uart.IER_RX)
+    myplic.wait(0)
+    assert(not myplic.service)
+
+    os.write(wfd, b"ab")
+    myplic.wait(0)
+    assert(myplic.deliverable)
+    myplic.serve()
+    assert(myplic.lines == 1 << uart.UART.IRQ.value)
+    assert(myuart.load(uart.UART.RHR.value, 1) == ord("a"))
+    assert(myuart.load(uart.UART.RHR.value, 1) == ord("b"))
+    assert(myplic.lines == 0)
+
+    # at the end of input the file is no longer watched
+    os.close(wfd)
+    myplic.wait(0)
+    myplic.serve()
+    assert(myuart.watched is None)
+    assert(len(myplic.selector.get_map()) == 1)
+    myplic.close()
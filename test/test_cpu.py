@@ -79,3 +79,38 @@ class TestCpu():
 
         data = self.mycpu.loaduint(bus.DRAM_BASE+4, 4)
         assert(data == 0xffff_ffef)
+
+    def test_cpu_icache(self):
+        # addi a0, a0, 1
+        self.mybus.store(bus.DRAM_BASE, 4, (0x00150513).to_bytes(4, 'little'))
+        self.mycpu.step()
+        assert(self.mycpu.xreg.read(10) == 1)
+        assert(self.mycpu.icache.lookup(bus.DRAM_BASE) is not None)
+
+        # a guest store over the cached instruction drops it: addi a0, a0, 2
+        self.mycpu.store(bus.DRAM_BASE, 4, (0x00250513).to_bytes(4, 'little'))
+        assert(self.mycpu.icache.lookup(bus.DRAM_BASE) is None)
+        self.mycpu.pc = bus.DRAM_BASE
+        self.mycpu.step()
+        assert(self.mycpu.xreg.read(10) == 3)
+
+    def test_cpu_step_block(self):
+        # loop: addi a0, a0, 1; addi a1, a1, -1; bne a1, zero, loop
+        prog = [0x00150513, 0xfff58593, 0xfe059ce3]
+        self.mybus.store(bus.DRAM_BASE, 12, b"".join(i.to_bytes(4, 'little') for i in prog))
+        self.mycpu.xreg.write(11, 5)
+        blk = self.mycpu.step_block()
+        assert(blk.ninsts == 3)
+        assert(self.mycpu.pc == bus.DRAM_BASE)
+        for i in range(4):
+            blk = self.mycpu.step_block(blk)
+        # the back edge links the block to itself
+        assert(blk.links[bus.DRAM_BASE] is blk)
+        assert(self.mycpu.pc == bus.DRAM_BASE + 12)
+        assert(self.mycpu.xreg.read(10) == 5)
+        assert(self.mycpu.xreg.read(11) == 0)
+
+        # writing the code page drops the block
+        self.mycpu.store(bus.DRAM_BASE, 4, (0x00250513).to_bytes(4, 'little'))
+        assert(not blk.valid)
+        assert(self.mycpu.translator.lookup(bus.DRAM_BASE) is not blk)
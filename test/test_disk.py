@@ -0,0 +1,66 @@
+import sys
+import os
+import pytest
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import disk
+
+
+def read(overlay, offset, size):
+    buf = bytearray(size)
+    overlay.read_into(offset, memoryview(buf))
+    return bytes(buf)
+
+
+def test_disk_overlay(tmp_path):
+    image = tmp_path / "fs.img"
+    base = bytes(range(256)) * 40
+    image.write_bytes(base)
+    delta = tmp_path / "fs.delta"
+
+    overlay = disk.Overlay(str(image), str(delta), "keep")
+    # a write across the first block boundary copies up both blocks
+    overlay.write_from(4000, memoryview(b"\xee" * 200))
+    assert(overlay.dirty == {0, 1})
+    assert(read(overlay, 3990, 220) == base[3990:4000] + b"\xee" * 200 + base[4200:4210])
+    # the short last block
+    overlay.write_from(10230, memoryview(b"\x11" * 10))
+    assert(read(overlay, 10200, 40) == base[10200:10230] + b"\x11" * 10)
+    overlay.close()
+    assert(image.read_bytes() == base)
+
+    # the kept delta comes back on the next run; discarding that run's
+    # writes leaves it as it was
+    kept = delta.read_bytes()
+    overlay = disk.Overlay(str(image), str(delta), "discard")
+    assert(overlay.dirty == {0, 1, 2})
+    assert(read(overlay, 4000, 200) == b"\xee" * 200)
+    overlay.write_from(8192, memoryview(b"\x33" * 16))
+    assert(read(overlay, 8192, 16) == b"\x33" * 16)
+    overlay.close()
+    assert(delta.read_bytes() == kept)
+    overlay = disk.Overlay(str(image), str(delta), "keep")
+    assert(overlay.dirty == {0, 1, 2})
+    overlay.close()
+    assert(delta.read_bytes() == kept)
+    delta.unlink()
+
+    # a delta file the overlay made itself is dropped in discard mode
+    overlay = disk.Overlay(str(image), str(delta), "discard")
+    overlay.write_from(0, memoryview(b"\x44" * 16))
+    overlay.close()
+    assert(not delta.exists())
+
+    overlay = disk.Overlay(str(image), None, "commit")
+    overlay.write_from(512, memoryview(b"\x22" * 512))
+    overlay.close()
+    assert(image.read_bytes() == base[:512] + b"\x22" * 512 + base[1024:])
+
+    # a delta made against another version of the image is refused
+    disk.Overlay(str(image), str(delta), "keep").close()
+    image.write_bytes(base[:4096])
+    with pytest.raises(ValueError):
+        disk.Overlay(str(image), str(delta), "keep")
+    with pytest.raises(ValueError):
+        disk.Overlay(str(image), None, "keep")
@@ -0,0 +1,67 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import dram
+
+
+def test_dram_typed_access():
+    ram = dram.Memory(0x2000, None)
+    ram.write_u64(0x10, -2)
+    assert(ram.read_u64(0x10) == 0xffff_ffff_ffff_fffe)
+    assert(ram.read_i64(0x10) == -2)
+    assert(ram.read_i32(0x14) == -1)
+    assert(ram.read_u16(0x10) == 0xfffe)
+    assert(ram.read_i8(0x10) == -2)
+    # unaligned, and only the low bytes of the value are written
+    ram.write_u32(0x21, 0x1_8765_4321)
+    assert(ram.load(0x20, 6) == b"\x00\x21\x43\x65\x87\x00")
+    ram.write_u8(0x20, 0x1ff)
+    assert(ram.read_u16(0x20) == 0x21ff)
+
+    pages = []
+    ram.add_watcher(pages.append)
+    ram.watch_page(1)
+    ram.write_u16(0xfff, 0xffff)
+    assert(pages == [1])
+
+
+def test_dram_sparse():
+    ram = dram.Memory(1 << 30, None)
+    ram.write_u64((1 << 30) - 8, 1)
+    assert(ram.read_u64((1 << 30) - 8) == 1)
+    resident = ram.resident()
+    # only touched pages are backed by host memory
+    assert(resident is None or resident < 1 << 20)
+
+
+def test_dram_dirty_tracking():
+    ram = dram.Memory(0x10_0000, None)
+    ram.track_dirty(0x1_0000)
+    ram.write_u8(0x1_0001, 1)
+    # unaligned, across two granules
+    ram.write_u32(0x2_fffe, 1)
+    ram.store(0x8_0000, 0x2_0000, bytes(0x2_0000))
+    ram.notify_write(0xf_0000, 8)
+    assert(ram.dirty_pages() == [*range(0x10, 0x40), *range(0x80, 0xa0), *range(0xf0, 0x100)])
+    ram.clear_dirty("base")
+    assert(ram.dirty_pages() == [] and ram.dirty_base == "base")
+
+
+def test_dram_touched_pages(monkeypatch):
+    ram = dram.Memory(0x10_0000, None)
+    ram.write_u8(5 << dram.PAGE_SHIFT, 1)
+    pages = ram.touched_pages()
+    assert(5 in pages)
+    if ram.pagemap_pages() is not None:
+        assert(100 not in pages)
+
+    # pages swapped out are not resident: with swap and no pagemap, mincore
+    # cannot be trusted and every page is a candidate
+    monkeypatch.setattr(ram, "pagemap_pages", lambda: None)
+    monkeypatch.setattr(ram, "resident_pages", lambda: [])
+    monkeypatch.setattr(dram, "host_has_swap", lambda: True)
+    assert(list(ram.touched_pages()) == list(range(0x100)))
+    monkeypatch.setattr(dram, "host_has_swap", lambda: False)
+    assert(ram.touched_pages() == [])
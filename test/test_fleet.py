@@ -0,0 +1,57 @@
+import sys
+import os
+import json
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import fleet
+
+# print '>', then echo every byte read from the uart:
+# lui t0, 0x10000; li t3, '>'; sb t3, 0(t0)
+# loop: lbu t1, 5(t0); andi t1, t1, 1; beqz t1, loop; lbu t2, 0(t0); sb t2, 0(t0); j loop
+ECHO = [0x100002b7, 0x03e00e13, 0x01c28023, 0x0052c303, 0x00137313, 0xfe030ce3,
+        0x0002c383, 0x00728023, 0xfedff06f]
+
+
+def test_fleet_manifest(tmp_path):
+    (tmp_path / "echo.img").write_bytes(b"".join(i.to_bytes(4, 'little') for i in ECHO))
+    manifest = {
+        "defaults": {"kernel": "echo.img", "max_insts": 20000, "memory": "1M"},
+        "jobs": [
+            {"name": "echo", "script": [{"wait": ">", "send": "hi"}, {"wait": "h", "send": "!"}],
+             "expect": "hi!"},
+            {"name": "silent", "expect": "nope"},
+            {"name": "budget", "max_insts": 1000},
+            {"name": "missing", "kernel": "missing.img"},
+        ],
+    }
+    (tmp_path / "jobs.json").write_text(json.dumps(manifest))
+    results_path = tmp_path / "results.json"
+    ret = fleet.main(["fleet", str(tmp_path / "jobs.json"), "-o", str(results_path), "-j", "2",
+                      "--no-cache"])
+    assert(ret == 1)
+    results = json.loads(results_path.read_text())
+    jobs = {job["name"]: job for job in results["jobs"]}
+    assert([job["name"] for job in results["jobs"]] == ["echo", "silent", "budget", "missing"])
+    assert(jobs["echo"]["status"] == "pass" and jobs["echo"]["output"] == ">hi!")
+    assert(0 < jobs["echo"]["instructions"] < 20000)
+    assert(jobs["silent"]["status"] == "fail" and jobs["silent"]["reason"] == "instruction budget")
+    assert(jobs["silent"]["instructions"] >= 20000)
+    assert(jobs["budget"]["status"] == "done")
+    assert(jobs["missing"]["status"] == "error")
+    assert(results["summary"]["pass"] == 1 and results["summary"]["error"] == 1)
+
+
+def test_fleet_budgets(tmp_path):
+    (tmp_path / "echo.img").write_bytes(b"".join(i.to_bytes(4, 'little') for i in ECHO))
+    path = tmp_path / "jobs.json"
+    # no budget named: the default timeout applies
+    path.write_text(json.dumps({"jobs": [{"kernel": "echo.img"}]}))
+    jobs = fleet.load_manifest(str(path))
+    assert(jobs[0]["timeout"] == fleet.DEFAULT_TIMEOUT and jobs[0]["max_insts"] is None)
+
+    # a job that could run forever is refused, as is a budget of nothing
+    for job in ({"kernel": "echo.img", "timeout": None},
+                {"kernel": "echo.img", "max_insts": 0}):
+        path.write_text(json.dumps({"jobs": [job]}))
+        assert(fleet.main(["fleet", str(path), "-o", str(tmp_path / "results.json")]) == 2)
@@ -0,0 +1,100 @@
+import sys
+import os
+import threading
+import time
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import bus
+from pyfive import cpu
+from pyfive import trap
+from pyfive import uart
+
+NOP = 0x00000013
+# csrrsi zero, sstatus, 2
+SET_SIE = 0x10016073
+# 1: wfi; j 1b
+IDLE_LOOP = [0x10500073, 0xffdff06f]
+
+
+# stands in for the disk, finishing requests on a worker thread
+class Device():
+    def __init__(self):
+        self.served = 0
+
+    def service(self):
+        self.served += 1
+
+
+def make_cpu():
+    mybus = bus.Bus()
+    mybus.ram.store(0, 16, b"".join(NOP.to_bytes(4, 'little') for _ in range(4)))
+    mybus.ram.store(16, 4, SET_SIE.to_bytes(4, 'little'))
+    # receive interrupts on
+    mybus.uart.store(uart.UART.IER.value, 1, uart.IER_RX)
+    mycpu = cpu.Cpu(mybus, jit_enabled=False)
+    mycpu.mode = cpu.MODE.SUPERVISOR
+    mycpu.csrs.write(cpu.CSR.MIDELEG, 1 << trap.INTERRUPT.SupervisorExternalInterrupt.value)
+    mycpu.csrs.write(cpu.CSR.MIE, cpu.MIP.SEIP.value)
+    mycpu.csrs.write(cpu.CSR.STVEC, bus.DRAM_BASE + 0x100)
+    return mycpu
+
+
+def test_plic_delivery():
+    mycpu = make_cpu()
+    plic = mycpu.bus.plic
+    mycpu.step()
+    # nothing pending, nothing to check
+    assert(not plic.deliverable)
+
+    # interrupts are off in sstatus: the line goes up, the slow path runs
+    # once and finds nothing it may take
+    mycpu.bus.uart.push_input(b"x")
+    assert(plic.deliverable)
+    mycpu.step()
+    assert(plic.lines == 1 << uart.UART.IRQ.value)
+    assert(not plic.deliverable)
+    mycpu.step()
+    mycpu.step()
+    assert(mycpu.pc == bus.DRAM_BASE + 16)
+
+    # enabling them is a csr write, which makes the interrupt deliverable
+    # and it is taken right after that instruction
+    mycpu.step()
+    assert(mycpu.pc == bus.DRAM_BASE + 0x100)
+    assert(mycpu.csrs.read(cpu.CSR.SEPC) == bus.DRAM_BASE + 20)
+    assert(mycpu.csrs.read(cpu.CSR.SCAUSE) == (1 << 63) | 9)
+    assert(plic.sclaim == uart.UART.IRQ.value)
+
+    # reading the byte lowers the line, completing the claim frees it
+    assert(mycpu.bus.uart.load(0, 1) == ord("x"))
+    assert(plic.lines == 0)
+    mycpu.bus.plic.store(0x201004, 4, uart.UART.IRQ.value)
+    assert(plic.claimed == 0)
+
+
+def test_plic_service_while_idle():
+    for jit_enabled in (False, True):
+        mybus = bus.Bus()
+        mybus.ram.store(0, 8, b"".join(i.to_bytes(4, 'little') for i in IDLE_LOOP))
+        mycpu = cpu.Cpu(mybus, jit_enabled=jit_enabled)
+        plic = mybus.plic
+        device = Device()
+
+        # the request lands between update_interrupts reading service and
+        # clearing the flag
+        plic.service.append(device)
+        plic.deliverable = False
+        mycpu.run(4)
+        assert(device.served == 1)
+
+        # a completion from another thread while the hart sleeps in wfi
+        worker = threading.Timer(0.02, plic.request_service, (device,))
+        worker.start()
+        start = time.monotonic()
+        while device.served < 2 and time.monotonic() - start < 2:
+            mycpu.run(4)
+        worker.join()
+        assert(device.served == 2)
+        assert(time.monotonic() - start < 1)
+        mybus.close()
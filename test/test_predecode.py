@@ -0,0 +1,39 @@
+import sys
+import os
+import numpy as np
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import cpu
+from pyfive import bus
+from pyfive import predecode
+
+
+def test_decode_words():
+    # addi a0, a0, -1; sd a1, -8(sp); beq a0, a1, -8; lui a2, 0x80000; jal ra, -2048
+    words = [0xfff50513, 0xfeb13c23, 0xfeb50ce3, 0x80000637, 0x801ff0ef]
+    decoded = predecode.decode_words(np.array(words, dtype=np.uint32))
+    assert(decoded["imm_i"][0] == -1)
+    assert(decoded["imm_s"][1] == -8)
+    assert(decoded["imm_b"][2] == -8)
+    assert(decoded["imm_u"][3] == -0x8000_0000)
+    assert(decoded["imm_j"][4] == -2048)
+    for i, word in enumerate(words):
+        assert(tuple(decoded[name][i] for name in predecode.FIELDS) == predecode.decode_word(word))
+
+
+def test_predecode_image(tmp_path):
+    image = tmp_path / "kernel.img"
+    # addi a0, a0, 1
+    image.write_bytes((0x00150513).to_bytes(4, 'little') * 8)
+    mycpu = cpu.Cpu(bus.Bus(dram_bin=str(image)))
+    tables = mycpu.predecoder.tables
+    assert(len(tables["opcode"]) == 1024)
+    assert(tables["opcode"][7] == 0x13 and tables["imm_i"][7] == 1)
+
+    # addi a0, a0, 2 written later is predecoded again on lookup
+    mycpu.store(bus.DRAM_BASE + 4, 4, (0x00250513).to_bytes(4, 'little'))
+    assert(mycpu.predecoder.fields_at(bus.DRAM_BASE + 4)[7] == 2)
+    mycpu.pc = bus.DRAM_BASE + 4
+    mycpu.step()
+    assert(mycpu.xreg.read(10) == 2)
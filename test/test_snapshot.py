@@ -0,0 +1,112 @@
+import sys
+import os
+import pytest
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import cpu
+from pyfive import bus
+from pyfive import cli
+from pyfive import dram
+from pyfive import snapshot
+
+# auipc t0, 0x10; loop: addi a0, a0, 1; sd a0, 0(t0); addi t0, t0, 8; j loop
+PROG = [0x00010297, 0x00150513, 0x00a2b023, 0x00828293, 0xff5ff06f]
+COUNTERS = bus.DRAM_BASE + 0x10000
+
+
+def make_image(tmp_path):
+    image = tmp_path / "kernel.img"
+    image.write_bytes(b"".join(i.to_bytes(4, 'little') for i in PROG))
+    return str(image)
+
+
+def test_snapshot_restore(tmp_path):
+    mycpu = cpu.Cpu(bus.Bus(dram_bin=make_image(tmp_path)))
+    mycpu.run(400)
+    mycpu.bus.clint.store(0x4000, 8, 12345)
+    mycpu.bus.store(bus.VIRTIO_BASE + 0x080, 4, 0x8000_1000)
+    path = str(tmp_path / "machine.snap")
+    mycpu.save_snapshot(path)
+    # zero pages are left out: two touched pages of 16 MiB
+    assert(os.path.getsize(path) < 8192)
+
+    # a machine that never saw the program carries on from the same point
+    other = cpu.Cpu(bus.Bus(size=snapshot.read_header(path)["dram_size"]))
+    other.load_snapshot(path)
+    assert(other.save_state() == mycpu.save_state())
+    assert(other.bus.clint.mtimecmp == 12345)
+    assert(other.bus.virtio.queue_desc_low == 0x8000_1000)
+    mycpu.run(300)
+    other.run(300)
+    assert(other.save_state() == mycpu.save_state())
+    assert(other.bus.ram.load(COUNTERS - bus.DRAM_BASE, 0x1000) ==
+           mycpu.bus.ram.load(COUNTERS - bus.DRAM_BASE, 0x1000))
+    assert(other.bus.loaduint(COUNTERS, 8) == 1)
+
+    # restoring over a machine that ran on drops what it did since
+    mycpu.load_snapshot(path)
+    assert(mycpu.bus.ram.load(COUNTERS - bus.DRAM_BASE, 0x1000) !=
+           other.bus.ram.load(COUNTERS - bus.DRAM_BASE, 0x1000))
+    assert(mycpu.pc == snapshot.read_header(path)["cpu"]["pc"])
+
+
+def test_snapshot_swapped_out(tmp_path, monkeypatch):
+    # no pagemap, and a host with swap where every guest page is out of
+    # memory: nothing may be lost on save or left over on load
+    monkeypatch.setattr(dram.Memory, "pagemap_pages", lambda self: None)
+    monkeypatch.setattr(dram.Memory, "resident_pages", lambda self: [])
+    monkeypatch.setattr(dram, "host_has_swap", lambda: True)
+    mycpu = cpu.Cpu(bus.Bus(dram_bin=make_image(tmp_path)))
+    mycpu.run(400)
+    path = str(tmp_path / "machine.snap")
+    mycpu.save_snapshot(path)
+    assert(len(list(snapshot.read_pages(path))) == 2)
+
+    other = cpu.Cpu(bus.Bus())
+    other.bus.store(bus.DRAM_BASE + 0x30000, 8, 7)
+    other.load_snapshot(path)
+    assert(other.bus.loaduint(bus.DRAM_BASE + 0x30000, 8) == 0)
+    assert(other.bus.ram.load(0, 0x21000) == mycpu.bus.ram.load(0, 0x21000))
+
+
+def test_snapshot_incremental(tmp_path):
+    mycpu = cpu.Cpu(bus.Bus(dram_bin=make_image(tmp_path)))
+    mycpu.bus.ram.track_dirty()
+    paths = [str(tmp_path / f"{n}.snap") for n in range(3)]
+    mycpu.run(100)
+    mycpu.save_snapshot(paths[0])
+    mycpu.run(100)
+    mycpu.save_snapshot(paths[1], paths[0])
+    mycpu.bus.store(bus.DRAM_BASE + 0x20000, 8, 1)
+    mycpu.run(100)
+    mycpu.save_snapshot(paths[2], paths[1])
+    assert(snapshot.chain(paths[2]) == paths[::-1])
+    # only the counter page changed since the first snapshot
+    assert([page for page, _ in snapshot.read_pages(paths[1])] == [0x10])
+    assert(len(list(snapshot.read_pages(paths[2]))) == 2)
+
+    other = cpu.Cpu(bus.Bus())
+    other.load_snapshot(paths[2])
+    assert(other.save_state() == mycpu.save_state())
+    assert(other.bus.ram.load(0, 0x21000) == mycpu.bus.ram.load(0, 0x21000))
+
+    merged = str(tmp_path / "merged.snap")
+    snapshot.merge(paths[2], merged)
+    assert(snapshot.chain(merged) == [merged])
+    other = cpu.Cpu(bus.Bus())
+    other.load_snapshot(merged)
+    assert(other.bus.ram.load(0, 0x21000) == mycpu.bus.ram.load(0, 0x21000))
+
+    # a parent the changes were not tracked against is refused
+    with pytest.raises(ValueError):
+        mycpu.save_snapshot(str(tmp_path / "bad.snap"), paths[0])
+
+
+def test_snapshot_cli_counts():
+    # a count of zero or less would checkpoint forever or never
+    for argv in (["--checkpoint-every", "0"], ["--checkpoint-every", "-5"],
+                 ["--snapshot", "x.snap", "--snapshot-after", "0"]):
+        with pytest.raises(SystemExit):
+            cli.parse_args(["pyfive", "kernel.img", *argv])
+    assert(cli.parse_args(["pyfive", "kernel.img", "--checkpoint-every", "1000"]).checkpoint_every == 1000)
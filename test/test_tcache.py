@@ -0,0 +1,62 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import cpu
+from pyfive import bus
+from pyfive import tcache
+
+# loop: addi a0, a0, 1; addi a1, a1, -1; bne a1, zero, loop
+PROG = [0x00150513, 0xfff58593, 0xfe059ce3]
+
+
+def make_image(tmp_path):
+    image = tmp_path / "kernel.img"
+    image.write_bytes(b"".join(i.to_bytes(4, 'little') for i in PROG))
+    return str(image)
+
+
+def run_loop(image, cache):
+    mycpu = cpu.Cpu(bus.Bus(dram_bin=image))
+    mycpu.translator.cache = cache
+    mycpu.xreg.write(11, 3)
+    blk = None
+    while mycpu.pc != bus.DRAM_BASE + 12:
+        blk = mycpu.step_block(blk)
+    assert(mycpu.xreg.read(10) == 3)
+    return mycpu
+
+
+def test_tcache_reuse(tmp_path):
+    image = make_image(tmp_path)
+    cache = tcache.TranslationCache.for_image(image, str(tmp_path))
+    run_loop(image, cache)
+    assert(cache.reused == 0)
+    cache.save()
+
+    cache = tcache.TranslationCache.for_image(image, str(tmp_path))
+    assert(len(cache.entries) == 1)
+    run_loop(image, cache)
+    assert(cache.reused == 1)
+
+
+def test_tcache_stale_and_corrupted(tmp_path):
+    image = make_image(tmp_path)
+    cache = tcache.TranslationCache.for_image(image, str(tmp_path))
+    run_loop(image, cache)
+    cache.save()
+
+    # guest code differs from what was cached: the entry is not used
+    cache = tcache.TranslationCache.for_image(image, str(tmp_path))
+    mycpu = cpu.Cpu(bus.Bus(dram_bin=image))
+    mycpu.translator.cache = cache
+    mycpu.store(bus.DRAM_BASE, 4, (0x00250513).to_bytes(4, 'little'))
+    mycpu.translator.lookup(bus.DRAM_BASE)
+    assert(cache.reused == 0)
+
+    data = bytearray(open(cache.path, 'rb').read())
+    data[-1] ^= 0xff
+    open(cache.path, 'wb').write(data)
+    cache = tcache.TranslationCache.for_image(image, str(tmp_path))
+    assert(len(cache.entries) == 0)
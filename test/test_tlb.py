@@ -0,0 +1,146 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import cpu
+from pyfive import bus
+from pyfive import tlb
+from pyfive import trap
+
+ROOT = bus.DRAM_BASE + 0x10000
+PTE_V, PTE_R, PTE_W, PTE_X = 1, 1 << 1, 1 << 2, 1 << 3
+
+
+def pte(paddr, flags):
+    return ((paddr >> 12) << 10) | flags
+
+
+def map_page(mybus, root, vaddr, paddr, flags):
+    # root, level 1 and level 0 tables in three consecutive pages
+    mybus.store(root + ((vaddr >> 30) & 0x1ff) * 8, 8, pte(root + 0x1000, PTE_V))
+    mybus.store(root + 0x1000 + ((vaddr >> 21) & 0x1ff) * 8, 8, pte(root + 0x2000, PTE_V))
+    mybus.store(root + 0x2000 + ((vaddr >> 12) & 0x1ff) * 8, 8, pte(paddr, flags))
+
+
+def set_satp(mycpu, root, asid=0):
+    mycpu.csrs.write(cpu.CSR.SATP, (8 << 60) | (asid << 44) | (root >> 12))
+    mycpu.update_paging(cpu.CSR.SATP.value)
+
+
+def test_tlb_hits_and_permissions():
+    mybus = bus.Bus()
+    mycpu = cpu.Cpu(mybus)
+    map_page(mybus, ROOT, 0x1000, bus.DRAM_BASE + 0x20000, PTE_V | PTE_R | PTE_W)
+    map_page(mybus, ROOT, 0x2000, bus.DRAM_BASE + 0x21000, PTE_V | PTE_R)
+    mybus.store(bus.DRAM_BASE + 0x20008, 8, 0x1234)
+    set_satp(mycpu, ROOT)
+
+    assert(mycpu.loaduint(0x1008, 8) == 0x1234)
+    assert(mycpu.loaduint(0x1008, 8) == 0x1234)
+    assert(mycpu.tlb.dmisses == 1 and mycpu.tlb.dhits == 1)
+
+    assert(mycpu.store(0x2000, 8, 1) == trap.EXCEPTION.StoreAMOPageFault)
+    assert(mycpu.fetch_paddr(0x2000) == trap.EXCEPTION.InstructionPageFault)
+    assert(mycpu.loaduint(0x3000, 8) == trap.EXCEPTION.LoadPageFault)
+
+
+def test_tlb_follows_page_table_writes():
+    mybus = bus.Bus()
+    mycpu = cpu.Cpu(mybus)
+    other = ROOT + 0x4000
+    map_page(mybus, ROOT, 0x1000, bus.DRAM_BASE + 0x20000, PTE_V | PTE_R)
+    map_page(mybus, other, 0x1000, bus.DRAM_BASE + 0x21000, PTE_V | PTE_R)
+    mybus.store(bus.DRAM_BASE + 0x20000, 8, 1)
+    mybus.store(bus.DRAM_BASE + 0x21000, 8, 2)
+
+    set_satp(mycpu, ROOT)
+    assert(mycpu.loaduint(0x1000, 8) == 1)
+    set_satp(mycpu, other)
+    assert(mycpu.loaduint(0x1000, 8) == 2)
+    # switching back reuses the entries of the first address space
+    set_satp(mycpu, ROOT)
+    assert(mycpu.loaduint(0x1000, 8) == 1)
+    assert(mycpu.tlb.dmisses == 2 and mycpu.tlb.dhits == 1)
+
+    # remapping the page is seen right away, without sfence.vma
+    map_page(mybus, ROOT, 0x1000, bus.DRAM_BASE + 0x21000, PTE_V | PTE_R)
+    assert(mycpu.loaduint(0x1000, 8) == 2)
+
+
+def test_tlb_drops_translated_blocks():
+    mybus = bus.Bus()
+    mycpu = cpu.Cpu(mybus)
+    map_page(mybus, ROOT, 0x1000, bus.DRAM_BASE + 0x20000, PTE_V | PTE_R | PTE_X)
+    # addi a0, a0, 1; jal zero, 0
+    mybus.store(bus.DRAM_BASE + 0x20000, 8, 0x0000006f_00150513)
+    set_satp(mycpu, ROOT)
+    mycpu.pc = 0x1000
+    blk = mycpu.step_block()
+    assert(mycpu.xreg.read(10) == 1 and blk.valid)
+
+    map_page(mybus, ROOT, 0x1000, bus.DRAM_BASE + 0x21000, PTE_V | PTE_R | PTE_X)
+    assert(not blk.valid)
+
+
+def test_tlb_evicts_old_spaces():
+    mybus = bus.Bus()
+    mycpu = cpu.Cpu(mybus)
+    map_page(mybus, ROOT, 0x1000, bus.DRAM_BASE + 0x20000, PTE_V | PTE_R | PTE_X)
+    # addi a0, a0, 1; jal zero, 0
+    mybus.store(bus.DRAM_BASE + 0x20000, 8, 0x0000006f_00150513)
+    # a process per asid, every one of them run once
+    for asid in range(tlb.MAX_SPACES + 8):
+        set_satp(mycpu, ROOT, asid)
+        mycpu.pc = 0x1000
+        mycpu.step_block()
+        assert(mycpu.loaduint(0x1000, 8) == 0x0000006f_00150513)
+    assert(len(mycpu.tlb.spaces) == tlb.MAX_SPACES)
+    assert(len(mycpu.translator.spaces) <= tlb.MAX_SPACES + 1)
+    live = set(mycpu.tlb.spaces)
+    assert(all(user[0] in live for users in mycpu.tlb.pages.values() for user in users))
+
+    # an evicted space walks its page table again, and still follows writes
+    # to it
+    set_satp(mycpu, ROOT, 0)
+    assert(mycpu.loaduint(0x1000, 8) == 0x0000006f_00150513)
+    map_page(mybus, ROOT, 0x1000, bus.DRAM_BASE + 0x21000, PTE_V | PTE_R | PTE_X)
+    mybus.store(bus.DRAM_BASE + 0x21000, 8, 5)
+    assert(mycpu.loaduint(0x1000, 8) == 5)
+    set_satp(mycpu, ROOT, tlb.MAX_SPACES + 7)
+    assert(mycpu.loaduint(0x1000, 8) == 5)
+
+
+# li a0, 5; lui t0, 0x2; sd a0, 8(t0); li a1, 1; j .
+STORE_RO = [0x00500513, 0x000022b7, 0x00a2b423, 0x00100593, 0x0000006f]
+# li a0, 5; lui t0, 0x2; amoadd.d a1, a0, (t0); li a1, 1; j .
+AMO_RO = [0x00500513, 0x000022b7, 0x00a2b5af, 0x00100593, 0x0000006f]
+
+
+def test_tlb_store_to_read_only_page():
+    for program in (STORE_RO, AMO_RO):
+        for jit in (False, True):
+            mybus = bus.Bus()
+            mycpu = cpu.Cpu(mybus)
+            mycpu.jit_enabled = jit
+            map_page(mybus, ROOT, 0x1000, bus.DRAM_BASE + 0x20000, PTE_V | PTE_R | PTE_X)
+            map_page(mybus, ROOT, 0x2000, bus.DRAM_BASE + 0x21000, PTE_V | PTE_R)
+            map_page(mybus, ROOT, 0x3000, bus.DRAM_BASE + 0x22000, PTE_V | PTE_R | PTE_X)
+            for k, inst in enumerate(program):
+                mybus.store(bus.DRAM_BASE + 0x20000 + 4 * k, 4, inst)
+            # the trap handler spins
+            mybus.store(bus.DRAM_BASE + 0x22000, 4, 0x0000006f)
+            mybus.store(bus.DRAM_BASE + 0x21000, 8, 7)
+            mybus.store(bus.DRAM_BASE + 0x21008, 8, 7)
+            mycpu.csrs.write(cpu.CSR.MTVEC, 0x3000)
+            set_satp(mycpu, ROOT)
+            mycpu.pc = 0x1000
+            mycpu.run(10)
+
+            assert(mycpu.csrs.read(cpu.CSR.MCAUSE) == trap.EXCEPTION.StoreAMOPageFault.value)
+            assert(mycpu.csrs.read(cpu.CSR.MEPC) == 0x1008)
+            assert(mycpu.pc == 0x3000)
+            # neither memory nor rd changed, and nothing after the store ran
+            assert(mybus.loaduint(bus.DRAM_BASE + 0x21000, 8) == 7)
+            assert(mybus.loaduint(bus.DRAM_BASE + 0x21008, 8) == 7)
+            assert(mycpu.xreg.read(11) == 0)
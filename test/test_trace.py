@@ -0,0 +1,99 @@
+import sys
+import os
+import io
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import bus
+from pyfive import cpu
+from pyfive import trace
+
+# li a0, 5; 1: addi a0, a0, -1; bnez a0, 1b; ecall
+COUNTDOWN = [0x00500513, 0xfff50513, 0xfe051ee3, 0x00000073]
+# auipc t0, 1; li a0, 5; sw a0, 0(t0); lw a1, 0(t0); ecall
+STORE_LOAD = [0x00001297, 0x00500513, 0x00a2a023, 0x0002a583, 0x00000073]
+# j .
+LOOP = 0x0000006f
+
+
+def make_cpu(size, program=COUNTDOWN, tracer=None):
+    mybus = bus.Bus()
+    for i, inst in enumerate(program):
+        mybus.ram.store(4 * i, 4, inst.to_bytes(4, 'little'))
+    mybus.ram.store(0x100, 4, LOOP.to_bytes(4, 'little'))
+    if size:
+        tracer = trace.Ring(size)
+    mycpu = cpu.Cpu(mybus, trace=tracer)
+    mycpu.csrs.write(cpu.CSR.MTVEC, bus.DRAM_BASE + 0x100)
+    return mycpu
+
+
+def test_trace_off():
+    mycpu = make_cpu(0)
+    assert(mycpu.trace is None)
+    assert(mycpu.jit_enabled)
+    assert("step" not in vars(mycpu))
+
+
+def test_trace_ring():
+    mycpu = make_cpu(4)
+    assert(not mycpu.jit_enabled)
+    mycpu.run(13)
+    ring = mycpu.trace
+    assert(ring.count == 13)
+    entries = ring.entries()
+    assert(len(entries) == 4)
+    # the last countdown iteration, the ecall trap, then the handler loop
+    assert(entries[0] == (trace.RETIRE, 3, bus.DRAM_BASE + 4, COUNTDOWN[1], 10, 0))
+    assert(entries[1][2:4] == (bus.DRAM_BASE + 8, COUNTDOWN[2]))
+    assert(entries[2] == (trace.TRAP, 3, bus.DRAM_BASE + 12, 11, 0, 0))
+    assert(entries[3][2] == bus.DRAM_BASE + 0x100)
+
+    out = io.StringIO()
+    ring.dump(out)
+    lines = out.getvalue().splitlines()
+    assert(lines[0].endswith("last 4 of 13"))
+    assert(lines[1] == "core   0: 3 0x0000000080000004 (0xfff50513) x10 0x0000000000000000")
+    # a branch writes no register
+    assert(lines[2] == "core   0: 3 0x0000000080000008 (0xfe051ee3)")
+    assert(lines[3] == "core   0: M trap EnvironmentCallFromMMode, epc 0x000000008000000c")
+
+
+def test_trace_same_run():
+    plain = make_cpu(0)
+    plain.jit_enabled = False
+    plain.run(13)
+    traced = make_cpu(16)
+    traced.run(13)
+    assert(traced.pc == plain.pc)
+    assert(traced.xreg.xregs == plain.xreg.xregs)
+    assert(traced.csrs.read(cpu.CSR.MEPC) == bus.DRAM_BASE + 12)
+
+
+def test_binary_trace(tmp_path):
+    for compress in (False, True):
+        path = str(tmp_path / f"trace{int(compress)}.bin")
+        # a chunk of two records, so the writer thread sees several
+        tracer = trace.BinaryTrace(path, compress, chunk=2)
+        mycpu = make_cpu(0, STORE_LOAD, tracer)
+        mycpu.run(6)
+        tracer.close()
+        records = trace.read(path)
+        assert(len(records) == 6)
+        assert(records.dtype == trace.DTYPE)
+        assert(list(records["pc"][:4]) == [bus.DRAM_BASE + 4 * i for i in range(4)])
+        assert(list(records["inst"][:4]) == STORE_LOAD[:4])
+        assert(list(records["kind"]) == [trace.RETIRE] * 4 + [trace.TRAP, trace.RETIRE])
+        assert((records["mode"] == 3).all())
+        store, load, ecall = records[2], records[3], records[4]
+        assert(store["access"] == trace.ACCESS_STORE | 4)
+        assert(store["addr"] == bus.DRAM_BASE + 0x1000 and store["data"] == 5)
+        assert(load["access"] == trace.ACCESS_LOAD | 4)
+        assert(load["rd"] == 11 and load["value"] == 5)
+        assert(ecall["pc"] == bus.DRAM_BASE + 16 and ecall["value"] == 11)
+
+        lines = list(trace.spike(records))
+        assert(len(lines) == 5)
+        assert(lines[0] == "core   0: 3 0x0000000080000000 (0x00001297) x5  0x0000000080001000")
+        assert(lines[2] == "core   0: 3 0x0000000080000008 (0x00a2a023) mem 0x0000000080001000 0x00000005")
+        assert(lines[3] == "core   0: 3 0x000000008000000c (0x0002a583) x11 0x0000000000000005 mem 0x0000000080001000")
@@ -0,0 +1,82 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import plic
+from pyfive import uart
+
+IER = uart.UART.IER.value
+IIR = uart.UART.IIR.value
+FCR = uart.UART.FCR.value
+LCR = uart.UART.LCR.value
+LSR = uart.UART.LSR.value
+RHR = uart.UART.RHR.value
+LINE = 1 << uart.UART.IRQ.value
+
+
+def make_uart():
+    myplic = plic.Plic(0x400000)
+    return myplic, uart.Uart(0x100, myplic)
+
+
+def test_uart_fifo():
+    myplic, myuart = make_uart()
+    # fifos on, trigger level 14, receive interrupts
+    myuart.store(FCR, 1, uart.FCR_ENABLE | uart.FCR_CLEAR_RX | 3 << 6)
+    myuart.store(IER, 1, uart.IER_RX)
+    myuart.push_input(b"0123456789")
+    # below the trigger level: no interrupt yet
+    assert(myplic.lines == 0)
+    assert(myuart.load(IIR, 1) == uart.IIR_FIFO | uart.IIR_NONE)
+    myuart.push_input(b"abcdefghijklmnopqrstuvwxyz")
+    assert(myplic.lines == LINE)
+    assert(myuart.load(IIR, 1) == uart.IIR_FIFO | uart.IIR_RX)
+
+    # one interrupt, and the driver reads while LSR says there is more
+    got = bytearray()
+    while myuart.load(LSR, 1) & uart.UART.LSR_RX.value:
+        got.append(myuart.load(RHR, 1))
+        if len(got) == 30:
+            break
+    assert(got == b"0123456789abcdefghijklmnopqrst")
+    # six bytes left, below the trigger: they go after a quiet poll
+    assert(myplic.lines == 0)
+    myuart.poll()
+    assert(myplic.lines == 0)
+    myuart.poll()
+    assert(myplic.lines == LINE)
+    assert(myuart.load(IIR, 1) == uart.IIR_FIFO | uart.IIR_TIMEOUT)
+    while myuart.load(LSR, 1) & uart.UART.LSR_RX.value:
+        got.append(myuart.load(RHR, 1))
+    assert(got == b"0123456789abcdefghijklmnopqrstuvwxyz")
+    assert(myplic.lines == 0)
+
+
+def test_uart_registers():
+    myplic, myuart = make_uart()
+    # the divisor latch hides THR and IER
+    myuart.store(LCR, 1, uart.LCR_DLAB)
+    myuart.store(RHR, 1, 3)
+    myuart.store(IER, 1, 0)
+    assert(myuart.txbuf == b"")
+    assert(myuart.load(RHR, 1) == 3)
+    myuart.store(LCR, 1, 3)
+
+    # without fifos a byte at a time
+    myuart.store(IER, 1, uart.IER_RX)
+    myuart.push_input(b"xy")
+    assert(myuart.load(IIR, 1) == uart.IIR_RX)
+    assert(myuart.load(RHR, 1) == ord("x"))
+    assert(myplic.lines == LINE)
+    assert(myuart.load(RHR, 1) == ord("y"))
+    assert(myplic.lines == 0)
+
+    # transmit interrupts are acknowledged by reading IIR
+    myuart.store(IER, 1, uart.IER_RX | uart.IER_THRE)
+    assert(myplic.lines == LINE)
+    assert(myuart.load(IIR, 1) == uart.IIR_THRE)
+    assert(myplic.lines == 0)
+    myuart.store(RHR, 1, ord("z"))
+    assert(myplic.lines == LINE)
+    assert(myuart.txbuf == b"z")
@@ -0,0 +1,146 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import bus
+from pyfive import virtio
+from pyfive import virtqueue
+
+DESC = bus.DRAM_BASE + 0x1000
+AVAIL = bus.DRAM_BASE + 0x2000
+USED = bus.DRAM_BASE + 0x3000
+HEADER = bus.DRAM_BASE + 0x4000
+DATA = bus.DRAM_BASE + 0x5000
+STATUS = bus.DRAM_BASE + 0x6000
+INDIRECT = bus.DRAM_BASE + 0x7000
+NEXT, WRITE = virtqueue.VIRTQ_DESC_F_NEXT, virtqueue.VIRTQ_DESC_F_WRITE
+
+
+def setup_queue(mybus):
+    for reg, addr in ((0x080, DESC), (0x090, AVAIL), (0x0a0, USED)):
+        mybus.store(bus.VIRTIO_BASE + reg, 4, addr & 0xffff_ffff)
+        mybus.store(bus.VIRTIO_BASE + reg + 4, 4, addr >> 32)
+    mybus.store(bus.VIRTIO_BASE + 0x038, 4, 8)
+
+
+def desc(mybus, table, index, addr, length, flags, next_index=0):
+    base = table + 16 * index
+    mybus.store(base, 8, addr)
+    mybus.store(base + 8, 4, length)
+    mybus.store(base + 12, 2, flags)
+    mybus.store(base + 14, 2, next_index)
+
+
+def make_avail(mybus, heads):
+    idx = mybus.loaduint(AVAIL + 2, 2)
+    for head in heads:
+        mybus.store(AVAIL + 4 + 2 * (idx % 8), 2, head)
+        idx += 1
+    mybus.store(AVAIL + 2, 2, idx)
+
+
+def irq_raised(mybus):
+    return bool(mybus.plic.lines >> virtio.VIRTIO.IRQ.value & 1)
+
+
+# requests are served on the notify itself, which then raises the line
+def notify(mybus):
+    mybus.store(bus.VIRTIO_BASE + 0x050, 4, 0)
+    return irq_raised(mybus)
+
+
+def header(mybus, n, req_type, sector):
+    mybus.store(HEADER + 16 * n, 4, req_type)
+    mybus.store(HEADER + 16 * n + 8, 8, sector)
+
+
+def used(mybus, n):
+    return (mybus.loaduint(USED + 4 + 8 * n, 4), mybus.loaduint(USED + 8 + 8 * n, 4))
+
+
+def test_virtio_block_requests(tmp_path):
+    image = tmp_path / "fs.img"
+    image.write_bytes(bytes(range(256)) * 16)
+    mybus = bus.Bus(disk_bin=str(image))
+    setup_queue(mybus)
+
+    # read sector 2 into two buffers, at head 0
+    header(mybus, 0, virtio.VIRTIO_BLK_T_IN, 2)
+    desc(mybus, DESC, 0, HEADER, 16, NEXT, 1)
+    desc(mybus, DESC, 1, DATA, 512, NEXT | WRITE, 2)
+    desc(mybus, DESC, 2, DATA + 512, 512, NEXT | WRITE, 3)
+    desc(mybus, DESC, 3, STATUS, 1, WRITE)
+    # write sector 7 through an indirect table, at head 4
+    header(mybus, 1, virtio.VIRTIO_BLK_T_OUT, 7)
+    mybus.ram.store(DATA + 0x800 - bus.DRAM_BASE, 512, b"\xaa" * 512)
+    desc(mybus, DESC, 4, INDIRECT, 48, virtqueue.VIRTQ_DESC_F_INDIRECT)
+    desc(mybus, INDIRECT, 0, HEADER + 16, 16, NEXT, 1)
+    desc(mybus, INDIRECT, 1, DATA + 0x800, 512, NEXT, 2)
+    desc(mybus, INDIRECT, 2, STATUS + 1, 1, WRITE)
+    # read past the end of the 4K image, at head 5
+    header(mybus, 2, virtio.VIRTIO_BLK_T_IN, 8)
+    desc(mybus, DESC, 5, HEADER + 32, 16, NEXT, 6)
+    desc(mybus, DESC, 6, DATA + 0xc00, 512, NEXT | WRITE, 7)
+    desc(mybus, DESC, 7, STATUS + 2, 1, WRITE)
+    mybus.store(STATUS, 4, 0xffffff)
+
+    # all three chains are served by a single notify and interrupt
+    make_avail(mybus, [0, 4, 5])
+    assert(notify(mybus))
+    assert(mybus.loaduint(USED + 2, 2) == 3)
+    assert([used(mybus, n) for n in range(3)] == [(0, 1025), (4, 1), (5, 1)])
+    assert(mybus.loaduint(STATUS, 4) == virtio.VIRTIO_BLK_S_IOERR << 16)
+    assert(mybus.ram.load(DATA - bus.DRAM_BASE, 1024) == bytes(range(256)) * 4)
+    assert(mybus.virtio.intr_status == 1)
+    mybus.store(bus.VIRTIO_BASE + 0x064, 4, 1)
+    assert(mybus.virtio.intr_status == 0)
+    assert(not irq_raised(mybus))
+
+    # nothing new on the ring, nothing to signal
+    assert(not notify(mybus))
+
+    header(mybus, 0, virtio.VIRTIO_BLK_T_FLUSH, 0)
+    desc(mybus, DESC, 0, HEADER, 16, NEXT, 3)
+    make_avail(mybus, [0])
+    assert(notify(mybus))
+    assert(used(mybus, 3) == (0, 1))
+
+    mybus.virtio.disk.close()
+    assert(image.read_bytes()[3584:] == b"\xaa" * 512)
+
+
+# a batch of reads and writes, some to the same blocks, in sync and async mode
+def run_batch(tmp_path, io_workers):
+    image = tmp_path / f"fs{io_workers}.img"
+    image.write_bytes(bytes(range(256)) * 32)
+    mybus = bus.Bus(disk_bin=str(image), io_workers=io_workers)
+    setup_queue(mybus)
+    mybus.ram.store(DATA - bus.DRAM_BASE, 0x800, bytes(range(8)) * 0x100)
+    plan = [(virtio.VIRTIO_BLK_T_OUT, 1, DATA), (virtio.VIRTIO_BLK_T_IN, 1, DATA + 0x1000),
+            (virtio.VIRTIO_BLK_T_OUT, 1, DATA + 0x200), (virtio.VIRTIO_BLK_T_IN, 3, DATA + 0x1200),
+            (virtio.VIRTIO_BLK_T_FLUSH, 0, 0), (virtio.VIRTIO_BLK_T_IN, 1, DATA + 0x1400)]
+    for n, (req_type, sector, addr) in enumerate(plan):
+        header(mybus, n, req_type, sector)
+        desc(mybus, DESC, 3 * n, HEADER + 16 * n, 16, NEXT, 3 * n + 1)
+        desc(mybus, DESC, 3 * n + 1, addr, 512, NEXT | (WRITE if req_type == virtio.VIRTIO_BLK_T_IN else 0),
+             3 * n + 2)
+        desc(mybus, DESC, 3 * n + 2, STATUS + n, 1, WRITE)
+    mybus.store(bus.VIRTIO_BASE + 0x038, 4, 32)
+    make_avail(mybus, [3 * n for n in range(len(plan))])
+    # the guest goes on while the workers are busy and gets an interrupt
+    # once requests complete
+    interrupted = notify(mybus)
+    while mybus.virtio.inflight:
+        mybus.plic.serve()
+        interrupted = irq_raised(mybus) or interrupted
+    assert(interrupted)
+    assert(mybus.loaduint(USED + 2, 2) == len(plan))
+    result = (mybus.ram.load(USED - bus.DRAM_BASE, 4 + 8 * len(plan)),
+              mybus.ram.load(DATA - bus.DRAM_BASE, 0x2000), mybus.ram.load(STATUS - bus.DRAM_BASE, 8))
+    mybus.virtio.close()
+    return result + (image.read_bytes(),)
+
+
+def test_virtio_async(tmp_path):
+    assert(run_batch(tmp_path, 0) == run_batch(tmp_path, 4))
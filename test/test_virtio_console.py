@@ -0,0 +1,88 @@
+import sys
+import os
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{dir_path}/..")
+from pyfive import bus
+from pyfive import console
+from pyfive import virtio_console
+from pyfive import virtqueue
+
+BASE = bus.VIRTIO_CONSOLE_BASE
+WRITE = virtqueue.VIRTQ_DESC_F_WRITE
+NEXT = virtqueue.VIRTQ_DESC_F_NEXT
+LINE = 1 << virtio_console.VCONSOLE.IRQ.value
+# desc, avail, used and buffers of each queue
+RINGS = [bus.DRAM_BASE + 0x10000 * (q + 1) + 0x1000 * n for q in range(2) for n in range(4)]
+
+
+def setup_queues(mybus):
+    for q in range(2):
+        mybus.store(BASE + 0x030, 4, q)
+        mybus.store(BASE + 0x038, 4, 8)
+        for n, reg in enumerate((0x080, 0x090, 0x0a0)):
+            mybus.store(BASE + reg, 4, RINGS[4 * q + n] & 0xffff_ffff)
+            mybus.store(BASE + reg + 4, 4, RINGS[4 * q + n] >> 32)
+        mybus.store(BASE + 0x044, 4, 1)
+
+
+def post(mybus, q, chains):
+    table, avail, _used, data = RINGS[4 * q:4 * q + 4]
+    index = 0
+    idx = mybus.loaduint(avail + 2, 2)
+    for chain in chains:
+        mybus.store(avail + 4 + 2 * (idx % 8), 2, index)
+        idx += 1
+        for n, (payload, length, flags) in enumerate(chain):
+            addr = data + 0x100 * index
+            mybus.ram.store(addr - bus.DRAM_BASE, len(payload), payload)
+            last = n == len(chain) - 1
+            mybus.store(table + 16 * index, 8, addr)
+            mybus.store(table + 16 * index + 8, 4, length)
+            mybus.store(table + 16 * index + 12, 2, flags | (0 if last else NEXT))
+            mybus.store(table + 16 * index + 14, 2, index + 1)
+            index += 1
+    mybus.store(avail + 2, 2, idx)
+    mybus.store(BASE + 0x050, 4, q)
+
+
+def used(mybus, q, n):
+    ring = RINGS[4 * q + 2]
+    return (mybus.loaduint(ring + 4 + 8 * n, 4), mybus.loaduint(ring + 8 + 8 * n, 4))
+
+
+def test_virtio_console():
+    out = console.MemoryConsole()
+    mybus = bus.Bus(vconsole=out)
+    assert(mybus.load(BASE + 0x008, 4) == virtio_console.VCONSOLE.DEVICE_ID.value)
+    setup_queues(mybus)
+
+    # two chains of output, one write to the console
+    post(mybus, 1, [[(b"hello, ", 7, 0), (b"world", 5, 0)], [(b"!\n", 2, 0)]])
+    assert(out.output == b"hello, world!\n")
+    assert(mybus.loaduint(RINGS[6] + 2, 2) == 2)
+    assert(mybus.plic.lines == LINE)
+    mybus.store(BASE + 0x064, 4, 1)
+    assert(mybus.plic.lines == 0)
+
+    # input fills the receive buffers in order, each as far as it goes
+    post(mybus, 0, [[(b"", 4, WRITE)], [(b"", 4, WRITE)]])
+    assert(mybus.plic.lines == 0)
+    mybus.vconsole.push_input(b"ls -l")
+    assert(used(mybus, 0, 0) == (0, 4))
+    assert(used(mybus, 0, 1) == (1, 1))
+    assert(mybus.ram.load(RINGS[3] - bus.DRAM_BASE, 4) == b"ls -")
+    assert(mybus.ram.load(RINGS[3] + 0x100 - bus.DRAM_BASE, 1) == b"l")
+    assert(mybus.plic.lines == LINE)
+
+    # input waits for buffers, which survive a save and load
+    mybus.vconsole.push_input(b"abc")
+    post(mybus, 0, [[(b"", 2, WRITE)]])
+    state = mybus.vconsole.save_state()
+    assert(state["pending"] == list(b"c"))
+    other = bus.Bus(vconsole=console.MemoryConsole())
+    other.ram.store(0, mybus.ram.size, mybus.ram.load(0, mybus.ram.size))
+    other.vconsole.load_state(state)
+    post(other, 0, [[(b"", 8, WRITE)]])
+    assert(used(other, 0, 3) == (0, 1))
+    assert(other.ram.load(RINGS[3] - bus.DRAM_BASE, 1) == b"c")